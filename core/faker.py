@@ -141,6 +141,8 @@ class FakeModelFactory:
                 'begin_at':     get_datetime('begin_at', 'before'),
                 'end_at':       get_datetime('end_at', 'after'),
                 'max_item_quantity': kwargs.get('max_item_quantity', self.faker.random_int()),
+                'max_concurrent_checkouts': kwargs.get('max_concurrent_checkouts'),
+                'ticket_renderer': kwargs.get('ticket_renderer', 'html'),
             }
 
         # ============================================
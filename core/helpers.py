@@ -1,5 +1,7 @@
-from typing import Sequence, Iterable, Callable
+from typing import Any, Sequence, Iterable, Callable
 from datetime import datetime
+from threading import Lock
+import time
 
 from django.utils import timezone
 
@@ -50,6 +52,27 @@ def iterable_to_map(iterable: Iterable, get_key: Callable=None, prop: str=None,
     return { get_key(obj): obj for obj in iterable }
 
 
+def is_list_of_records(data: Any, scalar_keys: Sequence=()) -> bool:
+    """
+    Check that data is a list of dictionnaries
+    whose values are scalars or missing for the given keys
+
+    Args:
+        data: the data to check, usually from a request body
+        scalar_keys: the keys whose values must be scalars, to be used as keys
+
+    Returns:
+        bool: whether the data is valid
+    """
+    return isinstance(data, list) and all(
+        isinstance(record, dict) and all(
+            record.get(key) is None or isinstance(record.get(key), (str, int, float))
+            for key in scalar_keys
+        )
+        for record in data
+    )
+
+
 def format_date(date) -> datetime:
     """
     Format a date with the proper timezone
@@ -60,6 +83,32 @@ def format_date(date) -> datetime:
         return timezone.make_aware(date, CURRENT_TZ, is_dst=False)
 
 
+# --------------------------------------------------------------------------
+#       Concurrency
+# --------------------------------------------------------------------------
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing calls to at most `rate` per second
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = Lock()
+
+    def wait(self) -> None:
+        """
+        Block until the caller is allowed to proceed
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
 # --------------------------------------------------------------------------
 #       Models
 # --------------------------------------------------------------------------
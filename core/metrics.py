@@ -0,0 +1,163 @@
+from typing import Callable, Dict
+from collections import Counter
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+import time
+
+# Upper bounds in seconds of the histograms buckets, from 0.5ms to about 30s
+BUCKET_BOUNDS = tuple(0.0005 * 1.2 ** i for i in range(61))
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    """
+    Thread-safe in-process histogram of durations with errors counted by code
+
+    Durations are counted in fixed buckets growing by 20%, so that recording
+    is constant time and memory while percentiles stay within 20% of the truth
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+            self.errors = Counter()
+
+    def record(self, duration: float, error_code: str=None) -> None:
+        index = bisect_left(BUCKET_BOUNDS, duration)
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += duration
+            if duration > self.max:
+                self.max = duration
+            if error_code is not None:
+                self.errors[error_code] += 1
+
+    def _percentile(self, buckets: list, count: int, max_duration: float,
+                    percent: float) -> float:
+        rank = count * percent / 100
+        seen = 0
+        for index, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                is_last = index >= len(BUCKET_BOUNDS)
+                bound = max_duration if is_last else BUCKET_BOUNDS[index]
+                return min(bound, max_duration)
+        return max_duration
+
+    def snapshot(self) -> dict:
+        """
+        Get the statistics of the histogram, durations being in milliseconds
+        """
+        with self.lock:
+            buckets, count, total = list(self.buckets), self.count, self.total
+            max_duration, errors = self.max, dict(self.errors)
+
+        stats = {
+            'count': count,
+            'errors': errors,
+            'mean': 1000 * total / count if count else None,
+            'max': 1000 * max_duration if count else None,
+        }
+        for percent in PERCENTILES:
+            value = None
+            if count:
+                value = self._percentile(buckets, count, max_duration, percent)
+            stats[f"p{percent}"] = 1000 * value if value is not None else None
+        return stats
+
+
+_histograms = {}
+_histograms_lock = Lock()
+
+
+def get_histogram(name: str) -> Histogram:
+    """
+    Get or create the histogram of the given name shared by the whole process
+    """
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, Histogram(name))
+    return histogram
+
+
+def get_metrics() -> Dict[str, dict]:
+    """
+    Get the statistics of all the histograms mapped by name
+    """
+    return {
+        name: histogram.snapshot()
+        for name, histogram in sorted(_histograms.items())
+    }
+
+
+def reset_metrics() -> None:
+    for histogram in tuple(_histograms.values()):
+        histogram.reset()
+
+
+def get_error_code(error: Exception) -> str:
+    """
+    Get a short code of an error, from its code or its HTTP response status if any
+    """
+    code = getattr(error, 'code', None)
+    if isinstance(code, str):
+        return code
+    status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status_code is not None:
+        return f"http_{status_code}"
+    return type(error).__name__
+
+
+class timed:
+    """
+    Record the duration and the error of a block or a function in a histogram
+
+    Usage:
+        with timed('name'):
+            ...
+
+        @timed('name')
+        def function():
+            ...
+    """
+
+    def __init__(self, name: str):
+        self.histogram = get_histogram(name)
+
+    def __enter__(self) -> 'timed':
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, error, traceback) -> bool:
+        duration = time.monotonic() - self.start
+        error_code = get_error_code(error) if error is not None else None
+        self.histogram.record(duration, error_code)
+        return False
+
+    def __call__(self, func: Callable) -> Callable:
+        histogram = self.histogram
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            error_code = None
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                error_code = get_error_code(error)
+                raise
+            finally:
+                histogram.record(time.monotonic() - start, error_code)
+
+        return wrapper
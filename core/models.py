@@ -1,4 +1,4 @@
-from typing import Any, Union, Sequence, List, Set, Tuple
+from typing import Any, Union, Sequence, List, Set, Tuple, Dict
 import logging
 
 from django.conf import settings
@@ -314,3 +314,65 @@ class APIModel(Model):
 
     class Meta:
         abstract = True
+
+
+class TrackedFieldsModel(Model):
+    """
+    Model that remembers the last saved values of its tracked fields
+    in order to know what changed before saving
+
+    Tracked fields are attribute names, use `<field>_id` for foreign keys
+    """
+    tracked_fields: Tuple[str] = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._saved_values = {}
+
+    @classmethod
+    def from_db(cls, db, field_names, values) -> 'TrackedFieldsModel':
+        instance = super().from_db(db, field_names, values)
+        instance._reset_tracked_fields()
+        return instance
+
+    def _reset_tracked_fields(self, fields: Sequence[str]=None) -> None:
+        """
+        Remember the current values of the tracked fields as saved values
+        """
+        for attr in (self.tracked_fields if fields is None else fields):
+            if attr in self.tracked_fields and attr in self.__dict__:
+                self._saved_values[attr] = self.__dict__[attr]
+
+    def get_saved_value(self, attr: str, default: Any=None) -> Any:
+        """
+        Get the last saved value of a tracked field
+        """
+        return self._saved_values.get(attr, default)
+
+    def get_dirty_fields(self) -> Dict[str, Any]:
+        """
+        Get the tracked fields that changed since the last save
+        mapped to their last saved value (None if never saved)
+        """
+        saved = self._saved_values
+        return {
+            attr: saved.get(attr)
+            for attr in self.tracked_fields
+            if attr not in saved or saved[attr] != getattr(self, attr)
+        }
+
+    def refresh_from_db(self, using: str=None, fields: Sequence[str]=None) -> None:
+        super().refresh_from_db(using, fields)
+        self._reset_tracked_fields(fields)
+
+    def save(self, *args, **kwargs) -> None:
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = [
+                self._meta.get_field(name).attname for name in update_fields
+            ]
+        self._reset_tracked_fields(update_fields)
+
+    class Meta:
+        abstract = True
@@ -0,0 +1,179 @@
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, List, Tuple, TYPE_CHECKING
+from base64 import b64encode
+from threading import Lock
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image
+from qrcode import QRCode
+from qrcode.constants import ERROR_CORRECT_Q
+
+if TYPE_CHECKING:
+    from reportlab.pdfgen.canvas import Canvas
+
+# Dark modules of a QR code as (x, y, width) horizontal runs, with the size in modules
+QRCodeRuns = Tuple[Tuple[Tuple[int, int, int], ...], int]
+
+
+class LRUCache:
+    """
+    Thread-safe cache keeping at most `maxsize` values, least recently used first out
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self.values = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get_or_set(self, key: Any, compute: Callable[[], Any]) -> Any:
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return self.values[key]
+            self.misses += 1
+
+        # Computed outside of the lock, concurrent misses only compute twice
+        value = compute()
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.values.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class QRCodeEngine:
+    """
+    Encode ticket payloads, usually OrderLineItem uuids, into QR codes
+    as base64 PNG images, SVG paths or shapes drawn on a PDF canvas
+
+    Each payload is only encoded once into its dark modules,
+    from which every output is built and kept in a bounded LRU cache
+    """
+    OUTPUTS = ('png', 'svg')
+
+    def __init__(self, maxsize: int=4096, error_correction: int=ERROR_CORRECT_Q,
+                 box_size: int=8, border: int=2):
+        self.cache = LRUCache(maxsize)
+        self.error_correction = error_correction
+        self.box_size = box_size
+        self.border = border
+
+    # ------------------------------------------------------------
+    #   Encoding
+    # ------------------------------------------------------------
+
+    def _get_runs(self, data: str) -> QRCodeRuns:
+        # Add border to improve readability
+        qr_code = QRCode(error_correction=self.error_correction, border=self.border)
+        qr_code.add_data(data)
+        qr_code.make(fit=True)
+        matrix = qr_code.get_matrix()
+
+        runs = []
+        for y, row in enumerate(matrix):
+            x = 0
+            while x < len(row):
+                if row[x]:
+                    start = x
+                    while x < len(row) and row[x]:
+                        x += 1
+                    runs.append((start, y, x - start))
+                else:
+                    x += 1
+        return tuple(runs), len(matrix)
+
+    def get_runs(self, data: str) -> QRCodeRuns:
+        """
+        Get the dark modules of the QR code of the data
+        """
+        return self.cache.get_or_set(('runs', data), lambda: self._get_runs(data))
+
+    def _get_png(self, data: str) -> str:
+        runs, size = self.get_runs(data)
+        image = Image.new('1', (size, size), 1)
+        for x, y, width in runs:
+            image.paste(0, (x, y, x + width, y + 1))
+        image = image.resize((size * self.box_size, size * self.box_size), Image.NEAREST)
+
+        image_buffer = BytesIO()
+        image.save(image_buffer, format='PNG')
+        return b64encode(image_buffer.getvalue()).decode('utf-8')
+
+    def get_png(self, data: str) -> str:
+        """
+        Get the QR code of the data as a base64 PNG image
+        """
+        return self.cache.get_or_set(('png', data), lambda: self._get_png(data))
+
+    def _get_svg(self, data: str) -> str:
+        runs, size = self.get_runs(data)
+        path = ''.join(f"M{x} {y}h{width}v1h-{width}z" for x, y, width in runs)
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" '
+                f'shape-rendering="crispEdges">'
+                f'<path fill="#fff" d="M0 0h{size}v{size}H0z"/>'
+                f'<path d="{path}"/></svg>')
+
+    def get_svg(self, data: str) -> str:
+        """
+        Get the QR code of the data as a compact SVG image, one unit per module
+        """
+        return self.cache.get_or_set(('svg', data), lambda: self._get_svg(data))
+
+    def batch(self, payloads: Iterable[str], output: str='png') -> List[str]:
+        """
+        Get the QR codes of many payloads in the requested output
+        """
+        if output not in self.OUTPUTS:
+            raise ValueError(f"Unknown output {output}, "
+                             f"expected one of {', '.join(self.OUTPUTS)}")
+        encode = self.get_png if output == 'png' else self.get_svg
+        return [ encode(data) for data in payloads ]
+
+    # ------------------------------------------------------------
+    #   Drawing
+    # ------------------------------------------------------------
+
+    def draw(self, pdf: 'Canvas', data: str, x: float, y: float, size: float) -> None:
+        """
+        Draw the QR code of the data as vector shapes on a reportlab canvas,
+        in the square of the given size whose bottom left corner is (x, y)
+        """
+        runs, n_modules = self.get_runs(data)
+        module = size / n_modules
+        top = y + size
+        path = pdf.beginPath()
+        for run_x, run_y, width in runs:
+            path.rect(x + run_x * module, top - (run_y + 1) * module,
+                      width * module, module)
+        pdf.saveState()
+        pdf.setFillColorRGB(0, 0, 0)
+        pdf.drawPath(path, stroke=0, fill=1)
+        pdf.restoreState()
+
+
+_engine = None
+_engine_lock = Lock()
+
+
+def get_qrcode_engine() -> QRCodeEngine:
+    """
+    Get the QR code engine shared by the whole process
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = QRCodeEngine(settings.QRCODE_CACHE_SIZE)
+    return _engine
@@ -1,15 +1,22 @@
 import os
 from io import BytesIO
-from base64 import b64encode
+from typing import Sequence, TYPE_CHECKING
 
 from rest_framework.renderers import BrowsableAPIRenderer as BaseAPIRenderer
 from django.conf import settings
+from django.contrib.staticfiles import finders
 from django.http import HttpResponse
 from django.template.loader import get_template
 from xhtml2pdf import pisa
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
 
-from qrcode import QRCode
-from qrcode.constants import ERROR_CORRECT_Q
+from core.exceptions import APIException
+from core.qrcodes import get_qrcode_engine
+
+if TYPE_CHECKING:
+    from sales.models import Order
 
 
 class BrowsableAPIRenderer(BaseAPIRenderer):
@@ -32,24 +39,25 @@ class BrowsableAPIRenderer(BaseAPIRenderer):
 #   Tickets
 # --------------------------------------------
 
-def link_asset(uri: str) -> str:
+def link_asset(uri: str, rel: str=None) -> str:
     """
     Callback to allow xhtml2pdf/reportlab to retrieve Images,Stylesheets, etc.
     `uri` is the href attribute from the html link element.
     """
-    if settings.MEDIA_URL and uri.startswith(settings.MEDIA_URL):
-        path = os.path.join(settings.MEDIA_ROOT, uri.replace(settings.MEDIA_URL, ''))
-    elif settings.STATIC_URL and uri.startswith(settings.STATIC_URL):
-        path = os.path.join(settings.STATIC_ROOT, uri.replace(settings.STATIC_URL, ''))
-
-    if not os.path.exists(path):
-        for folder in settings.STATICFILES_DIRS:
-            path = os.path.join(folder, uri.replace(settings.STATIC_URL, ""))
-            if os.path.exists(path):
-                return path
-    elif uri.startswith("http://") or uri.startswith("https://"):
+    # Data and remote uris are left as is
+    if uri.startswith(('data:', 'http://', 'https://')):
         return uri
-    return path
+
+    if settings.MEDIA_URL and uri.startswith(settings.MEDIA_URL):
+        return os.path.join(settings.MEDIA_ROOT, uri.replace(settings.MEDIA_URL, ''))
+    if settings.STATIC_URL and uri.startswith(settings.STATIC_URL):
+        name = uri.replace(settings.STATIC_URL, '')
+        path = os.path.join(settings.STATIC_ROOT, name)
+        # Look into the static folders if not collected yet
+        if not os.path.exists(path):
+            path = finders.find(name) or path
+        return path
+    return uri
 
 
 def render_to_pdf(template_src: str, context_dict: dict={}) -> HttpResponse:
@@ -64,15 +72,106 @@ def render_to_pdf(template_src: str, context_dict: dict={}) -> HttpResponse:
     return None
 
 
+TICKETS_TEMPLATE = 'pdf/template_order.html'
+
+
+def get_tickets_context(tickets: Sequence[dict], order: 'Order') -> dict:
+    """
+    Get the context of the tickets template, with the QR codes as images
+    """
+    qr_codes = get_qrcode_engine().batch(ticket['qr_data'] for ticket in tickets)
+    for ticket, qr_code in zip(tickets, qr_codes):
+        ticket['qr_code'] = qr_code
+    return {
+        'tickets': tickets,
+        'order': order,
+    }
+
+
+def render_tickets_pdf(tickets: Sequence[dict], order: 'Order') -> bytes:
+    """
+    Render tickets as a PDF with the renderer of their sale,
+    only from the data of the tickets so it can run in other processes
+    """
+    # The canvas draws QR codes as vectors, templates need images
+    if order.sale.ticket_renderer == 'canvas':
+        return draw_tickets_pdf(tickets, order)
+
+    pdf = render_to_pdf(TICKETS_TEMPLATE, get_tickets_context(tickets, order))
+    if pdf is None:
+        raise APIException("Les billets n'ont pas pu être générés",
+                           'tickets_rendering_failed')
+    return pdf.content
+
+
+# Layout of the tickets drawn on the canvas, in points
+TICKET_MARGIN = 30
+TICKET_PADDING = 30
+TICKET_HEIGHT = 200
+TICKET_QR_SIZE = 130
+
+
+def _fit_font_size(pdf: canvas.Canvas, text: str, font: str, size: float,
+                   width: float) -> float:
+    """
+    Shrink the font size so that the text fits in the width
+    """
+    text_width = pdf.stringWidth(text, font, size)
+    return size if text_width <= width else size * width / text_width
+
+
+def draw_tickets_pdf(tickets: Sequence[dict], order: 'Order') -> bytes:
+    """
+    Draw tickets with the layout of pdf/template_order.html
+    straight onto a PDF canvas, without parsing any HTML nor CSS
+    """
+    qr_codes = get_qrcode_engine()
+    buffer = BytesIO()
+    page_width, page_height = A4
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    pdf.setTitle("Commande Woolly")
+
+    left = TICKET_MARGIN
+    right = page_width - TICKET_MARGIN
+    info_width = 0.65 * (right - left) - TICKET_PADDING
+    y = page_height
+    for ticket in tickets:
+        if y - TICKET_HEIGHT < 0:
+            pdf.showPage()
+            y = page_height
+        top = y - TICKET_PADDING
+
+        # Left part: item, sale and details
+        item_name = str(ticket['item'].name)
+        size = _fit_font_size(pdf, item_name, 'Helvetica', 36, info_width)
+        pdf.setFillColor(colors.black)
+        pdf.setFont('Helvetica', size)
+        pdf.drawString(left, top - size, item_name)
+        pdf.setFillColor(colors.HexColor('#555555'))
+        pdf.setFont('Helvetica', 20)
+        pdf.drawString(left, top - size - 26, str(order.sale.name))
+        pdf.setFillColor(colors.black)
+        pdf.setFont('Helvetica', 14)
+        pdf.drawString(left + 10, top - size - 60, f"Prix : {ticket['item'].price}€")
+        pdf.drawString(left + 10, top - size - 84, f"{ticket['nom']} {ticket['prenom']}")
+
+        # Right part: QR code drawn as vectors and uuid
+        qr_codes.draw(pdf, ticket['qr_data'],
+                      right - TICKET_QR_SIZE, top - TICKET_QR_SIZE, TICKET_QR_SIZE)
+        pdf.setFont('Courier', 7)
+        pdf.drawCentredString(right - TICKET_QR_SIZE / 2, top - TICKET_QR_SIZE - 10,
+                              str(ticket['uuid']))
+
+        y -= TICKET_HEIGHT
+        pdf.setStrokeColor(colors.HexColor('#aaaaaa'))
+        pdf.line(left, y, right, y)
+
+    pdf.save()
+    return buffer.getvalue()
+
+
 def base64_qrcode(data: str) -> str:
     """
     Return a qrcode image from data
     """
-    # Add border to improve readability
-    qr_code = QRCode(error_correction=ERROR_CORRECT_Q, box_size=8, border=2)
-    qr_code.add_data(data)
-    qr_code.make(fit=True)
-
-    image_buffer = BytesIO()
-    qr_code.make_image().save(image_buffer)
-    return b64encode(image_buffer.getvalue()).decode('utf-8')
+    return get_qrcode_engine().get_png(data)
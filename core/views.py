@@ -1,6 +1,9 @@
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+
+from core.permissions import IsAdmin
+from core.metrics import get_metrics, reset_metrics
 
 
 @api_view(['GET'])
@@ -36,3 +39,15 @@ def api_root(request, format=None):
         # TODO PaymentMethods
         # 'paymentmethods':  reverse('paymentmethods-list',  **kwargs),
     })
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAdmin])
+def metrics(request, format=None):
+    """
+    Admin only latencies of the instrumented paths of this process,
+    durations are in milliseconds, DELETE resets them
+    """
+    if request.method == 'DELETE':
+        reset_metrics()
+    return Response(get_metrics())
@@ -0,0 +1,130 @@
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+
+from core.exceptions import APIException
+from authentication.models import User
+from sales.models import Sale, AdmissionTicket
+
+
+class AdmissionQueue:
+    """
+    Virtual waiting room in front of the payment path of a sale
+
+    Buyers take a ticket, stored in the database so that every worker
+    shares the same queue. Once the sale has begun, the oldest waiting tickets
+    are admitted as long as less than `max_concurrent_checkouts` admitted
+    buyers are checking out. An admitted ticket is released once its checkout
+    reaches the payment, or expires after ADMISSION_TOKEN_TIMEOUT if the buyer
+    gives up, letting the next buyer in. Only admitted buyers may enter
+    the payment path, which thus runs at a bounded concurrency whatever the rush.
+    A buyer whose ticket was released or expired has to queue again.
+
+    The queue is disabled if the sale has no max_concurrent_checkouts.
+    """
+
+    def __init__(self, sale: Sale):
+        self.sale = sale
+        self.size = sale.max_concurrent_checkouts
+        self.tickets = AdmissionTicket.objects.filter(sale=sale)
+
+    @property
+    def is_enabled(self) -> bool:
+        return bool(self.size)
+
+    def _take_ticket(self, user: User, now) -> AdmissionTicket:
+        """
+        Get the ticket of the user, or take a new one at the end of the queue
+        if they have none or their admission expired
+        """
+        ticket = self.tickets.filter(user=user).first()
+        if ticket is not None and ticket.is_admitted and ticket.expires_at <= now:
+            ticket.delete()
+            ticket = None
+        if ticket is None:
+            ticket, __ = AdmissionTicket.objects.get_or_create(sale=self.sale, user=user)
+        return ticket
+
+    def _admit_next(self, now) -> None:
+        """
+        Admit the oldest waiting tickets while less than `size` are checking out
+        """
+        if now < self.sale.begin_at:
+            return
+
+        checking_out = self.tickets.filter(expires_at__gt=now)
+        waiting = self.tickets.filter(admitted_at__isnull=True)
+        # Most polls find the checkout full, and don't need the lock
+        if checking_out.count() >= self.size or not waiting.exists():
+            return
+
+        # Admissions are serialized by the sale lock so that they never exceed the size
+        with transaction.atomic():
+            sale = Sale.objects.select_for_update().filter(pk=self.sale.pk)
+            list(sale.values_list('pk'))
+            self.tickets.filter(expires_at__lte=now).delete()
+            free = self.size - checking_out.count()
+            if free > 0:
+                next_pks = waiting.order_by('id').values_list('pk', flat=True)[:free]
+                next_pks = list(next_pks)
+                AdmissionTicket.objects.filter(pk__in=next_pks).update(
+                    admitted_at=now, expires_at=now + settings.ADMISSION_TOKEN_TIMEOUT)
+
+    def has_token(self, user: User) -> bool:
+        if not self.is_enabled:
+            return True
+        return self.tickets.filter(user=user, expires_at__gt=timezone.now()).exists()
+
+    def poll(self, user: User) -> dict:
+        """
+        Queue the user if needed and get their admission state
+
+        Returns:
+            admitted: whether the user can go to the payment
+            position: number of tickets to admit before the user's one
+            wait: estimated number of seconds before being admitted
+        """
+        if not self.is_enabled:
+            return { 'admitted': True, 'position': 0, 'wait': 0 }
+
+        now = timezone.now()
+        ticket = self._take_ticket(user, now)
+        if not ticket.is_admitted:
+            self._admit_next(now)
+            ticket.refresh_from_db()
+        if ticket.is_admitted:
+            return { 'admitted': True, 'position': 0, 'wait': 0 }
+
+        waiting = self.tickets.filter(admitted_at__isnull=True)
+        position = waiting.filter(pk__lte=ticket.pk).count()
+        checkout_duration = settings.ADMISSION_CHECKOUT_DURATION.total_seconds()
+        wait = math.ceil(position / self.size) * checkout_duration
+        if now < self.sale.begin_at:
+            wait += (self.sale.begin_at - now).total_seconds()
+        return { 'admitted': False, 'position': position, 'wait': math.ceil(wait) }
+
+    def check(self, user: User) -> None:
+        """
+        Raise if the user has not been admitted to the payment of the sale,
+        queuing them if needed
+        """
+        if self.has_token(user):
+            return
+        state = self.poll(user)
+        if not state['admitted']:
+            raise APIException(
+                "Vous devez attendre votre tour dans la file d'attente de la vente.",
+                'admission_required',
+                details=state,
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def release(self, user: User) -> None:
+        """
+        Release the place of the user once their checkout ended,
+        letting the next buyer in
+        """
+        if self.is_enabled:
+            self.tickets.filter(user=user).delete()
@@ -0,0 +1,175 @@
+"""
+Concurrency benchmark of the checkout path: many buyers checking out
+the same sale at once, in threads or in separate processes
+
+Usage:
+    python manage.py benchmark_checkout --help
+"""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import Counter
+from threading import Event
+from typing import Any, List, Tuple
+import multiprocessing
+import random
+import time
+
+from django import db
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+
+from core.faker import FakeModelFactory
+from core.testcases import get_api_client
+from authentication.models import User, UserType
+from sales.models import Sale, Item, Order, OrderLine, OrderStatus, StockCounter
+
+# Result of a checkout: status code, duration in seconds and number of queries
+CheckoutResult = Tuple[int, float, int]
+
+MODES = ('threads', 'processes')
+
+
+def checkout(sale_id: str, user: User, item_id: int, quantity: int) -> CheckoutResult:
+    """
+    Order and pay an item in a single request, as a buyer would
+    """
+    with get_api_client(user) as client:
+        with CaptureQueriesContext(db.connection) as queries:
+            start = time.monotonic()
+            resp = client.post(f"/sales/{sale_id}/checkout", {
+                'orderlines': [ { 'item': item_id, 'quantity': quantity } ],
+                'return_url': 'http://localhost:3000/orders',
+            }, format='json')
+            duration = time.monotonic() - start
+        return resp.status_code, duration, len(queries)
+
+
+def _checkout_in_process(sale_id: str, user_pk: Any, item_id: int,
+                         quantity: int) -> CheckoutResult:
+    return checkout(sale_id, User.objects.get(pk=user_pk), item_id, quantity)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of a list of values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(len(values) * percent / 100 + 0.5), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class CheckoutBenchmark:
+    """
+    Drive `buyers` concurrent checkouts against a single sale
+    of `items` items holding `stock` units each, every buyer
+    checking out `quantity` units of a random item
+
+    The report counts the checkouts per second, their latencies and queries,
+    and the quantity sold beyond the stock, which must always be 0
+    """
+
+    def __init__(self, buyers: int=50, items: int=1, stock: int=10, quantity: int=1,
+                 sale_quantity: int=None, seed: Any=None):
+        self.buyers = buyers
+        self.n_items = items
+        self.stock = stock
+        self.quantity = quantity
+        self.sale_quantity = sale_quantity
+        self.random = random.Random(seed)
+        self.factory = FakeModelFactory()
+
+    def setup(self) -> None:
+        """
+        Create the sale, its items and the buyers
+        """
+        self.sale = self.factory.create(Sale, max_item_quantity=self.sale_quantity)
+        usertype = self.factory.create(UserType, validation='True')
+        self.items = [
+            self.factory.create(Item, sale=self.sale, group=None, usertype=usertype,
+                                quantity=self.stock, max_per_user=None)
+            for __ in range(self.n_items)
+        ]
+        self.users = [ self.factory.create(User) for __ in range(self.buyers) ]
+
+    def run(self, mode: str='threads', workers: int=None) -> dict:
+        """
+        Run all the checkouts at once and report on them
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, expected one of {', '.join(MODES)}")
+
+        jobs = [ (user, self.random.choice(self.items).pk) for user in self.users ]
+        workers = workers or self.buyers
+        start = time.monotonic()
+        if mode == 'threads':
+            # Buyers are released all at once, once every job is submitted
+            go = Event()
+
+            def buy(user: User, item_id: int) -> CheckoutResult:
+                go.wait()
+                return checkout(self.sale.pk, user, item_id, self.quantity)
+
+            with ThreadPoolExecutor(workers) as executor:
+                futures = [
+                    executor.submit(buy, user, item_id) for user, item_id in jobs
+                ]
+                start = time.monotonic()
+                go.set()
+                results = [ future.result() for future in futures ]
+        else:
+            # Children must open their own connections, not share the parent ones
+            db.connections.close_all()
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(workers, mp_context=context) as executor:
+                futures = [
+                    executor.submit(_checkout_in_process,
+                                    self.sale.pk, user.pk, item_id, self.quantity)
+                    for user, item_id in jobs
+                ]
+                results = [ future.result() for future in futures ]
+        duration = time.monotonic() - start
+        return self.report(mode, results, duration)
+
+    def get_oversold(self) -> Tuple[int, int, int]:
+        """
+        Get the quantity sold from the booking orderlines, the quantity sold
+        beyond the stock, and the difference with the stock counters
+        """
+        orderlines = OrderLine.objects.filter(
+            order__sale=self.sale, order__status__in=OrderStatus.BOOKING_LIST.value)
+        sold = dict(orderlines.order_by().values_list('item_id')
+                              .annotate(quantity=Sum('quantity')))
+        oversold = sum(
+            max(sold.get(item.pk, 0) - item.quantity, 0) for item in self.items
+        )
+        total = sum(sold.values())
+        if self.sale_quantity:
+            oversold = max(oversold, total - self.sale_quantity)
+
+        counted = StockCounter.objects.get_quantity(self.sale, sold).total
+        return total, oversold, counted - total
+
+    def report(self, mode: str, results: List[CheckoutResult], duration: float) -> dict:
+        statuses = Counter(status_code for status_code, __, __ in results)
+        durations = [ result[1] for result in results ]
+        queries = [ result[2] for result in results ]
+        sold, oversold, drift = self.get_oversold()
+        return {
+            'mode': mode,
+            'buyers': len(results),
+            'stock': self.stock * self.n_items,
+            'duration': duration,
+            'checkouts_per_sec': len(results) / duration if duration else None,
+            'statuses': dict(statuses),
+            'successes': statuses[200],
+            'orders': Order.objects.filter(sale=self.sale).count(),
+            'p50': 1000 * percentile(durations, 50) if durations else None,
+            'p95': 1000 * percentile(durations, 95) if durations else None,
+            'max': 1000 * max(durations) if durations else None,
+            'queries_mean': sum(queries) / len(queries) if queries else None,
+            'queries_max': max(queries) if queries else None,
+            'sold': sold,
+            'oversold': oversold,
+            'counter_drift': drift,
+        }
@@ -1,13 +1,21 @@
+from threading import Lock
+from typing import Dict
+
 from django.conf import settings
 
 from payment.services.base import AbstractPaymentService
 from payment.services.payutc import PayutcService
 # from sales.models import Order
 
+# Payment services shared by all the threads of the process
+_pay_services: Dict[str, AbstractPaymentService] = {}
+_pay_services_lock = Lock()
+
 
 def get_pay_service(*args, **kwargs) -> AbstractPaymentService:
     """
-    Instanciate the requested payment service
+    Get the requested payment service, shared within the process
+    so that its authenticated session is reused between requests
     """
     # TODO Select pay service
     # if request is not None:
@@ -15,5 +23,8 @@ def get_pay_service(*args, **kwargs) -> AbstractPaymentService:
     if settings.TEST_MODE:
         from payment.services.fake import FakePaymentService
         return FakePaymentService()
-    else:
-        return PayutcService()
+
+    with _pay_services_lock:
+        if 'payutc' not in _pay_services:
+            _pay_services['payutc'] = PayutcService()
+        return _pay_services['payutc']
@@ -0,0 +1,105 @@
+from json import dumps
+
+from django.db import connection
+from django.test.utils import (
+    setup_test_environment, teardown_test_environment, override_settings,
+)
+from django.core.management.base import BaseCommand, CommandError
+
+from payment.benchmarks import CheckoutBenchmark, MODES
+
+
+class Command(BaseCommand):
+    """
+    Benchmark concurrent checkouts on a single sale
+    in a throwaway test database, with the fake payment service
+
+    Usage:
+        python manage.py benchmark_checkout --help
+    """
+
+    help = "Measure checkout throughput, latency, queries and oversell under concurrency."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-b', '--buyers',
+                            type=int,
+                            default=50,
+                            help="Number of concurrent buyers")
+        parser.add_argument('-i', '--items',
+                            type=int,
+                            default=1,
+                            help="Number of items in the sale")
+        parser.add_argument('-s', '--stock',
+                            type=int,
+                            default=10,
+                            help="Quantity of each item")
+        parser.add_argument('-q', '--quantity',
+                            type=int,
+                            default=1,
+                            help="Quantity checked out by each buyer")
+        parser.add_argument('--sale-quantity',
+                            type=int,
+                            default=None,
+                            help="Max quantity of items of the whole sale")
+        parser.add_argument('-m', '--mode',
+                            choices=MODES,
+                            default='threads',
+                            help="Run buyers in threads or in separate processes")
+        parser.add_argument('-w', '--workers',
+                            type=int,
+                            default=None,
+                            help="Number of concurrent workers (default: one per buyer)")
+        parser.add_argument('--seed',
+                            default=None,
+                            help="Seed of the items picked by the buyers")
+        parser.add_argument('--json',
+                            action='store_true',
+                            default=False,
+                            help="Output the report as JSON")
+
+    def write_report(self, report: dict) -> None:
+        self.stdout.write(
+            f"{report['buyers']} buyers ({report['mode']}) for {report['stock']} items "
+            f"in {report['duration']:.2f}s: "
+            f"{report['checkouts_per_sec']:.1f} checkouts/s")
+        self.stdout.write(
+            f"Latency: p50 {report['p50']:.1f}ms, p95 {report['p95']:.1f}ms, "
+            f"max {report['max']:.1f}ms")
+        self.stdout.write(
+            f"Queries per checkout: {report['queries_mean']:.1f} on average, "
+            f"{report['queries_max']} max")
+        statuses = ', '.join(
+            f"{count} x {status}" for status, count in sorted(report['statuses'].items())
+        )
+        self.stdout.write(f"Responses: {statuses}")
+        self.stdout.write(f"Sold {report['sold']}, oversold {report['oversold']}, "
+                          f"counter drift {report['counter_drift']}")
+
+    def handle(self, buyers: int, items: int, stock: int, quantity: int,
+               sale_quantity: int, mode: str, workers: int, seed: str, json: bool,
+               **options) -> str:
+        if buyers < 1 or items < 1:
+            raise CommandError("There must be at least one buyer and one item")
+
+        verbosity = options['verbosity']
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=verbosity,
+                                                      autoclobber=True)
+        try:
+            with override_settings(TEST_MODE=True, SECURE_SSL_REDIRECT=False):
+                benchmark = CheckoutBenchmark(buyers=buyers, items=items, stock=stock,
+                                              quantity=quantity,
+                                              sale_quantity=sale_quantity, seed=seed)
+                benchmark.setup()
+                report = benchmark.run(mode, workers)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+            teardown_test_environment()
+
+        if json:
+            self.stdout.write(dumps(report, indent=2))
+        else:
+            self.write_report(report)
+        if report['oversold']:
+            raise CommandError(f"Oversold {report['oversold']} items")
+        return None
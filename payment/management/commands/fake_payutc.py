@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand
+
+from payment.services.payutc_server import FakePayutcServer, FakePayutcState
+
+
+class Command(BaseCommand):
+    """
+    Run a local stand-in for the Payutc services,
+    to use with PAYUTC_BASE_URL=http://<host>:<port> in the environment
+
+    Usage:
+        python manage.py fake_payutc --help
+    """
+
+    help = "Run a local Payutc stand-in with latency and failure injection."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--host',
+                            default='127.0.0.1',
+                            help="Host to listen on")
+        parser.add_argument('-p', '--port',
+                            type=int,
+                            default=8001,
+                            help="Port to listen on")
+        parser.add_argument('-l', '--latency',
+                            type=float,
+                            default=0,
+                            help="Seconds added to each request")
+        parser.add_argument('-j', '--jitter',
+                            type=float,
+                            default=0,
+                            help="Max random seconds added to the latency")
+        parser.add_argument('-e', '--error-rate',
+                            type=float,
+                            default=0,
+                            help="Rate of requests failing with the error status")
+        parser.add_argument('--error-status',
+                            type=int,
+                            default=503,
+                            help="Status code of the failing requests")
+        parser.add_argument('--pay-after',
+                            type=float,
+                            default=None,
+                            help="Seconds after which transactions are paid "
+                                 "automatically")
+        parser.add_argument('--abort-rate',
+                            type=float,
+                            default=0,
+                            help="Rate of automatic payments aborted instead")
+        parser.add_argument('--session-ttl',
+                            type=float,
+                            default=None,
+                            help="Seconds after which sessions are rejected")
+        parser.add_argument('--notify',
+                            action='store_true',
+                            default=False,
+                            help="Request the callback url of transactions once paid")
+        parser.add_argument('--seed',
+                            default=None,
+                            help="Seed of the random latencies and failures")
+
+    def handle(self, host: str, port: int, latency: float, jitter: float,
+               error_rate: float, error_status: int, pay_after: float, abort_rate: float,
+               session_ttl: float, notify: bool, seed: str, **options) -> str:
+        state = FakePayutcState(pay_after=pay_after, abort_rate=abort_rate,
+                                session_ttl=session_ttl, notify=notify, seed=seed)
+        server = FakePayutcServer((host, port), latency=latency, jitter=jitter,
+                                  error_rate=error_rate, error_status=error_status,
+                                  state=state, seed=seed,
+                                  verbose=options['verbosity'] > 1)
+        self.stdout.write(f"Payutc stand-in listening on {server.base_url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return "Stopped the Payutc stand-in"
@@ -0,0 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple
+from collections import Counter
+import csv
+import os
+
+from django.conf import settings
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from core.exceptions import APIException
+from core.helpers import RateLimiter
+from sales.models import Order, OrderStatus
+from payment.helpers import get_pay_service
+
+
+REPORT_FIELDS = (
+    'order_id', 'sale', 'owner', 'tra_id', 'old_status',
+    'fetched_status', 'status', 'updated', 'tickets_generated', 'error',
+)
+
+
+class Command(BaseCommand):
+    """
+    Fetch the transaction status of all orders awaiting payment
+    in parallel and update them accordingly
+
+    Usage:
+        python manage.py reconcile_orders --help
+    """
+
+    help = "Reconcile the orders awaiting payment with the payment service."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('sales',
+                            nargs='*',
+                            help="Ids of the sales to reconcile, all by default")
+        parser.add_argument('-w', '--workers',
+                            type=int,
+                            default=8,
+                            help="Number of concurrent requests to the payment service")
+        parser.add_argument('-r', '--rate',
+                            type=float,
+                            default=10,
+                            help="Max number of requests per second and per fundation")
+        parser.add_argument('-o', '--output',
+                            default=None,
+                            help="Path of the CSV report "
+                                 "(default: in the exports directory)")
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            default=False,
+                            help="Only fetch statuses, do not update the orders")
+
+    def fetch_status(self, order: Order, limiter: RateLimiter) -> Tuple[OrderStatus, str]:
+        """
+        Fetch the transaction status of an order, run in a worker thread
+        """
+        limiter.wait()
+        try:
+            status = get_pay_service(order).get_transaction_status(order)
+        except APIException as error:
+            return None, str(error.detail)
+        if status is None:
+            return None, "Unknown transaction status"
+        return status, None
+
+    def apply_status(self, order: Order, status: OrderStatus, error: str,
+                     dry_run: bool) -> dict:
+        """
+        Update the order with its fetched status and build its report row
+        """
+        row = {
+            'order_id': order.pk,
+            'sale': order.sale_id,
+            'owner': order.owner.email,
+            'tra_id': order.tra_id,
+            'old_status': order.get_status_display(),
+            'fetched_status': status.name if status else None,
+            'status': order.get_status_display(),
+            'updated': False,
+            'tickets_generated': False,
+            'error': error,
+        }
+        if status is None or dry_run:
+            return row
+
+        try:
+            resp = order.update_status(status)
+        except APIException as error:
+            row['error'] = str(error.detail)
+            return row
+
+        row.update(
+            status=resp['status'],
+            updated=resp['updated'],
+            tickets_generated=resp['tickets_generated'],
+        )
+        return row
+
+    def write_report(self, rows: List[dict], path: str) -> None:
+        with open(path, 'w', newline='') as report:
+            writer = csv.DictWriter(report, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def handle(self, sales: List[str], workers: int=8, rate: float=10,
+               output: str=None, dry_run: bool=False, **options) -> str:
+        orders = Order.objects.filter(status=OrderStatus.AWAITING_PAYMENT.value) \
+                              .select_related('sale__association', 'owner')
+        if sales:
+            orders = orders.filter(sale__in=sales)
+        orders = list(orders)
+
+        # One limiter per fundation as Payutc limits per fundation
+        limiters = {
+            fun_id: RateLimiter(rate)
+            for fun_id in { order.sale.association.fun_id for order in orders }
+        }
+
+        # Fetch statuses concurrently but update orders in the main thread
+        rows = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self.fetch_status, order,
+                                limiters[order.sale.association.fun_id]): order
+                for order in orders
+            }
+            for future in as_completed(futures):
+                status, error = future.result()
+                rows.append(self.apply_status(futures[future], status, error, dry_run))
+
+        if output is None:
+            date = timezone.now().strftime('%Y-%m-%d_%H-%M-%S')
+            output = os.path.join(settings.EXPORTS_DIR, f"reconcile_orders_{date}.csv")
+        rows.sort(key=lambda row: row['order_id'])
+        self.write_report(rows, output)
+
+        counts = Counter(row['status'] for row in rows)
+        n_errors = sum(1 for row in rows if row['error'])
+        summary = ', '.join(f"{count} {status}" for status, count in counts.items())
+        return (f"Reconciled {len(rows)} orders ({summary or 'none'}) "
+                f"with {n_errors} errors, report written to {output}")
@@ -1,6 +1,9 @@
+from threading import Lock
+from typing import Any
 import logging
 
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework import status
 
 from sales.models import Sale, Order, OrderStatus, Item
@@ -10,6 +13,9 @@ from .payutc_client import PayutcClient, PayutcException as PayutcClientExceptio
 
 logger = logging.getLogger(f"woolly.{__name__}")
 
+# Status codes of responses rejecting the session
+SESSION_REJECTED_STATUS = { 401, 403 }
+
 PAYUTC_TO_ORDER_STATUS = {
     'A': OrderStatus.EXPIRED,
     'V': OrderStatus.PAID,
@@ -25,39 +31,87 @@ class PayutcException(TransactionException):
 
 
 class PayutcService(AbstractPaymentService):
+    """
+    Payment service for Payutc, meant to be shared between threads
+    so that its client stays logged in and keeps its connections alive
+    """
 
     def __init__(self, login: bool=False):
         super().__init__()
         self.client = PayutcClient(settings.PAYUTC)
+        self._login_lock = Lock()
+        if login:
+            self._check_login()
+
+    def _check_login(self, rejected_session: str=None) -> None:
+        """
+        Check that the client is logged to the app,
+        log in again if the current session is the rejected one
 
-    def _check_login(self) -> None:
-        """Check that the client is logged to the app"""
-        if not self.client.is_authenticated:
-            self.client.login_app()
-            self.client.login_user()
+        The login is done on a copy of the client whose config is then swapped in
+        at once, so that concurrent calls keep sending the old session until then
+        """
+        with self._login_lock:
+            session_id = self.client.config['session_id']
+            if session_id and session_id != rejected_session:
+                return
+
+            login_client = self.client.copy(session_id=None)
+            login_client.login_app()
+            login_client.login_user()
+            self.client.config = login_client.config
             logger.info("Logged in Payutc services")
 
-    def _get_category_id(self, sale: Sale) -> int:
+    def _call(self, method: str, *args, **kwargs) -> Any:
+        """
+        Call a method of the logged in client,
+        log in again and retry once if Payutc rejects the session
+        """
+        self._check_login()
+        session_id = self.client.config['session_id']
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except PayutcClientException as error:
+            status_code = getattr(error.response, 'status_code', None)
+            if status_code not in SESSION_REJECTED_STATUS:
+                raise
+            logger.info("Payutc session rejected, logging in again")
+
+        self._check_login(rejected_session=session_id)
+        return getattr(self.client, method)(*args, **kwargs)
+
+    def _get_category_id(self, sale: Sale, refresh: bool=False) -> int:
+        """
+        Get the id of the category of the sale, cached until refreshed
+        """
+        cache_key = f"payutc_category_{sale.association_id}_{sale.id}"
+        if not refresh:
+            category_id = cache.get(cache_key)
+            if category_id is not None:
+                return category_id
+
         data = {
             "name": f"Woolly - {sale.id}",
             "fundation": sale.association.fun_id,
         }
         try:
             try:
-                return self.client.get_categories(data)[0]["id"]
+                category_id = self._call('get_categories', data)[0]["id"]
             except IndexError:
                 logger.info(f"Creating category {data['name']} on fundation {data['fundation']}")
                 data["fun_id"] = data.pop("fundation")
-                return self.client.upsert_category(data)
+                category_id = self._call('upsert_category', data)
         except PayutcClientException as error:
             message = "Erreur lors de la mise à jour la catégorie"
             raise PayutcException(message, code="category_creation_error") from error
 
+        cache.set(cache_key, category_id, timeout=None)
+        return category_id
+
     def synch_item(self, item: Item, **kwargs) -> None:
         """
         Adapter to synchronize an item in the payment service
         """
-        self._check_login()
         sale = item.sale
         data = {
             "name": item.name,
@@ -71,7 +125,15 @@ class PayutcService(AbstractPaymentService):
         action = "Updating" if item.pk else "Creating"
         logger.info(f"{action} item {data['name']} on fundation {data['fun_id']}")
         try:
-            item.nemopay_id = self.client.upsert_product(data, id=item.nemopay_id)
+            try:
+                item.nemopay_id = self._call('upsert_product', data, id=item.nemopay_id)
+            except PayutcClientException:
+                # The cached category may not exist anymore, retry with a fresh one
+                category_id = self._get_category_id(sale, refresh=True)
+                if category_id == data["parent"]:
+                    raise
+                data["parent"] = category_id
+                item.nemopay_id = self._call('upsert_product', data, id=item.nemopay_id)
         except PayutcClientException as error:
             message = "Erreur lors de la mise à jour l'article"
             raise PayutcException(message, code="item_synch_error") from error
@@ -84,7 +146,7 @@ class PayutcService(AbstractPaymentService):
         itemsArray = [ [int(orderline.item.nemopay_id), orderline.quantity] for orderline in orderlines ]
 
         try:
-            return self.client.create_transaction({
+            return self._call('create_transaction', {
                 'fun_id': int(order.sale.association.fun_id),
                 'items': str(itemsArray),
                 'mail': order.owner.email,
@@ -100,7 +162,7 @@ class PayutcService(AbstractPaymentService):
         Adapter to get transaction status from an order
         """
         try:
-            trans = self.client.get_transaction({
+            trans = self._call('get_transaction', {
                 'tra_id': int(order.tra_id),
                 'fun_id': int(order.sale.association.fun_id),
             })
@@ -1,6 +1,11 @@
 from functools import partial
-import requests
 from typing import Any
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core.metrics import timed
 
 
 ALLOWED_ACTIONS_MAP = {
@@ -13,6 +18,7 @@ ALLOWED_ACTIONS_MAP = {
 
 BASE_CONFIG = {
     'base_url': 'https://api.nemopay.net',
+    'payment_url': 'https://payutc.nemopay.net/validation',
     'nemopay_version': '2018-07-03',
     'system_id': '80405',
     'fun_id': None,
@@ -29,7 +35,23 @@ BASE_CONFIG = {
     'password': None,
     'cas_ticket': None,
     'cas_service': None,
+
+    # HTTP connections
+    'timeout': (3.05, 20),      # (connect, read) in seconds
+    'pool_connections': 4,      # Number of hosts to keep pools for
+    'pool_maxsize': 10,         # Number of connections kept alive per host
+    'max_retries': 2,           # Retries of idempotent requests
+    'retry_backoff': 0.3,       # Seconds, doubled at each retry
+}
+
+# Services that can safely be requested multiple times
+IDEMPOTENT_SERVICES = {
+    'MYACCOUNT/getUserDetails',
+    'WEBSALE/getTransactionInfo',
+    'POSS3/loginApp',
+    'SELFPOS/login2',
 }
+RETRY_STATUS_CODES = { 502, 503, 504 }
 
 
 def filter_dict_by_keys(dico: dict, *keys: tuple) -> dict:
@@ -45,7 +67,7 @@ class PayutcException(Exception):
                  response: requests.Response=None,
                  config: dict=None,
                  data: dict=None):
-        if response.text:
+        if getattr(response, 'text', None):
             message += f"\nResponse: {response.text}"
         super().__init__(message)
         self.response = response
@@ -79,6 +101,43 @@ class PayutcClient:
             **config,
             **kwargs,
         }
+        self.session = self._create_session()
+
+    def _create_session(self) -> requests.Session:
+        """
+        Create a session keeping connections alive in a pool,
+        retries are handled in request to only retry idempotent calls
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.config['pool_connections'],
+                              pool_maxsize=self.config['pool_maxsize'],
+                              max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def copy(self, **config) -> 'PayutcClient':
+        """
+        Copy the client with some config changed, sharing its pooled connections
+        """
+        client = type(self).__new__(type(self))
+        client.config = { **self.config, **config }
+        client.session = self.session
+        return client
+
+    def close(self) -> None:
+        """
+        Close the pooled connections
+        """
+        self.session.close()
+
+    def is_idempotent(self, method: str, uri: str, api: str='resources') -> bool:
+        """
+        Whether a request can safely be sent again on failure
+        """
+        if api == 'services':
+            return uri in IDEMPOTENT_SERVICES
+        return method in ('get', 'head', 'options', 'put', 'delete')
 
     def request(self, method: str, uri: str, data: dict={}, api: str='resources', **kwargs) -> Any:
         """
@@ -91,6 +150,7 @@ class PayutcClient:
             data:   the data to sent in the request (default: {})
             api:    the API to request (default: 'resources')
             return_response: If true, return the response no matter what the status (default: False)
+            idempotent: Whether the request can be retried (default: guessed from the uri)
 
         Returns:
             Response or data
@@ -98,18 +158,21 @@ class PayutcClient:
         Raises:
             PayutcException: in case something goes wrong raise a PayutcException
         """
+        # Config is read once, it may be swapped by another thread logging in
+        config = self.config
+
         # Build url
         assert api in {'services', 'resources'}
-        url = f"{self.config['base_url']}/{api}/{uri}"
+        url = f"{config['base_url']}/{api}/{uri}"
         if 'id' in kwargs:
             url += f"/{kwargs['id']}"
 
         request_config = {
-            'params': filter_dict_by_keys(self.config, 'app_key', 'system_id'),
-            'cookies': { 'sessionid': self.config.get('session_id') },
+            'params': filter_dict_by_keys(config, 'app_key', 'system_id'),
+            'cookies': { 'sessionid': config.get('session_id') },
             'headers': {
                 'Content-Type': 'application/json',
-                'nemopay-version': self.config.get('nemopay_version'),
+                'nemopay-version': config.get('nemopay_version'),
             },
         }
 
@@ -118,17 +181,40 @@ class PayutcClient:
         else:
             request_config['json'] = data
 
-        # Make the request
-        response = requests.request(method, url, **request_config)
-
-        if kwargs.get('return_response', False):
-            return response
-
-        if response.ok:
-            return response.json()
-
-        message = f"Error {response.status_code} on {method.upper()} {api}/{uri}"
-        raise PayutcException(message, response, request_config, data)
+        # Make the request, timed per endpoint
+        with timed(f"payutc.{method} {api}/{uri}"):
+            # Retry idempotent ones on connection or gateway errors
+            idempotent = kwargs.get('idempotent', self.is_idempotent(method, uri, api))
+            retries = config['max_retries']
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(config['retry_backoff'] * 2 ** (attempt - 1))
+                try:
+                    response = self.session.request(method, url,
+                                                    timeout=config['timeout'],
+                                                    **request_config)
+                except (requests.ConnectionError, requests.Timeout) as error:
+                    # Requests that could not connect never reached the server
+                    can_retry = idempotent or isinstance(error, requests.ConnectTimeout)
+                    if attempt >= retries or not can_retry:
+                        message = (f"{type(error).__name__} "
+                                   f"on {method.upper()} {api}/{uri}")
+                        raise PayutcException(message, None, request_config,
+                                              data) from error
+                    continue
+
+                should_retry = idempotent and response.status_code in RETRY_STATUS_CODES
+                if not should_retry or attempt >= retries:
+                    break
+
+            if kwargs.get('return_response', False):
+                return response
+
+            if response.ok:
+                return response.json()
+
+            message = f"Error {response.status_code} on {method.upper()} {api}/{uri}"
+            raise PayutcException(message, response, request_config, data)
 
     def list_routes(self):
         """
@@ -187,8 +273,12 @@ class PayutcClient:
     def _login(self, response: dict) -> dict:
         if type(response) is not dict or not response.get('sessionid'):
             raise PayutcException('Login failed', response)
-        self.config['session_id'] = response.get('sessionid')
-        self.config['username'] = response.get('username')
+        # Swapped at once so that concurrent requests never read a partial login
+        self.config = {
+            **self.config,
+            'session_id': response.get('sessionid'),
+            'username': response.get('username'),
+        }
         return response
 
     def login(self, method: str, **kwargs):
@@ -254,7 +344,7 @@ class PayutcClient:
         return self.request('post', 'WEBSALE/getTransactionInfo', data, api='services')
 
     def get_payment_url(self, tra_id: int) -> str:
-        return f"https://payutc.nemopay.net/validation?tra_id={tra_id}"
+        return f"{self.config['payment_url']}?tra_id={tra_id}"
 
     def upsert_category(self, data: dict, id: int=None) -> int:
         if id is not None:
@@ -0,0 +1,290 @@
+"""
+Local stand-in for the Payutc/Nemopay services used by PayutcClient,
+with configurable latency, failures and transaction state transitions
+
+Usage:
+    python manage.py fake_payutc --help
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+from urllib.request import urlopen
+from threading import Lock, Thread
+from typing import Any, Dict, Tuple
+from itertools import count
+import random
+import json
+import time
+import uuid
+
+
+class FakePayutcState:
+    """
+    Thread-safe state of the stand-in: sessions, categories, products and transactions
+
+    Transactions start waiting ('W'), then are validated ('V') or aborted ('A')
+    either on the validation page or automatically after `pay_after` seconds,
+    aborted transactions being picked at `abort_rate`.
+    """
+
+    def __init__(self, pay_after: float=None, abort_rate: float=0,
+                 session_ttl: float=None, notify: bool=False, seed: Any=None):
+        self.pay_after = pay_after
+        self.abort_rate = abort_rate
+        self.session_ttl = session_ttl
+        self.notify = notify
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.ids = count(1)
+        self.sessions: Dict[str, float] = {}
+        self.categories: Dict[int, dict] = {}
+        self.products: Dict[int, dict] = {}
+        self.transactions: Dict[int, dict] = {}
+
+    # ------------------------------------------------------------
+    #   Sessions
+    # ------------------------------------------------------------
+
+    def open_session(self) -> str:
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = time.monotonic()
+        return session_id
+
+    def is_session_valid(self, session_id: str) -> bool:
+        with self.lock:
+            opened_at = self.sessions.get(session_id)
+        if opened_at is None:
+            return False
+        return self.session_ttl is None or time.monotonic() - opened_at < self.session_ttl
+
+    # ------------------------------------------------------------
+    #   Articles
+    # ------------------------------------------------------------
+
+    def find_categories(self, name: str=None, fundation: str=None) -> list:
+        def matches(category: dict) -> bool:
+            if name is not None and category['name'] != name:
+                return False
+            return fundation is None or str(category['fundation']) == str(fundation)
+
+        with self.lock:
+            return list(filter(matches, self.categories.values()))
+
+    def upsert(self, objects: Dict[int, dict], data: dict) -> int:
+        with self.lock:
+            obj_id = int(data.get('obj_id') or next(self.ids))
+            objects[obj_id] = { **objects.get(obj_id, {}), **data, 'id': obj_id }
+            if 'fun_id' in data:
+                objects[obj_id]['fundation'] = data['fun_id']
+            return obj_id
+
+    # ------------------------------------------------------------
+    #   Transactions
+    # ------------------------------------------------------------
+
+    def create_transaction(self, data: dict) -> dict:
+        with self.lock:
+            tra_id = next(self.ids)
+            self.transactions[tra_id] = {
+                **data,
+                'id': tra_id,
+                'status': 'W',
+                'created_at': time.monotonic(),
+            }
+        return self.transactions[tra_id]
+
+    def get_transaction(self, tra_id: int) -> dict:
+        with self.lock:
+            transaction = self.transactions.get(tra_id)
+        if transaction is None:
+            return None
+
+        # Automatic payment after a while
+        if self.pay_after is not None and transaction['status'] == 'W' \
+           and time.monotonic() - transaction['created_at'] >= self.pay_after:
+            aborted = self.random.random() < self.abort_rate
+            self.set_transaction_status(tra_id, 'A' if aborted else 'V')
+        return transaction
+
+    def set_transaction_status(self, tra_id: int, status: str) -> dict:
+        with self.lock:
+            transaction = self.transactions.get(tra_id)
+            if transaction is None or transaction['status'] != 'W':
+                return transaction
+            transaction['status'] = status
+
+        # Payutc notifies the callback of the transaction
+        if self.notify and transaction.get('callback_url'):
+            Thread(target=self._notify, args=(transaction['callback_url'],),
+                   daemon=True).start()
+        return transaction
+
+    def _notify(self, url: str) -> None:
+        try:
+            urlopen(url, timeout=10).close()
+        except OSError:
+            pass
+
+
+class FakePayutcHandler(BaseHTTPRequestHandler):
+    """
+    Handle the requests of PayutcClient with the state of the server
+    """
+    protocol_version = 'HTTP/1.1'
+    # Do not delay small responses on kept alive connections
+    disable_nagle_algorithm = True
+
+    # Services not requiring a session
+    LOGIN_SERVICES = {
+        'POSS3/loginApp', 'SELFPOS/login2', 'POSS3/loginCas', 'POSS3/loginBadge2',
+    }
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _read_data(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _send(self, status_code: int, data: Any=None, headers: dict=None) -> None:
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _get_session(self) -> str:
+        for cookie in self.headers.get_all('Cookie') or ():
+            for part in cookie.split(';'):
+                key, __, value = part.strip().partition('=')
+                if key == 'sessionid':
+                    return value
+        return None
+
+    def do_GET(self) -> None:
+        self.handle_request('get')
+
+    def do_POST(self) -> None:
+        self.handle_request('post')
+
+    def do_PUT(self) -> None:
+        self.handle_request('put')
+
+    def handle_request(self, method: str) -> None:
+        server = self.server
+        url = urlsplit(self.path)
+        params = { key: values[-1] for key, values in parse_qs(url.query).items() }
+        data = self._read_data()
+
+        # Injected latency and failures
+        delay = server.latency + server.random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if server.random.random() < server.error_rate:
+            error = { 'error': { 'message': "Injected failure" } }
+            return self._send(server.error_status, error)
+
+        path = url.path.strip('/')
+        if path == 'validation':
+            return self.validate_transaction(params)
+
+        api, __, uri = path.partition('/')
+        if api == 'services':
+            if uri not in self.LOGIN_SERVICES:
+                if not server.state.is_session_valid(self._get_session()):
+                    return self._send(403, { 'error': { 'message': "Session invalide" } })
+            return self.handle_service(uri, data)
+        if api == 'resources' and uri == 'categories':
+            categories = server.state.find_categories(params.get('name'),
+                                                      params.get('fundation'))
+            return self._send(200, categories)
+        return self._send(404, { 'error': { 'message': f"Unknown route {url.path}" } })
+
+    def handle_service(self, uri: str, data: dict) -> None:
+        state = self.server.state
+        if uri in self.LOGIN_SERVICES:
+            username = data.get('login') if uri == 'SELFPOS/login2' else None
+            session = { 'sessionid': state.open_session(), 'username': username }
+            return self._send(200, session)
+        if uri == 'MYACCOUNT/getUserDetails':
+            return self._send(200, { 'username': None })
+        if uri == 'GESARTICLE/setCategory':
+            return self._send(200, { 'success': state.upsert(state.categories, data) })
+        if uri == 'GESARTICLE/setProduct':
+            return self._send(200, { 'success': state.upsert(state.products, data) })
+        if uri == 'WEBSALE/createTransaction':
+            transaction = state.create_transaction(data)
+            query = urlencode({ 'tra_id': transaction['id'] })
+            return self._send(200, {
+                'tra_id': transaction['id'],
+                'url': f"{self.server.base_url}/validation?{query}",
+            })
+        if uri == 'WEBSALE/getTransactionInfo':
+            transaction = state.get_transaction(int(data.get('tra_id') or 0))
+            if transaction is None:
+                return self._send(400, { 'error': { 'message': "Transaction inconnue" } })
+            status = { 'id': transaction['id'], 'status': transaction['status'] }
+            return self._send(200, status)
+        return self._send(404, { 'error': { 'message': f"Unknown service {uri}" } })
+
+    def validate_transaction(self, params: dict) -> None:
+        """
+        Payment page: validate or abort the transaction and go back to the return url
+        """
+        try:
+            tra_id = int(params.get('tra_id'))
+        except (TypeError, ValueError):
+            return self._send(400, { 'error': { 'message': "tra_id manquant" } })
+
+        status = 'A' if params.get('status') == 'A' else 'V'
+        transaction = self.server.state.set_transaction_status(tra_id, status)
+        if transaction is None:
+            return self._send(404, { 'error': { 'message': "Transaction inconnue" } })
+        if transaction.get('return_url'):
+            return self._send(302, headers={ 'Location': transaction['return_url'] })
+        return self._send(200, { 'id': tra_id, 'status': transaction['status'] })
+
+
+class FakePayutcServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server standing in for Payutc, each request being delayed
+    by `latency` plus up to `jitter` seconds, and failing at `error_rate`
+    with `error_status`
+
+    Point PayutcClient to it with its `base_url` config
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int]=('127.0.0.1', 0), latency: float=0,
+                 jitter: float=0, error_rate: float=0, error_status: int=503,
+                 state: FakePayutcState=None, seed: Any=None, verbose: bool=False):
+        super().__init__(address, FakePayutcHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.state = state or FakePayutcState(seed=seed)
+        self.random = random.Random(seed)
+        self.verbose = verbose
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> Thread:
+        """
+        Serve in a background thread, stopped with shutdown
+        """
+        thread = Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
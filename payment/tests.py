@@ -1,19 +1,53 @@
 from typing import Sequence
 from collections import Counter
-from threading import Thread
+from itertools import count
+from threading import Thread, Event
+from unittest.mock import patch
+import tempfile
+import time
 import random
+import json
+import csv
+import io
+import os
 
+import requests
+
+from django import db
 from django.utils import timezone
+from django.core.cache import cache
+from django.core.management import call_command
 from django.db import transaction
-from django.test import tag
+from django.test import tag, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APITestCase, APITransactionTestCase
 
 
 from core.faker import FakeModelFactory
+from core.metrics import Histogram, get_histogram, timed
 from core.testcases import get_api_client
 from authentication.models import User, UserType
-from sales.models import Sale, Item, ItemGroup, Order, OrderStatus, OrderLine, OrderLineItem
+from sales.models import (
+    Sale, Item, ItemGroup, Order, OrderStatus, OrderLine, OrderLineItem, StockCounter,
+    Job, POST_PAYMENT_JOBS, AdmissionTicket,
+)
 from payment.validator import OrderValidator
+from payment.services.base import TransactionException
+from payment.services.fake import FakePaymentService
+from payment.benchmarks import CheckoutBenchmark
+from payment.services.payutc_client import PayutcClient, PayutcException
+from payment.services.payutc import PayutcService
+from payment.services.payutc_server import FakePayutcServer
+
+
+def fake_response(status_code: int, data: dict=None) -> requests.Response:
+    """
+    Build a raw HTTP response with JSON data
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(data or {}).encode()
+    return response
 
 
 def start_and_await_jobs(jobs: Sequence[Thread]) -> None:
@@ -278,6 +312,398 @@ class OrderValidatorTestCase(APITestCase):
         self.itemgroup.save()
         self._test_validation(True)
 
+    @tag('quantities')
+    def test_validate_orders(self):
+        """
+        Orders of a sale must be validated in a single pass
+        with the same results as one by one
+        """
+        def validate_orders(orders):
+            with CaptureQueriesContext(db.connection) as context:
+                results = OrderValidator.validate_orders(orders)
+            return results, len(context.captured_queries)
+
+        self.item.quantity = 7
+        self.item.save()
+        orders = [ self.order ]
+        results, num_queries = validate_orders(orders)
+        self.assertEqual(results, { self.order.pk: [] })
+
+        for user in self.users:
+            order, __ = self._create_order(user, self.item,
+                                           status=OrderStatus.AWAITING_PAYMENT.value)
+            orders.append(order)
+
+        results, num_queries_more = validate_orders(orders)
+        self.assertEqual(num_queries_more, num_queries)
+        for order in orders:
+            validator = OrderValidator(order, raise_on_error=False)
+            validator.validate()
+            self.assertEqual(results[order.pk], validator.errors)
+        self.assertTrue(any(results.values()), "Some orders should be invalid")
+        self.assertFalse(all(results.values()), "Some orders should be valid")
+
+        other_sale = self.factory.create(Sale)
+        other_order = self.factory.create(Order, owner=self.user, sale=other_sale)
+        with self.assertRaises(ValueError):
+            OrderValidator.validate_orders(orders + [ other_order ])
+
+    @tag('quantities')
+    def test_stock_counters(self):
+        """
+        Stock counters must follow the orders booking items
+        """
+        def assert_booked(total: int, item: int, group: int):
+            quantity = StockCounter.objects.get_quantity(self.sale, [self.item.pk],
+                                                         [self.itemgroup.pk])
+            self.assertEqual(quantity.total, total)
+            self.assertEqual(quantity.per_item.get(self.item.pk, 0), item)
+            self.assertEqual(quantity.per_group.get(self.itemgroup.pk, 0), group)
+
+        # Ongoing orders don't book items
+        assert_booked(0, 0, 0)
+
+        self.order.status = OrderStatus.AWAITING_PAYMENT.value
+        self.order.save()
+        assert_booked(2, 2, 2)
+
+        self.orderline.quantity = 5
+        self.orderline.save()
+        other_orderline = self.factory.create(OrderLine, item=self.items[1],
+                                              order=self.order, quantity=1)
+        assert_booked(6, 5, 6)
+
+        # Moving an item to another group moves its quantity
+        self.item.group = None
+        self.item.save()
+        assert_booked(6, 5, 1)
+        self.item.group = self.itemgroup
+        self.item.save()
+
+        other_orderline.delete()
+        assert_booked(5, 5, 5)
+
+        self.order.status = OrderStatus.PAID.value
+        self.order.save()
+        assert_booked(5, 5, 5)
+
+        # Rebuilding the counters must not change them
+        StockCounter.objects.rebuild()
+        assert_booked(5, 5, 5)
+
+        self.order.status = OrderStatus.CANCELLED.value
+        self.order.save()
+        assert_booked(0, 0, 0)
+
+    @tag('quantities')
+    def test_stock_counters_deletions(self):
+        """
+        Stock counters must follow orderlines deleted in bulk or in cascade
+        and items moved to another sale
+        """
+        def assert_booked(sale: Sale, total: int):
+            self.assertEqual(StockCounter.objects.get_quantity(sale).total, total)
+
+        orders = [
+            self._create_order(user, status=OrderStatus.PAID.value)[0]
+            for user in self.users
+        ]
+        assert_booked(self.sale, 6)
+
+        Order.objects.filter(pk=orders[0].pk).delete()
+        assert_booked(self.sale, 4)
+        self.users[1].delete()
+        assert_booked(self.sale, 2)
+
+        # Moving an item moves the quantity booked by the orders of its old sale
+        other_sale = self.factory.create(Sale)
+        self.item.sale = other_sale
+        self.item.save()
+        assert_booked(self.sale, 2)
+        assert_booked(other_sale, 0)
+
+        self.item.delete()
+        assert_booked(self.sale, 0)
+        StockCounter.objects.rebuild()
+        assert_booked(self.sale, 0)
+
+
+class BaseCheckoutTestCase(APITestCase):
+    """
+    Sale of a few items open to every user, with a helper to check them out
+    """
+    factory = FakeModelFactory()
+    item_quantity = 5
+
+    def get_sale_attributes(self) -> dict:
+        return { 'max_item_quantity': None }
+
+    def setUp(self):
+        self.sale = self.factory.create(Sale, **self.get_sale_attributes())
+        self.usertype = self.factory.create(UserType, validation='True')
+        self.items = [
+            self.factory.create(Item, sale=self.sale, group=None, usertype=self.usertype,
+                                quantity=self.item_quantity, max_per_user=None)
+            for __ in range(3)
+        ]
+        self.item = self.items[0]
+        self.user = self.factory.create(User)
+
+    def checkout(self, orderlines: Sequence[tuple], sale: Sale=None, user: User=None):
+        """
+        Order and pay (item, quantity) orderlines in a single request as the user
+        """
+        sale = sale or self.sale
+        self.client.force_authenticate(user=user or self.user)
+        return self.client.post(f"/sales/{sale.pk}/checkout", {
+            'orderlines': [
+                { 'item': item.pk, 'quantity': quantity } for item, quantity in orderlines
+            ],
+            'return_url': 'http://localhost:3000/orders',
+        }, format='json')
+
+
+@tag('checkout')
+class CheckoutTestCase(BaseCheckoutTestCase):
+
+    def test_checkout(self):
+        """
+        Ordering and paying must happen in a single request
+        """
+        # Previous ongoing order is reused
+        order = self.factory.create(Order, owner=self.user, sale=self.sale,
+                                    status=OrderStatus.ONGOING.value)
+        self.factory.create(OrderLine, order=order, item=self.items[2], quantity=1)
+
+        resp = self.checkout([
+            (self.items[0], 2), (self.items[1], 1), (self.items[2], 0),
+        ])
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(resp.data['status'], OrderStatus.AWAITING_PAYMENT.name)
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, OrderStatus.AWAITING_PAYMENT.value)
+        self.assertEqual(resp.data['redirect_url'].split('/', 2)[1], str(order.pk))
+        quantities = dict(order.orderlines.values_list('item_id', 'quantity'))
+        self.assertEqual(quantities, { self.items[0].pk: 2, self.items[1].pk: 1 })
+        self.assertEqual(self.items[0].quantity_sold(), 2)
+
+    def test_checkout_replaces_cart(self):
+        """
+        The checked out orderlines must replace those of the ongoing order
+        """
+        order = self.factory.create(Order, owner=self.user, sale=self.sale,
+                                    status=OrderStatus.ONGOING.value)
+        self.factory.create(OrderLine, order=order, item=self.items[1], quantity=3)
+
+        resp = self.checkout([ (self.items[0], 1) ])
+        self.assertEqual(resp.status_code, 200, resp.data)
+        order.refresh_from_db()
+        self.assertEqual(order.status, OrderStatus.AWAITING_PAYMENT.value)
+        quantities = dict(order.orderlines.values_list('item_id', 'quantity'))
+        self.assertEqual(quantities, { self.items[0].pk: 1 })
+        self.assertEqual(self.items[0].quantity_sold(), 1)
+        self.assertEqual(self.items[1].quantity_sold(), 0)
+
+    def test_invalid_checkout(self):
+        """
+        Invalid checkouts must not leave any order nor orderline
+        """
+        other_item = self.factory.create(Item, sale=self.factory.create(Sale))
+        invalid_orderlines = {
+            400: [ (self.items[0], 1), (other_item, 1) ],
+            406: [ (self.items[0], self.items[0].quantity + 1) ],
+        }
+        for status_code, orderlines in invalid_orderlines.items():
+            resp = self.checkout(orderlines)
+            self.assertEqual(resp.status_code, status_code, resp.data)
+
+        resp = self.checkout([ (self.items[0], -1) ])
+        self.assertEqual(resp.status_code, 400, resp.data)
+        resp = self.client.post(f"/sales/{self.sale.pk}/checkout", {
+            'orderlines': [ { 'item': [ self.items[0].pk ], 'quantity': 1 } ],
+            'return_url': 'http://localhost:3000/orders',
+        }, format='json')
+        self.assertEqual(resp.status_code, 400, resp.data)
+        self.assertEqual(resp.data['code'], 'invalid_orderlines')
+        self.assertFalse(Order.objects.filter(owner=self.user).exists())
+        self.assertFalse(OrderLine.objects.exists())
+
+    def test_failed_transaction(self):
+        """
+        The items must be booked before the transaction is created
+        and released if it fails
+        """
+        def create_transaction(order, *args, **kwargs):
+            self.assertEqual(self.item.quantity_sold(), 2)
+            raise TransactionException("Payment service unavailable", 'transaction_error')
+
+        with patch.object(FakePaymentService, 'create_transaction', create_transaction):
+            resp = self.checkout([ (self.item, 2) ])
+        self.assertEqual(resp.status_code, 500, resp.data)
+        order = Order.objects.get(owner=self.user)
+        self.assertEqual(order.status, OrderStatus.ONGOING.value)
+        self.assertIsNone(order.tra_id)
+        self.assertEqual(self.item.quantity_sold(), 0)
+
+
+@tag('benchmark')
+class CheckoutBenchmarkTestCase(APITransactionTestCase):
+
+    def test_no_oversell(self):
+        """
+        Concurrent buyers must never get more than the stock,
+        in threads as in separate processes
+        """
+        for mode in ('threads', 'processes'):
+            with self.subTest(mode=mode):
+                benchmark = CheckoutBenchmark(buyers=8, items=1, stock=4, quantity=1)
+                benchmark.setup()
+                report = benchmark.run(mode, workers=4)
+                self.assertEqual(report['buyers'], 8)
+                self.assertEqual(report['successes'], 4, report['statuses'])
+                self.assertEqual(report['sold'], 4)
+                self.assertEqual(report['oversold'], 0)
+                self.assertEqual(report['counter_drift'], 0)
+                self.assertGreater(report['queries_mean'], 0)
+                self.assertLessEqual(report['p50'], report['p95'])
+
+
+@tag('metrics')
+class MetricsTestCase(BaseCheckoutTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = self.factory.create(User, is_admin=True)
+
+    def test_histogram(self):
+        """
+        Histograms must count durations, percentiles and errors
+        """
+        histogram = Histogram('test')
+        for duration in range(1, 101):
+            error_code = 'timeout' if duration > 98 else None
+            histogram.record(duration / 1000, error_code=error_code)
+        stats = histogram.snapshot()
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual(stats['errors'], { 'timeout': 2 })
+        self.assertAlmostEqual(stats['mean'], 50.5)
+        self.assertEqual(stats['max'], 100)
+        for percent in (50, 95, 99):
+            self.assertTrue(percent <= stats[f"p{percent}"] <= percent * 1.2, stats)
+
+        with self.assertRaises(ValueError):
+            with timed('test.error'):
+                raise ValueError()
+        self.assertEqual(get_histogram('test.error').snapshot()['errors'],
+                         { 'ValueError': 1 })
+
+    def test_metrics_endpoint(self):
+        """
+        Checkout latencies must be exposed to admins only
+        """
+        resp = self.checkout([ (self.item, 1) ])
+        self.assertEqual(resp.status_code, 200, resp.data)
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 403)
+
+        self.client.force_authenticate(user=self.admin)
+        resp = self.client.delete('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['view.checkout']['count'], 0)
+
+        self.assertEqual(self.checkout([ (self.item, 2) ]).status_code, 200)
+        self.assertEqual(self.checkout([ (self.item, 100) ]).status_code, 406)
+        self.client.force_authenticate(user=self.admin)
+        metrics = self.client.get('/metrics').data
+        self.assertEqual(metrics['view.checkout']['count'], 2)
+        self.assertEqual(metrics['view.checkout']['errors'], { 'not_enough_items': 1 })
+        for name in ('pay.validate', 'pay.lock_sale', 'pay.book_order',
+                     'pay.create_transaction', 'pay.save_order'):
+            self.assertEqual(metrics[name]['count'], 1, name)
+        self.assertLessEqual(metrics['view.checkout']['p50'],
+                             metrics['view.checkout']['max'])
+
+
+@tag('validation', 'queue')
+class AdmissionQueueTestCase(BaseCheckoutTestCase):
+
+    item_quantity = None
+
+    def get_sale_attributes(self) -> dict:
+        return {
+            **super().get_sale_attributes(),
+            'max_concurrent_checkouts': 2,
+            'begin_at': timezone.now() - timezone.timedelta(hours=1),
+        }
+
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        self.users = [ self.factory.create(User) for __ in range(5) ]
+
+    def poll(self, user: User):
+        self.client.force_authenticate(user=user)
+        return self.client.get(f"/sales/{self.sale.pk}/queue")
+
+    def test_admission_cap(self):
+        """
+        At most max_concurrent_checkouts users must be checking out at once, in order
+        """
+        states = [ self.poll(user).data for user in self.users ]
+        self.assertEqual([ state['admitted'] for state in states ],
+                         [ True, True, False, False, False ])
+        self.assertEqual([ state['position'] for state in states[2:] ], [ 1, 2, 3 ])
+
+        # Polling again keeps the place in the queue
+        self.assertEqual(self.poll(self.users[3]).data['position'], 2)
+
+        # Users not admitted cannot pay nor order
+        resp = self.checkout([ (self.item, 1) ], user=self.users[4])
+        self.assertEqual(resp.status_code, 429, resp.data)
+        self.assertEqual(resp.data['details']['position'], 3)
+        resp = self.client.post('/orders', { 'sale': self.sale.pk }, format='json')
+        self.assertEqual(resp.status_code, 429, resp.data)
+        self.assertFalse(Order.objects.filter(owner=self.users[4]).exists())
+
+        # A finished checkout lets the next user in, and must queue again
+        resp = self.checkout([ (self.item, 1) ], user=self.users[0])
+        self.assertEqual(resp.status_code, 200, resp.data)
+        states = [ self.poll(user).data for user in self.users[2:] ]
+        self.assertEqual([ state['admitted'] for state in states ],
+                         [ True, False, False ])
+        self.assertEqual(self.poll(self.users[0]).data['position'], 3)
+
+        # Expired admissions let the next users in
+        expired_at = timezone.now() - timezone.timedelta(seconds=1)
+        AdmissionTicket.objects.filter(admitted_at__isnull=False) \
+                               .update(expires_at=expired_at)
+        states = [ self.poll(user).data for user in self.users[3:] ]
+        self.assertEqual([ state['admitted'] for state in states ], [ True, True ])
+        self.assertFalse(self.poll(self.users[1]).data['admitted'])
+        admitted = AdmissionTicket.objects.filter(expires_at__gt=timezone.now())
+        self.assertLessEqual(admitted.count(), 2)
+
+    def test_queue_before_opening(self):
+        """
+        Nobody must be admitted before the beginning of the sale
+        """
+        self.sale.begin_at = timezone.now() + timezone.timedelta(minutes=5)
+        self.sale.save()
+        state = self.poll(self.users[0]).data
+        self.assertFalse(state['admitted'])
+        self.assertGreater(state['wait'], 4 * 60)
+
+    def test_queue_disabled(self):
+        """
+        Sales without max_concurrent_checkouts must not have a queue
+        """
+        self.sale.max_concurrent_checkouts = None
+        self.sale.save()
+        self.assertTrue(all(self.poll(user).data['admitted'] for user in self.users))
+        resp = self.checkout([ (self.item, 1) ], user=self.users[4])
+        self.assertEqual(resp.status_code, 200, resp.data)
+
 
 @tag('validation', 'shotgun')
 class ShotgunTestCase(APITransactionTestCase):
@@ -329,7 +755,7 @@ class ShotgunTestCase(APITransactionTestCase):
         """
         with get_api_client(user) as client:
             # Create order
-            order_resp = client.post(f"/sales/{self.sale.id}/orders", {})
+            order_resp = client.post(f"/sales/{item.sale_id}/orders", {})
             msg = f"Order response is not valid ({order_resp.json()})"
             self.assertEqual(order_resp.status_code, 201, msg)
 
@@ -341,11 +767,14 @@ class ShotgunTestCase(APITransactionTestCase):
             msg = f"Order should be ONGOING ({OrderStatus(order['status']).name})"
             self.assertEqual(order['status'], OrderStatus.ONGOING.value, msg)
 
-            # Create orderlines
+            # Create orderlines, items are held so they can fail early
             orderline_resp = client.post(f"/orders/{order_id}/orderlines", {
                 'item': item.id,
                 'quantity': quantity,
             })
+            if orderline_resp.status_code == 406:
+                self.responses.append(orderline_resp)
+                return
             msg = f"Orderline response is not valid ({orderline_resp.json()})"
             self.assertEqual(orderline_resp.status_code, 201, msg)
 
@@ -412,6 +841,42 @@ class ShotgunTestCase(APITransactionTestCase):
         item.save()
         self.start_shotguns(items=[item])
 
+    @tag('lock')
+    def test_sales_are_locked_separately(self):
+        """
+        Test that a checkout is not blocked by a checkout on another sale
+        """
+        other_sale = self.factory.create(Sale, max_item_quantity=None)
+        other_item = self.factory.create(Item, sale=other_sale, usertype=self.usertype,
+                                         quantity=None, max_per_user=None)
+        locked, release = Event(), Event()
+
+        def hold_sale_lock():
+            with transaction.atomic():
+                Sale.objects.select_for_update().get(pk=self.sale.pk)
+                locked.set()
+                release.wait(timeout=10)
+            db.connections.close_all()
+
+        holder = Thread(target=hold_sale_lock)
+        holder.start()
+        locked.wait(timeout=10)
+
+        # Checkout on the other sale while the first one is locked
+        self.responses = []
+        buyer = Thread(target=self.shotgun, args=(self.users[0], other_item))
+        buyer.start()
+        buyer.join(timeout=5)
+        is_blocked = buyer.is_alive()
+
+        release.set()
+        holder.join()
+        buyer.join()
+
+        self.assertFalse(is_blocked, "Checkout was blocked by the lock of another sale")
+        self.assertEqual(len(self.responses), 1)
+        self.assertEqual(self.responses[0].status_code, 200)
+
     # =================================================
     #       Tests tickets generation
     # =================================================
@@ -459,6 +924,367 @@ class ShotgunTestCase(APITransactionTestCase):
         self.assertEqual(kv_acc[('updated', True)], n_orders, "Orders should be updated only once")
         self.assertEqual(kv_acc[('tickets_generated', True)], n_orders, "Tickets should be generated only once")
 
+        # Tickets are generated by the jobs scheduled only once per order
+        self.assertEqual(OrderLineItem.objects.count(), 0,
+                         "Tickets should be generated out of the request")
+        self.assertEqual(Job.objects.count(), len(POST_PAYMENT_JOBS) * n_orders)
+        Job.objects.run_pending(limit=Job.objects.count())
+        self.assertEqual(Job.objects.filter(status='done').count(), Job.objects.count())
+
         # Check OrderLineItems quantity
         n_orderlineitems = OrderLineItem.objects.count()
         self.assertEqual(n_orderlineitems, n_orders, "Wrong number of tickets generated")
+
+    @tag('tickets')
+    def test_concurrent_callbacks_fetch_once(self):
+        """
+        Test that concurrent callbacks of an order fetch its status only once
+        """
+        self.responses = []
+        self.shotgun(self.users[0], self.items[0])
+        order_id = self.responses[0].json()['redirect_url'].split('/', 2)[1]
+        fetched = []
+
+        def fetch_slowly(order):
+            fetched.append(order.pk)
+            time.sleep(0.2)
+            return OrderStatus.PAID
+
+        n_callbacks = 5
+        self.responses = []
+        with patch('payment.services.fake.FakePaymentService.get_transaction_status',
+                   side_effect=fetch_slowly):
+            start_and_await_jobs(
+                Thread(target=self.pay_callback, args=(self.users[0], order_id))
+                for __ in range(n_callbacks)
+            )
+
+        self.assertEqual(len(fetched), 1, "The status should be fetched only once")
+        statuses = [ resp.json()['status'] for resp in self.responses ]
+        self.assertEqual(statuses, [ OrderStatus.PAID.name ] * n_callbacks)
+        updated = [ resp.json()['updated'] for resp in self.responses ]
+        self.assertEqual(updated.count(True), 1, "The order should be updated only once")
+        self.assertEqual(Job.objects.count(), len(POST_PAYMENT_JOBS),
+                         "Jobs should be scheduled only once")
+        Job.objects.run_pending()
+        self.assertEqual(OrderLineItem.objects.count(), 1,
+                         "Tickets should be generated only once")
+
+
+@tag('payutc')
+class PayutcClientTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.client = PayutcClient(base_url='http://payutc.test', retry_backoff=0)
+
+    def _request(self, responses: list, *args, **kwargs):
+        """
+        Helper to request the client with a sequence of responses or errors
+        Return the result or raised exception and the number of requests sent
+        """
+        session = self.client.session
+        with patch.object(session, 'request', side_effect=responses) as request:
+            try:
+                result = self.client.request(*args, **kwargs)
+            except PayutcException as error:
+                result = error
+        return result, request.call_count
+
+    def test_session_is_reused(self):
+        """
+        Requests must be sent through the pooled session with a timeout
+        """
+        with patch.object(self.client.session, 'request',
+                          return_value=fake_response(200, { 'id': 1 })) as request:
+            self.client.request('get', 'categories')
+            self.client.request('get', 'categories')
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(request.call_args[1]['timeout'], self.client.config['timeout'])
+
+    def test_idempotent_requests_are_retried(self):
+        """
+        Idempotent requests must be retried a bounded number of times
+        """
+        uri = 'WEBSALE/getTransactionInfo'
+        responses = [
+            requests.ConnectionError(),
+            fake_response(503),
+            fake_response(200, { 'status': 'V' }),
+        ]
+        result, calls = self._request(responses, 'post', uri, api='services')
+        self.assertEqual(result, { 'status': 'V' })
+        self.assertEqual(calls, 3)
+
+        max_retries = self.client.config['max_retries']
+        responses = [ fake_response(503) ] * (max_retries + 2)
+        result, calls = self._request(responses, 'post', uri, api='services')
+        self.assertIsInstance(result, PayutcException)
+        self.assertEqual(calls, max_retries + 1)
+
+    def test_other_requests_are_not_retried(self):
+        """
+        Other requests must only be retried if they never reached the server
+        """
+        uri = 'WEBSALE/createTransaction'
+        for error in (fake_response(503), requests.ReadTimeout()):
+            responses = [ error, fake_response(200) ]
+            result, calls = self._request(responses, 'post', uri, api='services')
+            self.assertIsInstance(result, PayutcException)
+            self.assertEqual(calls, 1)
+
+        responses = [ requests.ConnectTimeout(), fake_response(200, { 'tra_id': 1 }) ]
+        result, calls = self._request(responses, 'post', uri, api='services')
+        self.assertEqual(result, { 'tra_id': 1 })
+        self.assertEqual(calls, 2)
+
+
+@tag('payutc')
+class PayutcServiceTestCase(APITestCase):
+
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        cache.clear()
+        self.service = PayutcService()
+        self.client = self.service.client
+        self.client.config.update(base_url='http://payutc.test', retry_backoff=0)
+        self.sessions = count()
+        self.rejected = set()
+        self.categories = [ 42 ]
+        self.calls = []
+
+    def fake_payutc(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Fake Payutc API rejecting the sessions in self.rejected
+        """
+        uri = url.split('/', 4)[-1]
+        self.calls.append(uri)
+        if uri in ('POSS3/loginApp', 'SELFPOS/login2'):
+            session_id = f"session{next(self.sessions)}"
+            return fake_response(200, { 'sessionid': session_id, 'username': 'woolly' })
+        if kwargs['cookies']['sessionid'] in self.rejected:
+            return fake_response(403)
+        if uri == 'categories':
+            return fake_response(200, [ { 'id': self.categories[-1] } ])
+        if uri == 'GESARTICLE/setProduct':
+            if kwargs['json']['parent'] != self.categories[-1]:
+                return fake_response(400)
+            return fake_response(200, { 'success': 7 })
+        return fake_response(200, { 'status': 'V' })
+
+    def get_transaction(self) -> dict:
+        with patch.object(self.client.session, 'request', side_effect=self.fake_payutc):
+            return self.service._call('get_transaction', { 'tra_id': 1, 'fun_id': 1 })
+
+    def test_session_is_reused(self):
+        """
+        The service must only log in once and reuse its session
+        """
+        self.get_transaction()
+        self.assertEqual(len(self.calls), 3)
+
+        self.calls = []
+        for __ in range(3):
+            self.assertEqual(self.get_transaction(), { 'status': 'V' })
+        self.assertEqual(self.calls, [ 'WEBSALE/getTransactionInfo' ] * 3)
+
+    def test_relogin_when_session_is_rejected(self):
+        """
+        The service must log in again only when its session is rejected
+        """
+        self.get_transaction()
+        rejected_session = self.client.config['session_id']
+        self.rejected.add(rejected_session)
+
+        self.calls = []
+        self.assertEqual(self.get_transaction(), { 'status': 'V' })
+        self.assertNotEqual(self.client.config['session_id'], rejected_session)
+        self.assertEqual(self.calls, [
+            'WEBSALE/getTransactionInfo', 'POSS3/loginApp', 'SELFPOS/login2',
+            'WEBSALE/getTransactionInfo',
+        ])
+
+    def test_relogin_keeps_session_for_concurrent_calls(self):
+        """
+        Calls made while logging in again must never send an empty or partial session
+        """
+        self.get_transaction()
+        rejected_session = self.client.config['session_id']
+        self.rejected.add(rejected_session)
+
+        # Sessions seen by other threads while each login request is sent
+        seen_sessions = []
+        fake_payutc = self.fake_payutc
+
+        def fake_payutc_spy(method: str, url: str, **kwargs) -> requests.Response:
+            if url.endswith(('POSS3/loginApp', 'SELFPOS/login2')):
+                seen_sessions.append(self.service.client.config['session_id'])
+            return fake_payutc(method, url, **kwargs)
+
+        with patch.object(self.client.session, 'request', side_effect=fake_payutc_spy):
+            self.service._call('get_transaction', { 'tra_id': 1, 'fun_id': 1 })
+        self.assertEqual(seen_sessions, [ rejected_session ] * 2)
+        self.assertNotIn(self.service.client.config['session_id'],
+                         (None, rejected_session))
+
+    def test_category_is_cached(self):
+        """
+        The category of a sale must only be fetched again when an upsert fails
+        """
+        sale = self.factory.create(Sale)
+        items = [ self.factory.create(Item, sale=sale) for __ in range(3) ]
+
+        def synch_items() -> list:
+            self.calls = []
+            session = self.client.session
+            with patch.object(session, 'request', side_effect=self.fake_payutc):
+                for item in items:
+                    self.service.synch_item(item)
+            login_calls = ('POSS3/loginApp', 'SELFPOS/login2')
+            return [ call for call in self.calls if call not in login_calls ]
+
+        self.assertEqual(synch_items(),
+                         [ 'categories' ] + [ 'GESARTICLE/setProduct' ] * 3)
+        self.assertEqual(synch_items(), [ 'GESARTICLE/setProduct' ] * 3)
+
+        # Category deleted and recreated on Payutc
+        self.categories.append(43)
+        self.assertEqual(synch_items(), [
+            'GESARTICLE/setProduct', 'categories', 'GESARTICLE/setProduct',
+            'GESARTICLE/setProduct', 'GESARTICLE/setProduct',
+        ])
+
+
+@tag('payutc')
+class FakePayutcServerTestCase(APITestCase):
+
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        cache.clear()
+        self.server = FakePayutcServer(seed=1)
+        self.server.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings = { 'base_url': self.server.base_url, 'retry_backoff': 0 }
+        with self.settings(PAYUTC=settings):
+            self.service = PayutcService()
+
+    def test_transaction(self):
+        """
+        The real payment path must work against the stand-in
+        """
+        sale = self.factory.create(Sale)
+        item = self.factory.create(Item, sale=sale, nemopay_id=None)
+        self.service.synch_item(item)
+        self.assertIn(item.nemopay_id, self.server.state.products)
+        item.save()
+
+        order = self.factory.create(Order, sale=sale, status=OrderStatus.ONGOING.value)
+        self.factory.create(OrderLine, order=order, item=item, quantity=2)
+        transaction = self.service.create_transaction(order, 'http://localhost/callback',
+                                                      'http://localhost/return')
+        order.tra_id = transaction['tra_id']
+        self.assertEqual(self.service.get_transaction_status(order),
+                         OrderStatus.AWAITING_PAYMENT)
+
+        # Pay on the validation page
+        resp = requests.get(transaction['url'], allow_redirects=False)
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.headers['Location'], 'http://localhost/return')
+        self.assertEqual(self.service.get_transaction_status(order), OrderStatus.PAID)
+
+    def test_injected_failures(self):
+        """
+        Latencies, failures and session expiry must be injected
+        """
+        self.server.latency = 0.05
+        start = time.monotonic()
+        self.service._call('get_user_details')
+        self.assertGreaterEqual(time.monotonic() - start, 3 * 0.05)  # 2 logins and 1 call
+
+        # Idempotent requests are retried before failing
+        self.server.latency = 0
+        self.server.error_rate = 1
+        with self.assertRaises(PayutcException) as context:
+            self.service._call('get_user_details')
+        self.assertEqual(context.exception.response.status_code, 503)
+
+        # Forgotten sessions are renewed
+        self.server.error_rate = 0
+        session_id = self.service.client.config['session_id']
+        self.server.state.sessions.clear()
+        self.service._call('get_user_details')
+        self.assertNotEqual(self.service.client.config['session_id'], session_id)
+
+        # Expired sessions are rejected
+        self.server.state.session_ttl = 0
+        with self.assertRaises(PayutcException) as context:
+            self.service._call('get_user_details')
+        self.assertEqual(context.exception.response.status_code, 403)
+
+    def test_automatic_payment(self):
+        """
+        Transactions must be paid or aborted automatically if configured
+        """
+        self.server.state.pay_after = 0
+        self.server.state.abort_rate = 0.5
+        statuses = Counter()
+        for __ in range(20):
+            tra_id = self.service._call('create_transaction', {
+                'fun_id': 1, 'items': '[[1, 1]]', 'mail': 'a@b.c',
+                'callback_url': 'http://localhost/callback',
+                'return_url': 'http://localhost/return',
+            })['tra_id']
+            transaction = self.service._call('get_transaction',
+                                             { 'tra_id': tra_id, 'fun_id': 1 })
+            statuses[transaction['status']] += 1
+        self.assertEqual(set(statuses), { 'V', 'A' })
+
+
+@tag('reconciliation')
+class ReconcileOrdersTestCase(APITestCase):
+
+    factory = FakeModelFactory()
+
+    def test_reconcile_orders(self):
+        """
+        Orders awaiting payment must be updated and reported
+        """
+        sales = self.factory.create(Sale, 2)
+        awaiting = [
+            self.factory.create(Order, sale=sale, tra_id=i,
+                                status=OrderStatus.AWAITING_PAYMENT.value)
+            for i, sale in enumerate(sales * 3)
+        ]
+        ongoing = self.factory.create(Order, sale=sales[0],
+                                      status=OrderStatus.ONGOING.value)
+        for order in awaiting:
+            self.factory.create(OrderLine, order=order, quantity=2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'report.csv')
+            call_command('reconcile_orders', sales[0].pk, workers=2, output=output,
+                         stdout=io.StringIO())
+            with open(output, newline='') as report:
+                rows = list(csv.DictReader(report))
+
+        reconciled = [ order for order in awaiting if order.sale == sales[0] ]
+        self.assertEqual(sorted(row['order_id'] for row in rows),
+                         sorted(str(order.pk) for order in reconciled))
+        for row in rows:
+            self.assertEqual(row['old_status'], OrderStatus.AWAITING_PAYMENT.name)
+            self.assertEqual(row['status'], OrderStatus.PAID.name)
+            self.assertEqual(row['tickets_generated'], 'True')
+            self.assertEqual(row['error'], '')
+
+        for order in awaiting:
+            order.refresh_from_db()
+            expected = OrderStatus.AWAITING_PAYMENT
+            if order.sale == sales[0]:
+                expected = OrderStatus.PAID
+            self.assertEqual(order.status, expected.value)
+        Job.objects.run_pending(limit=Job.objects.count())
+        self.assertEqual(OrderLineItem.objects.count(), 2 * len(reconciled))
+        ongoing.refresh_from_db()
+        self.assertEqual(ongoing.status, OrderStatus.ONGOING.value)
@@ -6,6 +6,8 @@ from .views import PaymentView
 urlpatterns = [
     path('orders/<int:pk>/pay',    PaymentView.pay,           name='order-pay'),
     path('orders/<int:pk>/status', PaymentView.update_status, name='order-status'),
+    path('sales/<str:pk>/checkout', PaymentView.checkout,     name='sale-checkout'),
+    path('sales/<str:pk>/queue',    PaymentView.queue,        name='sale-queue'),
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
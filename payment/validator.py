@@ -1,172 +1,299 @@
-from typing import List, Sequence
-from collections import namedtuple
-
-from django.utils import timezone
-
-from sales.exceptions import OrderValidationException
-from sales.models import Order, OrderLine, OrderStatus
-
-
-class OrderValidator:
-	"""
-	Object that can validate an order
-	"""
-
-	def __init__(self, order: Order, raise_on_error: bool=True):
-		# TODO : Optimize
-		# self.order = Order.objects.select_related('sale', 'owner') \
-		# 					.prefetch_related('orderlines', 'orderlines__item', 'sale__items', 'owner__orders') \
-		# 					.get(pk=order.pk)
-		# TODO Check if oauth not needed or find oauth in cache
-		self.order = order
-		self.owner = self.order.owner.get_with_api_data()
-		self.sale = self.order.sale
-
-		self.raise_on_error = raise_on_error
-		self.now = timezone.now()
-		self.errors = []
-		self.checked = False
-
-	def validate(self):
-		"""
-		Vérifie la validité d'un order
-		"""
-		self.checked = True
-		self._check_sale()
-		self._check_order()
-		self._check_quantities()
-
-	@property
-	def is_valid(self) -> bool:
-		if not self.checked:
-			raise OrderValidationException(
-				"La commande doit être vérifiée avant d'être validée",
-				'check_order_before_is_valid',
-				status_code=500)
-
-		return len(self.errors) == 0
-
-	def get_errors(self) -> List[str]:
-		return self.errors
-
-	def _add_error(self, message: str, code: str=None):
-		"""
-		Raise or add a new error
-		"""
-		self.errors.append(message)
-		if self.raise_on_error:
-			raise OrderValidationException(message, code)
-
-	# ===============================================
-	# 			Check functions
-	# ===============================================
-
-	def _check_sale(self):
-		"""
-		Check general settings on the sale
-		"""
-		# Check if sale is active
-		if not self.sale.is_active:
-			self._add_error("La vente n'est pas disponible.")
-
-		# Check dates
-		if self.now < self.sale.begin_at:
-			self._add_error("La vente n'a pas encore commencé.")
-		if self.now > self.sale.end_at:
-			self._add_error("La vente est terminée.")
-
-	def _check_order(self):
-		"""
-		Check general settings on the order
-		"""
-		# Check if order is still buyable
-		if self.order.status not in OrderStatus.BUYABLE_STATUS_LIST.value:
-			self._add_error("Votre commande n'est pas payable.")
-
-		# TODO Check if expired
-
-		# Check if no previous ongoing order on the same sale
-		user_prev_ongoing_orders = self.owner.orders.filter(
-			status=OrderStatus.ONGOING.value,
-			sale=self.sale.pk
-		).exclude(pk=self.order.pk)
-		if user_prev_ongoing_orders:
-			self._add_error("Vous avez déjà une commande en cours pour cette vente.")
-
-		# Check if user can buy items
-		for orderline in self.order.orderlines.prefetch_related('item', 'item__usertype').all():
-			if not orderline.item.usertype.check_user(self.owner):
-				self._add_error(f"L'article {orderline.item.name} est réservé à {orderline.item.usertype.name}")
-
-	def _check_quantities(self):
-		"""
-		Fetch, Process and Verify Quantities
-		"""
-		# ======= Part I - Fetch resources
-		# TODO : optimize (orderlinefield.orderlineitem.orderline.order.sale.association)
-
-		# sale_items = self.sale.items.prefetch_related('group').all()
-		order_orderlines = self.order.orderlines.prefetch_related('item').all()
-		# All orders which book items except the one we are processing
-		sale_orderlines = OrderLine.objects \
-							.filter(order__sale__pk=self.sale.pk, order__status__in=OrderStatus.BOOKING_LIST.value) \
-							.exclude(order__pk=self.order.pk) \
-							.prefetch_related('item', 'item__group')
-		# Orders that the user already booked
-		user_orderlines = sale_orderlines.filter(order__owner__pk=self.owner.pk)
-
-		# ======= Part II - Process quantities
-
-		Quantity = namedtuple('Quantity', ['total', 'per_item', 'per_group'])
-
-		def build_quantity(orderlines: Sequence[OrderLine]) -> Quantity:
-			"""
-			Helper to build total, per item and per group quantities
-			"""
-			count, per_item, per_group = 0, {}, {}
-			for orderline in orderlines:
-				count += orderline.quantity
-				per_item[orderline.item] = per_item.get(orderline.item, 0) + orderline.quantity
-				if orderline.item.group:
-					per_group[orderline.item.group] = per_group.get(orderline.item.group, 0) + orderline.quantity
-
-			return Quantity._make([count, per_item, per_group])
-
-		# Quantity per item and Total quantity bought in the order
-		order_qt = build_quantity(order_orderlines)
-		sale_qt  = build_quantity(sale_orderlines)
-		user_qt  = build_quantity(user_orderlines)
-
-		# ======= Part III - Verification
-
-		def is_quantity(quantity) -> bool:
-			return type(quantity) is int and quantity > 0
-
-		# III.1 - Sale level verification
-
-		if order_qt.total <= 0:
-			self._add_error("Vous devez avoir un nombre d'items commandés strictement positif.")
-
-		# Check max item quantity for the sale (ie. enough items left)
-		if is_quantity(self.sale.max_item_quantity) and sale_qt.total + order_qt.total > self.sale.max_item_quantity:
-			self._add_error("Il ne reste pas assez d'articles pour cette vente.")
-
-		# III.2 - Item level verification
-		for item, qt in order_qt.per_item.items():
-			# Check quantity per item
-			if is_quantity(item.quantity) and sale_qt.per_item.get(item, 0) + qt > item.quantity:
-				self._add_error(f"Il ne reste pas assez de {item.name}.")
-
-			# Check max_per_user per item
-			if is_quantity(item.max_per_user) and user_qt.per_item.get(item, 0) + qt > item.max_per_user:
-				self._add_error(f"Vous ne pouvez pas prendre plus de {item.max_per_user} {item.name} par utilisateur.")
-
-		# III.3 - ItemGroup level verification
-		for group, qt in order_qt.per_group.items():
-			# Check quantity per group
-			if is_quantity(group.quantity) and sale_qt.per_group.get(group, 0) + qt > group.quantity:
-				self._add_error(f"Il ne reste pas assez de {group.name}.")
-
-			# Check max_per_user per group
-			if is_quantity(group.max_per_user) and user_qt.per_group.get(group, 0) + qt > group.max_per_user:
-				self._add_error(f"Vous ne pouvez pas prendre plus de {group.max_per_user} {group.name} par utilisateur.")
+from typing import Any, Dict, Iterable, List
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from core.metrics import timed
+
+from authentication.models import User
+from sales.exceptions import OrderValidationException
+from sales.models import (
+    Sale, Order, OrderLine, OrderStatus, StockCounter, StockHold, StockQuantity,
+)
+
+
+class SaleSnapshot:
+    """
+    Data of a sale shared by the validations of some of its orders,
+    fetched once with a constant number of queries whatever the number of orders
+    """
+
+    def __init__(self, sale: Sale, orders: Iterable[Order]):
+        self.sale = sale
+        orders = tuple(orders)
+        order_ids = [ order.pk for order in orders ]
+        owner_ids = { order.owner_id for order in orders }
+
+        # Owners with their full data, all mapped by owner id as string
+        self.owners = {
+            str(user.pk): user.get_with_api_data()
+            for user in User.objects.filter(pk__in=owner_ids)
+        }
+
+        # Orderlines of the orders to validate
+        self.orderlines = defaultdict(list)
+        orderlines = OrderLine.objects.filter(order__in=order_ids) \
+            .select_related('item', 'item__group', 'item__usertype')
+        for orderline in orderlines:
+            self.orderlines[orderline.order_id].append(orderline)
+        self.items = {
+            orderline.item_id: orderline.item
+            for orderlines in self.orderlines.values()
+            for orderline in orderlines
+        }
+        self.groups = {
+            item.group_id: item.group
+            for item in self.items.values()
+            if item.group_id is not None
+        }
+
+        # Quantities booked on the sale
+        self.booked = StockCounter.objects.get_quantity(sale, self.items, self.groups)
+
+        # Quantities held on the sale, and by each order:
+        # { order_id: [ (item_id, group_id, quantity) ] }
+        self.held = StockHold.objects.get_quantity(sale)
+        self.held_by_order = defaultdict(list)
+        order_holds = StockHold.objects.active().filter(order__in=order_ids) \
+            .values_list('order_id', 'item_id', 'item__group_id', 'quantity')
+        for order_id, *row in order_holds:
+            self.held_by_order[order_id].append(row)
+
+        # Quantities booked by each owner:
+        # { owner_id: [ (order_id, item_id, group_id, quantity) ] }
+        self.booked_by_owner = defaultdict(list)
+        user_orderlines = OrderLine.objects \
+            .filter(order__sale__pk=sale.pk) \
+            .filter(order__status__in=OrderStatus.BOOKING_LIST.value) \
+            .filter(order__owner__in=owner_ids) \
+            .values_list('order__owner_id', 'order_id', 'item_id', 'item__group_id',
+                         'quantity')
+        for owner_id, *row in user_orderlines:
+            self.booked_by_owner[str(owner_id)].append(row)
+
+        # Ongoing orders of each owner
+        self.ongoing_by_owner = defaultdict(set)
+        ongoing_orders = Order.objects \
+            .filter(sale__pk=sale.pk, status=OrderStatus.ONGOING.value) \
+            .filter(owner__in=owner_ids) \
+            .values_list('owner_id', 'pk')
+        for owner_id, order_id in ongoing_orders:
+            self.ongoing_by_owner[str(owner_id)].add(order_id)
+
+
+class OrderValidator:
+    """
+    Object that can validate an order
+
+    With lock_sale, the validation must happen in a transaction and the sale
+    is locked until its end, so that concurrent validations of the same sale
+    are serialized between processes while other sales are not impacted.
+
+    Many orders of the same sale can be validated at once with validate_orders,
+    sharing a single SaleSnapshot between their validations.
+    """
+
+    def __init__(
+        self, order: Order, raise_on_error: bool=True, lock_sale: bool=False,
+        snapshot: SaleSnapshot=None
+    ):
+        # TODO Check if oauth not needed or find oauth in cache
+        self.order = order
+        self.snapshot = snapshot
+        if snapshot is None:
+            self.owner = self.order.owner.get_with_api_data()
+            self.sale = self.order.sale
+        else:
+            self.owner = snapshot.owners[str(order.owner_id)]
+            self.sale = snapshot.sale
+
+        self.raise_on_error = raise_on_error
+        self.lock_sale = lock_sale
+        self.now = timezone.now()
+        self.errors = []
+        self.checked = False
+
+    @classmethod
+    def validate_orders(cls, orders: Iterable[Order]) -> Dict[Any, List[str]]:
+        """
+        Validate many orders of the same sale in a single pass
+        Each order is validated independently against the current bookings
+
+        Returns:
+            The list of errors of each order mapped by order id
+        """
+        orders = tuple(orders)
+        if not orders:
+            return {}
+        if len({ order.sale_id for order in orders }) > 1:
+            raise ValueError("All the orders must belong to the same sale")
+
+        snapshot = SaleSnapshot(orders[0].sale, orders)
+        results = {}
+        for order in orders:
+            validator = cls(order, raise_on_error=False, snapshot=snapshot)
+            validator.validate()
+            results[order.pk] = validator.get_errors()
+        return results
+
+    def validate(self):
+        """
+        Vérifie la validité d'un order
+        """
+        self.checked = True
+        if self.lock_sale:
+            self._lock_sale()
+        if self.snapshot is None:
+            self.snapshot = SaleSnapshot(self.sale, (self.order,))
+        self._check_sale()
+        self._check_order()
+        self._check_quantities()
+
+    @property
+    def is_valid(self) -> bool:
+        if not self.checked:
+            raise OrderValidationException(
+                "La commande doit être vérifiée avant d'être validée",
+                'check_order_before_is_valid',
+                status_code=500)
+
+        return len(self.errors) == 0
+
+    def get_errors(self) -> List[str]:
+        return self.errors
+
+    def _add_error(self, message: str, code: str=None):
+        """
+        Raise or add a new error
+        """
+        self.errors.append(message)
+        if self.raise_on_error:
+            raise OrderValidationException(message, code)
+
+    def _lock_sale(self):
+        """
+        Lock the sale row until the end of the current transaction
+        and refresh the order status that may have changed meanwhile
+        """
+        if not transaction.get_connection().in_atomic_block:
+            raise OrderValidationException(
+                "La vente ne peut être verrouillée qu'au sein d'une transaction",
+                'sale_lock_outside_transaction',
+                status_code=500)
+
+        with timed('pay.lock_sale'):
+            self.sale = Sale.objects.select_for_update().get(pk=self.sale.pk)
+        self.order.refresh_from_db(fields=('status',))
+
+    # ===============================================
+    # 			Check functions
+    # ===============================================
+
+    def _check_sale(self):
+        """
+        Check general settings on the sale
+        """
+        # Check if sale is active
+        if not self.sale.is_active:
+            self._add_error("La vente n'est pas disponible.")
+
+        # Check dates
+        if self.now < self.sale.begin_at:
+            self._add_error("La vente n'a pas encore commencé.")
+        if self.now > self.sale.end_at:
+            self._add_error("La vente est terminée.")
+
+    def _check_order(self):
+        """
+        Check general settings on the order
+        """
+        # Check if order is still buyable
+        if self.order.status not in OrderStatus.BUYABLE_STATUS_LIST.value:
+            self._add_error("Votre commande n'est pas payable.")
+
+        # Items of lottery sales can only be bought from drawn orders
+        if self.sale.is_lottery and self.order.status == OrderStatus.ONGOING.value:
+            self._add_error(
+                "Les articles de cette vente sont attribués par tirage au sort.")
+
+        # TODO Check if expired
+
+        # Check if no previous ongoing order on the same sale
+        user_ongoing_orders = self.snapshot.ongoing_by_owner[str(self.owner.pk)]
+        user_prev_ongoing_orders = user_ongoing_orders - { self.order.pk }
+        if user_prev_ongoing_orders:
+            self._add_error("Vous avez déjà une commande en cours pour cette vente.")
+
+        # Check if user can buy items
+        for orderline in self.snapshot.orderlines[self.order.pk]:
+            if not orderline.item.usertype.check_user(self.owner):
+                self._add_error(f"L'article {orderline.item.name} est réservé à {orderline.item.usertype.name}")
+
+    def _check_quantities(self):
+        """
+        Process and Verify Quantities
+        """
+        # ======= Part I - Process quantities
+
+        items = self.snapshot.items
+        groups = self.snapshot.groups
+
+        # Quantity per item and Total quantity bought in the order
+        order_qt = StockQuantity.from_rows(
+            (orderline.item_id, orderline.item.group_id, orderline.quantity)
+            for orderline in self.snapshot.orderlines[self.order.pk]
+        )
+        # Quantities booked or held by all orders except the one we are processing
+        sale_qt = self.snapshot.booked + self.snapshot.held
+        sale_qt -= StockQuantity.from_rows(self.snapshot.held_by_order[self.order.pk])
+        if self.order.books_items:
+            sale_qt -= order_qt
+        # Quantities that the user already booked except in the one we are processing
+        user_rows = self.snapshot.booked_by_owner[str(self.owner.pk)]
+        user_qt = StockQuantity.from_rows(
+            (item_id, group_id, quantity)
+            for order_id, item_id, group_id, quantity in user_rows
+            if order_id != self.order.pk
+        )
+
+        # ======= Part II - Verification
+
+        def is_quantity(quantity) -> bool:
+            return type(quantity) is int and quantity > 0
+
+        # II.1 - Sale level verification
+
+        if order_qt.total <= 0:
+            self._add_error(
+                "Vous devez avoir un nombre d'items commandés strictement positif.")
+
+        # Check max item quantity for the sale (ie. enough items left)
+        if is_quantity(self.sale.max_item_quantity) and sale_qt.total + order_qt.total > self.sale.max_item_quantity:
+            self._add_error("Il ne reste pas assez d'articles pour cette vente.")
+
+        # II.2 - Item level verification
+        for item_id, qt in order_qt.per_item.items():
+            item = items[item_id]
+            # Check quantity per item
+            sale_item_qt = sale_qt.per_item.get(item_id, 0) + qt
+            if is_quantity(item.quantity) and sale_item_qt > item.quantity:
+                self._add_error(f"Il ne reste pas assez de {item.name}.")
+
+            # Check max_per_user per item
+            user_item_qt = user_qt.per_item.get(item_id, 0) + qt
+            if is_quantity(item.max_per_user) and user_item_qt > item.max_per_user:
+                self._add_error(f"Vous ne pouvez pas prendre plus de {item.max_per_user} {item.name} par utilisateur.")
+
+        # II.3 - ItemGroup level verification
+        for group_id, qt in order_qt.per_group.items():
+            group = groups[group_id]
+            # Check quantity per group
+            sale_group_qt = sale_qt.per_group.get(group_id, 0) + qt
+            if is_quantity(group.quantity) and sale_group_qt > group.quantity:
+                self._add_error(f"Il ne reste pas assez de {group.name}.")
+
+            # Check max_per_user per group
+            user_group_qt = user_qt.per_group.get(group_id, 0) + qt
+            if is_quantity(group.max_per_user) and user_group_qt > group.max_per_user:
+                self._add_error(f"Vous ne pouvez pas prendre plus de {group.max_per_user} {group.name} par utilisateur.")
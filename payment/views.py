@@ -1,86 +1,181 @@
-from threading import Lock
-
+from django.db import transaction
 from django.urls import reverse
+from django.shortcuts import get_object_or_404
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 
-from sales.exceptions import OrderValidationException
-from sales.models import Order, OrderStatus
-from payment.services.base import TransactionException
+from core.exceptions import InvalidRequest
+from core.helpers import is_list_of_records
+from core.metrics import timed
+from sales.models import Sale, Order, OrderStatus
 from payment.validator import OrderValidator
+from payment.admission import AdmissionQueue
 from payment.helpers import get_pay_service
 
 
-pay_lock = Lock()
-
-
 class PaymentView:
     """
     View responsible for payment of orders
     """
 
+    @classmethod
+    def _book_order(cls, order: Order) -> tuple:
+        """
+        Verify the order while holding the sale lock and book its items,
+        within the current transaction that must end right after
+        to release the sale lock
+        Return the previous status and transaction id of the order
+        """
+        # Verify Order
+        with timed('pay.validate'):
+            validator = OrderValidator(order, raise_on_error=True, lock_sale=True)
+            validator.validate()
+
+        # TODO Check if doesn't already have an order
+
+        # Book the items
+        previous = (order.status, order.tra_id)
+        with timed('pay.book_order'):
+            order.status = OrderStatus.AWAITING_PAYMENT.value
+            order.tra_id = None
+            order.save()
+        return previous
+
+    @classmethod
+    def _pay_booked_order(cls, request, order: Order, return_url: str,
+                          previous: tuple) -> Response:
+        """
+        Create the transaction of a booked order and redirect to the payment,
+        or restore the order to its previous state if it fails
+        """
+        # Create Transaction, out of the sale lock as the payment service may be slow
+        pay_service = get_pay_service(order, request)
+        callback_url = request.build_absolute_uri(
+            reverse('order-status', kwargs={ 'pk': order.pk })
+        )
+        try:
+            with timed('pay.create_transaction'):
+                pay_transaction = pay_service.create_transaction(order, callback_url,
+                                                                 return_url)
+        except Exception:
+            # Release the booked items
+            order.status, order.tra_id = previous
+            order.save()
+            raise
+
+        # Save transaction id and redirect
+        with timed('pay.save_order'):
+            order.tra_id = pay_transaction['tra_id']
+            order.save(update_fields=('tra_id', 'updated_at'))
+
+        # The checkout ends with the payment,
+        # leaving its place in the queue to the next buyer
+        AdmissionQueue(order.sale).release(request.user)
+
+        # Redirect to transaction url
+        resp = {
+            'status': order.get_status_display(),
+            'redirect_url': pay_transaction['url'],
+        }
+        return Response(resp, status=status.HTTP_200_OK)
+
     @classmethod
     @permission_classes([IsAuthenticated])
+    @timed('view.pay')
     def pay(cls, request, pk):
         """
         Pay an order
 
         Steps:
             1. Retrieve Order
-            2. Verify Order
-            3. Create Transaction
-            4. Save Transaction info and redirect
+            2. Check the admission of the user if the sale has a queue
+            3. Verify and book Order while holding the sale lock
+            4. Create Transaction
+            5. Save Transaction info and redirect
         """
-        # 1. Retrieve Order
         # TODO ajout de la limite de temps
         order = Order.objects.filter(owner__pk=request.user.pk) \
                      .filter(status__in=OrderStatus.BUYABLE_STATUS_LIST.value) \
                      .select_related('sale', 'owner') \
                      .get(pk=pk)
 
-        # Lock sensitive part
-        pay_lock.acquire()
+        AdmissionQueue(order.sale).check(request.user)
+        with transaction.atomic():
+            previous = cls._book_order(order)
+        return cls._pay_booked_order(request, order, request.GET['return_url'], previous)
 
-        # 2. Verify Order
-        try:
-            validator = OrderValidator(order, raise_on_error=True)
-            validator.validate()
-        except OrderValidationException as error:
-            pay_lock.release()
-            raise error
+    @classmethod
+    @permission_classes([IsAuthenticated])
+    @timed('view.checkout')
+    def checkout(cls, request, pk):
+        """
+        Order items of a sale and pay them in a single request
 
-        # TODO Check if doesn't already have an order
+        Steps:
+            1. Retrieve or create the ongoing Order of the user on the sale,
+               once admitted if the sale has a queue
+            2. Replace its OrderLines by the ordered ones
+            3. Verify and book the Order as in `pay`
+            4. Pay the Order as in `pay`
+        The order is built and booked in one transaction, so nothing is kept
+        if it is invalid
+
+        Body:
+            orderlines: list of { item, quantity }
+            return_url: the url to return to after the payment
+        """
+        orderlines = request.data.get('orderlines')
+        if not is_list_of_records(orderlines, ('item',)):
+            raise InvalidRequest(
+                "Les articles commandés doivent être une liste de { item, quantity }.",
+                'invalid_orderlines')
+        return_url = request.data.get('return_url', request.GET.get('return_url'))
+        if not return_url:
+            raise InvalidRequest("Une url de retour doit être fournie.",
+                                 'missing_return_url')
+
+        sale = get_object_or_404(Sale, pk=pk)
+        AdmissionQueue(sale).check(request.user)
+        with transaction.atomic():
+            # 1. Retrieve or create Order
+            order = Order.objects.filter(sale=sale, owner__pk=request.user.pk) \
+                         .filter(status=OrderStatus.ONGOING.value) \
+                         .select_related('sale', 'owner') \
+                         .first()
+            if order is None:
+                order = Order.objects.create(sale=sale, owner=request.user,
+                                             status=OrderStatus.ONGOING.value)
+
+            # 2. Set OrderLines
+            order.set_orderlines({
+                line.get('item'): line.get('quantity') for line in orderlines
+            }, replace=True)
+
+            # 3. Book Order
+            previous = cls._book_order(order)
+
+        # 4. Pay Order
+        return cls._pay_booked_order(request, order, return_url, previous)
 
-        # 3. Create Transaction
-        pay_service = get_pay_service(order, request)
-        try:
-            callback_url = request.build_absolute_uri(
-                reverse('order-status', kwargs={ 'pk': order.pk })
-            )
-            return_url = request.GET['return_url']
-            transaction = pay_service.create_transaction(order, callback_url, return_url)
-        except TransactionException as error:
-            pay_lock.release()
-            raise error
-
-        # 4. Save transaction id and redirect
-        try:
-            order.status = OrderStatus.AWAITING_PAYMENT.value
-            order.tra_id = transaction['tra_id']
-            order.save()
-        finally:
-            pay_lock.release()
+    @classmethod
+    @permission_classes([IsAuthenticated])
+    def queue(cls, request, pk):
+        """
+        Poll the admission queue of a sale, queuing the user if needed
 
-        # Redirect to transaction url
-        resp = {
-            'status': order.get_status_display(),
-            'redirect_url': transaction['url'],
-        }
+        Returns:
+            admitted: whether the user can pay
+            position: number of buyers to admit before the user
+            wait: estimated number of seconds before being admitted
+        """
+        sale = get_object_or_404(Sale, pk=pk)
+        resp = AdmissionQueue(sale).poll(request.user)
         return Response(resp, status=status.HTTP_200_OK)
 
     @classmethod
+    @timed('view.update_status')
     def update_status(cls, request, pk):
         """
         Callback after the transaction has been made
@@ -99,5 +194,6 @@ class PaymentView:
 
 
 # Set all endpoint method from PaymentView as API View
-for key in ('pay', 'update_status'):
+for key in ('pay', 'queue', 'update_status'):
     setattr(PaymentView, key, api_view(['GET'])(getattr(PaymentView, key)))
+PaymentView.checkout = api_view(['POST'])(PaymentView.checkout)
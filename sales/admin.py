@@ -81,6 +81,7 @@ class ItemAdmin(admin.ModelAdmin):
     )
     list_filter = ('is_active', 'sale', 'group', 'usertype')
     list_editable = tuple()
+    list_select_related = ('sale', 'group', 'usertype')
 
     inlines = (ItemFieldInline,)
     exclude = ('fields',)
@@ -93,6 +94,9 @@ class ItemAdmin(admin.ModelAdmin):
     search_fields = ('name', 'sale', 'group')
     ordering = ('sale', 'name', 'usertype')
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_quantities()
+
 
 # --------------------------------------------
 #   Orders
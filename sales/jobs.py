@@ -0,0 +1,31 @@
+"""
+Handlers of the jobs run out of the request path by the run_jobs command
+
+Each handler gets the order of its job and must be safe to run again,
+as failed jobs are retried
+"""
+from typing import Callable, Dict
+
+from sales.models import Order
+
+
+def generate_tickets(order: Order) -> None:
+    order.generate_orderlineitems_and_fields()
+
+
+def render_tickets(order: Order) -> None:
+    # Tickets must exist before being rendered and stored for their first download
+    order.generate_orderlineitems_and_fields()
+    order.get_rendered_tickets('pdf')
+
+
+def send_confirmation_mail(order: Order) -> None:
+    order.generate_orderlineitems_and_fields()
+    order.send_confirmation_mail()
+
+
+JOB_HANDLERS: Dict[str, Callable[[Order], None]] = {
+    'generate_tickets': generate_tickets,
+    'render_tickets': render_tickets,
+    'send_confirmation_mail': send_confirmation_mail,
+}
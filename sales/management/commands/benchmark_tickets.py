@@ -0,0 +1,88 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.utils import TICKETS_TEMPLATE, render_to_pdf, draw_tickets_pdf, base64_qrcode
+from core.qrcodes import QRCodeEngine, get_qrcode_engine
+from authentication.models import User
+from sales.models import Sale, Item, Order
+
+
+class Command(BaseCommand):
+    """
+    Compare the time to render tickets from the HTML template
+    and to draw them straight onto the PDF canvas
+
+    Usage:
+        python manage.py benchmark_tickets --help
+    """
+
+    help = "Measure the per-ticket render time of each ticket renderer."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-t', '--tickets',
+                            type=int,
+                            default=10,
+                            help="Number of tickets per order")
+        parser.add_argument('-r', '--repeat',
+                            type=int,
+                            default=5,
+                            help="Number of orders rendered by each renderer")
+
+    def get_tickets(self, order: Order, n_tickets: int) -> list:
+        item = Item(name="Place", price=12.5, sale=order.sale)
+        return [
+            {
+                'nom': order.owner.first_name,
+                'prenom': order.owner.last_name,
+                'qr_data': ticket_id.hex,
+                'qr_code': base64_qrcode(ticket_id.hex),
+                'item': item,
+                'uuid': ticket_id,
+            }
+            for ticket_id in (uuid.uuid4() for __ in range(n_tickets))
+        ]
+
+    def measure(self, render, repeat: int) -> float:
+        """
+        Get the best time of a render out of `repeat` runs
+        """
+        durations = []
+        for __ in range(repeat):
+            start = time.perf_counter()
+            render()
+            durations.append(time.perf_counter() - start)
+        return min(durations)
+
+    def handle(self, tickets: int, repeat: int, **options) -> str:
+        if tickets < 1 or repeat < 1:
+            raise CommandError("There must be at least one ticket and one repetition")
+
+        # Unsaved instances are enough to render tickets
+        owner = User(first_name="Jean", last_name="Dupont")
+        order = Order(sale=Sale(name="Gala"), owner=owner)
+        data = { 'tickets': self.get_tickets(order, tickets), 'order': order }
+        payloads = [ ticket['qr_data'] for ticket in data['tickets'] ]
+
+        # QR codes are measured without cache, as on a first render, then cached
+        engine = get_qrcode_engine()
+        qr_results = {
+            'png': self.measure(lambda: QRCodeEngine().batch(payloads, 'png'), repeat),
+            'svg': self.measure(lambda: QRCodeEngine().batch(payloads, 'svg'), repeat),
+            'cached png': self.measure(lambda: engine.batch(payloads, 'png'), repeat),
+        }
+        for output, duration in qr_results.items():
+            self.stdout.write(f"QR codes as {output}: "
+                              f"{1000 * duration / tickets:.2f}ms per ticket")
+
+        results = {
+            'html': self.measure(lambda: render_to_pdf(TICKETS_TEMPLATE, data), repeat),
+            'canvas': self.measure(lambda: draw_tickets_pdf(data['tickets'], order),
+                                   repeat),
+        }
+        for renderer, duration in results.items():
+            self.stdout.write(f"{renderer}: {1000 * duration / tickets:.2f}ms per ticket "
+                              f"({1000 * duration:.1f}ms for {tickets} tickets)")
+        speedup = results['html'] / results['canvas']
+        return f"Canvas renderer is {speedup:.1f}x faster than the HTML one"
@@ -0,0 +1,38 @@
+from typing import List
+
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from sales.models import Sale, PurchaseIntent
+
+
+class Command(BaseCommand):
+    """
+    Draw the lottery sales whose registration has ended
+
+    Usage:
+        python manage.py draw_lottery --help
+    """
+
+    help = "Allocate the items of lottery sales among their purchase intents."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('sales',
+                            nargs='*',
+                            help="Ids of the sales to draw, "
+                                 "all closed lotteries by default")
+        parser.add_argument('-s', '--seed',
+                            default=None,
+                            help="Seed of the draw, to reproduce it")
+
+    def handle(self, sales: List[str], seed: str=None, **options) -> str:
+        lotteries = Sale.objects.filter(registration_end_at__lt=timezone.now(),
+                                        intents__allocated__isnull=True).distinct()
+        if sales:
+            lotteries = lotteries.filter(pk__in=sales)
+
+        results = []
+        for sale in lotteries:
+            orders = PurchaseIntent.objects.draw(sale, seed=seed)
+            results.append(f"{len(orders)} winners for {sale.pk}")
+        return f"Drew {len(results)} lotteries ({', '.join(results) or 'none'})"
@@ -0,0 +1,44 @@
+from typing import List
+import time
+
+from django.core.management.base import BaseCommand
+
+from sales.models import Order
+
+
+class Command(BaseCommand):
+    """
+    Expire the orders that exceeded the max time of their status
+
+    Usage:
+        python manage.py expire_orders --help
+    """
+
+    help = "Expire overdue orders and release the items they booked."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('sales',
+                            nargs='*',
+                            help="Ids of the sales to sweep, all by default")
+        parser.add_argument('-e', '--every',
+                            type=int,
+                            default=None,
+                            help="Sweep again every given number of seconds "
+                                 "until interrupted")
+
+    def sweep(self, sales: List[str]) -> str:
+        orders = Order.objects.filter(sale__in=sales) if sales else Order.objects.all()
+        expired = orders.expire_overdue()
+        details = ', '.join(f"{count} {status.name}" for status, count in expired.items())
+        return f"Expired {sum(expired.values())} orders ({details})"
+
+    def handle(self, sales: List[str], every: int=None, **options) -> str:
+        if not every:
+            return self.sweep(sales)
+
+        try:
+            while True:
+                self.stdout.write(self.sweep(sales))
+                time.sleep(every)
+        except KeyboardInterrupt:
+            return "Stopped sweeping orders"
@@ -0,0 +1,226 @@
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import deque
+from typing import Deque, Iterator, List, Optional, Tuple
+import multiprocessing
+import math
+import zipfile
+import time
+import csv
+import io
+import os
+
+from PyPDF2 import PdfReader, PdfWriter
+
+from django import db
+from django.conf import settings
+from django.utils import timezone
+from django.db.models import prefetch_related_objects
+from django.core.management.base import BaseCommand, CommandError
+
+from core.utils import render_tickets_pdf
+from sales.models import Sale, Order, OrderStatus
+
+MANIFEST_FIELDS = ('order_id', 'owner', 'email', 'tickets', 'filename')
+
+# An order with its tickets, and with its number of tickets and rendered PDF if any
+OrderTickets = Tuple[Order, List[dict]]
+OrderRender = Tuple[Order, int, Optional[bytes]]
+
+
+class Command(BaseCommand):
+    """
+    Export the tickets of all the validated orders of a sale,
+    rendered in a pool of processes and written as they come,
+    either as a zip of one PDF per order or as merged PDFs
+    of at most `batch_size` orders each, so that memory stays bounded
+
+    Validated orders whose tickets are not generated yet are listed
+    in the manifest and the output, not exported
+
+    Usage:
+        python manage.py export_tickets --help
+    """
+
+    help = "Export every ticket of a sale as a zip of PDFs or as one merged PDF."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('sale',
+                            help="Id of the sale to export")
+        parser.add_argument('-f', '--format',
+                            dest='export_format',
+                            choices=('zip', 'pdf'),
+                            default='zip',
+                            help="Zip of one PDF per order or one merged PDF")
+        parser.add_argument('-w', '--workers',
+                            type=int,
+                            default=os.cpu_count(),
+                            help="Number of rendering processes")
+        parser.add_argument('-c', '--chunk-size',
+                            type=int,
+                            default=50,
+                            help="Number of orders fetched at once")
+        parser.add_argument('-b', '--batch-size',
+                            type=int,
+                            default=500,
+                            help="Max number of orders merged in each PDF")
+        parser.add_argument('-o', '--output',
+                            default=None,
+                            help="Path of the export (default: in the exports directory)")
+
+    def iter_orders(self, sale: Sale, chunk_size: int) -> Iterator[OrderTickets]:
+        """
+        Stream the validated orders of the sale with their tickets,
+        prefetching the tickets of a chunk of orders at once
+        """
+        orders = Order.objects.filter(sale=sale) \
+                              .filter(status__in=OrderStatus.VALIDATED_LIST.value) \
+                              .select_related('sale', 'owner') \
+                              .order_by('pk') \
+                              .iterator(chunk_size=chunk_size)
+        chunk = []
+        for order in orders:
+            chunk.append(order)
+            if len(chunk) >= chunk_size:
+                yield from self.get_chunk_tickets(chunk)
+                chunk = []
+        yield from self.get_chunk_tickets(chunk)
+
+    def get_chunk_tickets(self, orders: List[Order]) -> Iterator[OrderTickets]:
+        prefetch_related_objects(orders, *Order.TICKETS_PREFETCH)
+        for order in orders:
+            yield order, order.get_tickets()
+
+    def render(self, sale: Sale, workers: int, chunk_size: int) -> Iterator[OrderRender]:
+        """
+        Render the tickets of the orders in a pool of processes,
+        with a bounded number of PDFs pending, and yield them in order,
+        without PDF for the orders whose tickets are not generated yet
+        """
+        db.connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            # Workers are only forked on the first submit: force it with a no-op task
+            # before the queries below open a new connection, which they must not inherit
+            executor.submit(int).result()
+
+            # Only send what the renderers need to the workers,
+            # not the prefetched relations
+            pending: Deque[Tuple[Order, int, Optional[Future]]] = deque()
+            for order, tickets in self.iter_orders(sale, chunk_size):
+                future = None
+                if tickets:
+                    light_order = Order(pk=order.pk, sale=order.sale, owner=order.owner)
+                    future = executor.submit(render_tickets_pdf, tickets, light_order)
+                pending.append((order, len(tickets), future))
+                if len(pending) >= 2 * workers:
+                    order, n_tickets, future = pending.popleft()
+                    yield order, n_tickets, future and future.result()
+            while pending:
+                order, n_tickets, future = pending.popleft()
+                yield order, n_tickets, future and future.result()
+
+    def write_merged(self, renders: Iterator[OrderRender], paths: Iterator[str],
+                     batch_size: int) -> Iterator[Tuple[Order, int, bool]]:
+        """
+        Merge the rendered PDFs into files of at most `batch_size` orders,
+        each written as soon as it is full, and yield the orders as they are merged
+        """
+        merged, n_merged = PdfWriter(), 0
+        for order, n_tickets, pdf in renders:
+            if pdf is not None:
+                for page in PdfReader(io.BytesIO(pdf)).pages:
+                    merged.add_page(page)
+                n_merged += 1
+            if n_merged >= batch_size:
+                with open(next(paths), 'wb') as file:
+                    merged.write(file)
+                merged, n_merged = PdfWriter(), 0
+            yield order, n_tickets, pdf is not None
+        if n_merged:
+            with open(next(paths), 'wb') as file:
+                merged.write(file)
+
+    def write_progress(self, n_orders: int, total: int, n_tickets: int,
+                       start: float) -> None:
+        duration = time.monotonic() - start
+        rate = n_tickets / duration if duration else 0
+        self.stderr.write(f"\r{n_orders}/{total} orders, "
+                          f"{n_tickets} tickets ({rate:.1f} tickets/s)", ending='')
+
+    def handle(self, sale: str, export_format: str='zip', workers: int=None,
+               chunk_size: int=50, batch_size: int=500, output: str=None,
+               **options) -> str:
+        try:
+            sale = Sale.objects.get(pk=sale)
+        except Sale.DoesNotExist:
+            raise CommandError(f"Sale {sale} does not exist")
+        workers = max(workers or 1, 1)
+        batch_size = max(batch_size or 1, 1)
+        total = Order.objects.filter(sale=sale) \
+                             .filter(status__in=OrderStatus.VALIDATED_LIST.value) \
+                             .count()
+
+        if output is None:
+            date = timezone.now().strftime('%Y-%m-%d_%H-%M-%S')
+            os.makedirs(settings.EXPORTS_DIR, exist_ok=True)
+            filename = f"tickets_{sale.pk}_{date}.{export_format}"
+            output = os.path.join(settings.EXPORTS_DIR, filename)
+
+        start = time.monotonic()
+        n_orders = n_tickets = 0
+        missing = []
+        renders = self.render(sale, workers, chunk_size)
+        show_progress = options['verbosity'] > 0
+        if export_format == 'zip':
+            # PDFs are already compressed, they are stored as is
+            with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+                manifest = io.StringIO()
+                writer = csv.DictWriter(manifest, fieldnames=MANIFEST_FIELDS)
+                writer.writeheader()
+                for order, order_tickets, pdf in renders:
+                    filename = f"{order.pk}.pdf" if pdf is not None else ''
+                    if pdf is not None:
+                        archive.writestr(filename, pdf)
+                    writer.writerow({
+                        'order_id': order.pk,
+                        'owner': order.owner,
+                        'email': order.owner.email,
+                        'tickets': order_tickets,
+                        'filename': filename,
+                    })
+                    if pdf is None:
+                        missing.append(order.pk)
+                        continue
+                    n_orders += 1
+                    n_tickets += order_tickets
+                    if show_progress:
+                        self.write_progress(n_orders, total, n_tickets, start)
+                archive.writestr('orders.csv', manifest.getvalue())
+            outputs = [ output ]
+        else:
+            # Merged in parts to bound the memory, numbered if there are many
+            n_parts = math.ceil(total / batch_size)
+            outputs = [ output ]
+            if n_parts > 1:
+                root, ext = os.path.splitext(output)
+                outputs = [ f"{root}_{part:03}{ext}" for part in range(1, n_parts + 1) ]
+            merged = self.write_merged(renders, iter(outputs), batch_size)
+            for order, order_tickets, exported in merged:
+                if not exported:
+                    missing.append(order.pk)
+                    continue
+                n_orders += 1
+                n_tickets += order_tickets
+                if show_progress:
+                    self.write_progress(n_orders, total, n_tickets, start)
+            outputs = [ path for path in outputs if os.path.exists(path) ]
+
+        if show_progress:
+            self.stderr.write('')
+        if missing:
+            self.stderr.write(f"{len(missing)} orders without tickets yet, not exported: "
+                              f"{', '.join(str(pk) for pk in missing)}")
+        duration = time.monotonic() - start
+        rate = n_tickets / duration if duration else 0
+        return (f"Exported {n_tickets} tickets of {n_orders} orders in {duration:.1f}s "
+                f"({rate:.1f} tickets/s) to {', '.join(outputs)}")
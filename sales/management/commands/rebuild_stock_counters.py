@@ -0,0 +1,26 @@
+from typing import List
+
+from django.core.management.base import BaseCommand
+
+from sales.models import Sale, StockCounter
+
+
+class Command(BaseCommand):
+    """
+    Recompute the stock counters from the orderlines of booking orders
+
+    Usage:
+        python manage.py rebuild_stock_counters --help
+    """
+
+    help = "Recompute the stock counters from the orders booking items."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('sales',
+                            nargs='*',
+                            help="Ids of the sales to rebuild, all by default")
+
+    def handle(self, sales: List[str], **options) -> str:
+        queryset = Sale.objects.filter(pk__in=sales) if sales else None
+        created = StockCounter.objects.rebuild(queryset)
+        return f"Rebuilt {created} stock counters"
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from sales.models import Job
+
+
+class Command(BaseCommand):
+    """
+    Run the jobs scheduled out of the request path,
+    like the tickets and confirmation mail of paid orders
+
+    Usage:
+        python manage.py run_jobs --help
+    """
+
+    help = "Run the pending background jobs, once or continuously."
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('-b', '--batch',
+                            type=int,
+                            default=10,
+                            help="Number of jobs claimed at once")
+        parser.add_argument('-i', '--interval',
+                            type=float,
+                            default=1,
+                            help="Seconds to wait when there is no job to run")
+        parser.add_argument('--once',
+                            action='store_true',
+                            default=False,
+                            help="Run the pending jobs and stop")
+
+    def handle(self, batch: int=10, interval: float=1, once: bool=False,
+               **options) -> str:
+        total = 0
+        try:
+            while True:
+                count = Job.objects.run_pending(batch)
+                total += count
+                if once and not count:
+                    break
+                if not count:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        failed = Job.objects.filter(status='failed').count()
+        return f"Ran {total} jobs ({failed} failed after all their attempts)"
@@ -0,0 +1,65 @@
+# Generated by Django 3.0.7 on 2026-10-17 03:45
+
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# AWAITING_VALIDATION, VALIDATED, AWAITING_PAYMENT and PAID orders book items
+BOOKING_STATUSES = (1, 2, 3, 4)
+
+
+def create_stock_counters(apps, schema_editor):
+    """
+    Compute the counters from the orderlines of booking orders:
+    one for each sale, each item group and each item
+    """
+    OrderLine = apps.get_model('sales', 'OrderLine')
+    StockCounter = apps.get_model('sales', 'StockCounter')
+
+    deltas = defaultdict(int)
+    orderlines = OrderLine.objects.filter(order__status__in=BOOKING_STATUSES) \
+                                  .values_list('order__sale_id', 'item_id', 'item__group_id', 'quantity')
+    for sale_id, item_id, group_id, quantity in orderlines:
+        deltas[(sale_id, None, None)] += quantity
+        deltas[(sale_id, None, item_id)] += quantity
+        if group_id is not None:
+            deltas[(sale_id, group_id, None)] += quantity
+
+    StockCounter.objects.bulk_create(
+        StockCounter(sale_id=sale_id, group_id=group_id, item_id=item_id, quantity=quantity)
+        for (sale_id, group_id, item_id), quantity in deltas.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='order',
+            options={'ordering': ('-id',)},
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='fields',
+            field=models.ManyToManyField(through='sales.ItemField', to='sales.Field'),
+        ),
+        migrations.CreateModel(
+            name='StockCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=0)),
+                ('group', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stockcounters', to='sales.ItemGroup')),
+                ('item', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stockcounters', to='sales.Item')),
+                ('sale', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='stockcounters', to='sales.Sale')),
+            ],
+            options={
+                'unique_together': {('sale', 'group', 'item')},
+            },
+        ),
+        migrations.RunPython(create_stock_counters, migrations.RunPython.noop),
+    ]
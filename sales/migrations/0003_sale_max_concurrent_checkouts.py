@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-17 04:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0002_stockcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='max_concurrent_checkouts',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
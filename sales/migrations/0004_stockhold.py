@@ -0,0 +1,27 @@
+# Generated by Django 3.0.7 on 2026-10-17 04:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0003_sale_max_concurrent_checkouts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('item', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='sales.Item')),
+                ('order', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='sales.Order')),
+            ],
+            options={
+                'unique_together': {('order', 'item')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.0.7 on 2026-10-17 04:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sales', '0004_stockhold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='registration_end_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='PurchaseIntent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveSmallIntegerField()),
+                ('allocated', models.PositiveSmallIntegerField(blank=True, default=None, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('item', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='intents', to='sales.Item')),
+                ('order', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='intents', to='sales.Order')),
+                ('owner', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='intents', to=settings.AUTH_USER_MODEL)),
+                ('sale', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='intents', to='sales.Sale')),
+            ],
+            options={
+                'ordering': ('id',),
+                'unique_together': {('owner', 'item')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-17 04:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0005_lottery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='ticket_renderer',
+            field=models.CharField(choices=[('html', 'Gabarit HTML'), ('canvas', 'Dessin direct')], default='html', max_length=8),
+        ),
+    ]
@@ -1,13 +1,28 @@
+import os
 import uuid
+import math
+import hashlib
+import random
 from enum import Enum
+from contextlib import suppress
+from collections import namedtuple, defaultdict
+from typing import Any, Iterable, List, Tuple, Dict, Union
 
 from django.conf import settings
 from django.utils import timezone
 from django.db import models, transaction
-from django.core.mail import EmailMessage
-
-from core.models import APIModel
+from django.db.models import F, Q, Count, Max, Sum, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.core.mail import EmailMessage, get_connection
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+from core.models import APIModel, TrackedFieldsModel
+from core.metrics import timed
 from core.helpers import get_field_default_value
+from core.utils import TICKETS_TEMPLATE, get_tickets_context, render_tickets_pdf
 from authentication.models import User, UserType
 
 NAME_FIELD_MAXLEN = 150
@@ -42,6 +57,12 @@ class Association(APIModel):
         return self.shortname
 
 
+TICKET_RENDERERS = (
+    ('html', "Gabarit HTML"),
+    ('canvas', "Dessin direct"),
+)
+
+
 class Sale(models.Model):
     """
     Defines a Sale
@@ -60,17 +81,33 @@ class Sale(models.Model):
     created_at  = models.DateTimeField(auto_now_add=True, editable=False)
     begin_at    = models.DateTimeField()
     end_at      = models.DateTimeField()
+    # Sales with a registration end are allocated by lottery
+    registration_end_at = models.DateTimeField(blank=True, null=True)
 
     max_item_quantity = models.PositiveIntegerField(blank=True, null=True)
+    # Admission queue in front of the payment, disabled if empty
+    # At most this number of admitted users can be checking out at once
+    max_concurrent_checkouts = models.PositiveIntegerField(blank=True, null=True)
 
     # Customization
     cgv   = models.URLField(max_length=URL_FIELD_MAXLEN, blank=True, null=True)
     image = models.URLField(max_length=URL_FIELD_MAXLEN, blank=True, null=True)
     color = models.CharField(max_length=6, blank=True, null=True)
+    # Tickets drawn straight on a PDF canvas are much faster than rendered from HTML
+    ticket_renderer = models.CharField(max_length=8, choices=TICKET_RENDERERS,
+                                       default='html')
 
     # TODO mail_template tickets
     # TODO paymentmethods = models.ManyToManyField(PaymentMethod)
 
+    @property
+    def is_lottery(self) -> bool:
+        """
+        Whether items are drawn among the purchase intents registered
+        between begin_at and registration_end_at, instead of first come first served
+        """
+        return self.registration_end_at is not None
+
     def __str__(self) -> str:
         return f"{self.name} par {self.association}"
 
@@ -102,10 +139,55 @@ class ItemGroup(models.Model):
         return self.name
 
 
-class Item(models.Model):
+class ItemQuerySet(models.QuerySet):
+
+    def with_quantities(self) -> 'ItemQuerySet':
+        """
+        Annotate the quantity sold of each item from its stock counter
+        """
+        booked = StockCounter.objects.filter(item=models.OuterRef('pk')) \
+                                     .values('quantity')[:1]
+        return self.annotate(_quantity_sold=Coalesce(models.Subquery(booked), 0))
+
+    def clean_quantities(self, sale_id: str,
+                         quantities: Dict[Any, Any]) -> Dict[int, int]:
+        """
+        Check quantities mapped by item id of a sale and cast them to integers
+        """
+        from .exceptions import OrderValidationException
+
+        try:
+            quantities = {
+                int(item_id): int(quantity) for item_id, quantity in quantities.items()
+            }
+            assert all(quantity >= 0 for quantity in quantities.values())
+        except (TypeError, ValueError, AssertionError) as error:
+            raise OrderValidationException(
+                "La quantité d'article à acheter doit être positive ou nulle.",
+                'order_quantity_null',
+                status_code=400
+            ) from error
+
+        sale_items = self.filter(sale=sale_id, pk__in=quantities) \
+                         .values_list('pk', flat=True)
+        unknown_items = set(quantities) - set(sale_items)
+        if unknown_items:
+            raise OrderValidationException(
+                "Certains articles n'appartiennent pas à cette vente.",
+                'item_not_in_sale',
+                details=sorted(unknown_items),
+                status_code=400
+            )
+        return quantities
+
+
+class Item(TrackedFieldsModel):
     """
     Defines a sellable Item
     """
+    tracked_fields = ('group_id', 'name', 'price', 'usertype_id', 'sale_id')
+    payment_fields = ('name', 'price', 'usertype_id', 'sale_id')
+
     # Description
     name        = models.CharField(max_length=NAME_FIELD_MAXLEN)
     description = models.CharField(max_length=DESC_FIELD_MAXLEN, blank=True)
@@ -131,21 +213,17 @@ class Item(models.Model):
                                     through='ItemField',
                                     through_fields=('item', 'field'))
 
-    def quantity_sold(self) -> int:
-        filters = {
-            'orderlines__item__pk': self.pk,
-            'status__in': OrderStatus.BOOKING_LIST.value,
-        }
+    objects = ItemQuerySet.as_manager()
 
-        # TODO Use db
-        # from django.db.models import Avg, Count, Min, Sum
-        # return Sum().aggregate(quantity_sold=)
-        # self.sale.orders.filter(**filters)
-        return sum(
-            orderline.quantity
-            for order in self.sale.orders.filter(**filters).prefetch_related('orderlines').all()
-            for orderline in order.orderlines.filter(item=self).all()
-        )
+    def quantity_sold(self) -> int:
+        """
+        Quantity booked by orders, annotated by ItemQuerySet.with_quantities
+        or read from the stock counter of the item
+        """
+        if hasattr(self, '_quantity_sold'):
+            return self._quantity_sold
+        booked = self.stockcounters.values_list('quantity', flat=True).first()
+        return booked or 0
 
     def quantity_left(self) -> int:
         if self.quantity is None:
@@ -156,15 +234,35 @@ class Item(models.Model):
         # TODO Quantity estimation for client UI
         pass
 
+    def needs_payment_synch(self, dirty_fields: dict=None) -> bool:
+        """
+        Whether the item is new to the payment system or changed fields it uses
+        """
+        if dirty_fields is None:
+            dirty_fields = self.get_dirty_fields()
+        if self._state.adding or not self.nemopay_id:
+            return True
+        return any(field in dirty_fields for field in self.payment_fields)
+
     def save(self, *args, **kwargs) -> None:
         """
-        Save item and synch it with the payment system
+        Save item and synch it with the payment system if needed,
+        move its booked quantity if its group changed
+        and recompute the counters of both sales if it changed sale
         """
-        from payment.helpers import get_pay_service
-        pay_service = get_pay_service(self)
-        pay_service.synch_item(self)
+        is_new = self._state.adding
+        dirty_fields = self.get_dirty_fields()
+        if self.needs_payment_synch(dirty_fields):
+            from payment.helpers import get_pay_service
+            pay_service = get_pay_service(self)
+            pay_service.synch_item(self)
 
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if not is_new and 'sale_id' in dirty_fields:
+                StockCounter.objects.rebuild([ dirty_fields['sale_id'], self.sale_id ])
+            elif not is_new and 'group_id' in dirty_fields:
+                StockCounter.objects.move_item_group(self, dirty_fields['group_id'])
 
     def __str__(self) -> str:
         return f"{self.name} ({self.sale})"
@@ -225,11 +323,57 @@ class OrderStatus(Enum):
         return tuple((i.value, i.name) for i in cls if isinstance(i.value, int))
 
 
-class Order(models.Model):
+class OrderQuerySet(models.QuerySet):
+
+    def expire_overdue(self, now=None) -> Dict[OrderStatus, int]:
+        """
+        Expire the orders that exceeded the max time of their status
+        with one update per status, and release the items they booked or held
+        Orders locked by another transaction are left for the next run,
+        as well as the orders awaiting a transaction that may still be paid,
+        which are reconciled with the payment service instead
+        Return the number of expired orders per previous status
+        """
+        if now is None:
+            now = timezone.now()
+        max_times = {
+            OrderStatus.ONGOING: settings.MAX_ONGOING_TIME,
+            OrderStatus.AWAITING_PAYMENT: settings.MAX_PAYMENT_TIME,
+            OrderStatus.AWAITING_VALIDATION: settings.MAX_VALIDATION_TIME,
+        }
+
+        expired = {}
+        with transaction.atomic():
+            for status, max_time in max_times.items():
+                overdue = self.filter(status=status.value, created_at__lt=now - max_time)
+                if status == OrderStatus.AWAITING_PAYMENT:
+                    overdue = overdue.filter(tra_id__isnull=True)
+                if status.value in OrderStatus.BOOKING_LIST.value:
+                    order_ids = list(overdue.select_for_update(skip_locked=True)
+                                            .values_list('pk', flat=True))
+                    orderlines = OrderLine.objects.filter(order__in=order_ids)
+                    StockCounter.objects.add_orderlines(orderlines, -1)
+                    overdue = Order.objects.filter(pk__in=order_ids)
+
+                expired[status] = overdue.update(status=OrderStatus.EXPIRED.value,
+                                                 updated_at=now)
+
+            StockHold.objects.filter(expires_at__lte=now).delete()
+        return expired
+
+
+class Order(TrackedFieldsModel):
     """
     Defines the Order object
     This is the central model of all the project
     """
+    tracked_fields = ('status',)
+    # Relations used to get the tickets of orders
+    TICKETS_PREFETCH = (
+        'orderlines__item',
+        'orderlines__orderlineitems__orderlinefields__field',
+    )
+
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders', editable=False)
     sale  = models.ForeignKey(Sale, on_delete=models.CASCADE, related_name='orders', editable=False)
 
@@ -243,8 +387,17 @@ class Order(models.Model):
     # TODO Abstraire payment
     tra_id = models.IntegerField(blank=True, null=True, default=None)
 
+    objects = OrderQuerySet.as_manager()
+
     # ----- Additional methods
 
+    @property
+    def books_items(self) -> bool:
+        """
+        Whether the order, as saved in the database, books its items
+        """
+        return self.get_saved_value('status') in OrderStatus.BOOKING_LIST.value
+
     def is_expired(self) -> bool:
         """
         Check expiracy time according to order status and expire if needed
@@ -279,13 +432,47 @@ class Order(models.Model):
 
         return OrderStatus(self.status)
 
+    def _lock_and_refresh_status(self) -> None:
+        """
+        Lock the order row until the end of the current transaction
+        and refresh its status that may have changed meanwhile
+        """
+        self.status = Order.objects.select_for_update() \
+                           .values_list('status', flat=True).get(pk=self.pk)
+        self._reset_tracked_fields(('status',))
+
+    def fetch_status_once(self) -> OrderStatus:
+        """
+        Fetch the status, sharing the status fetched from the payment service
+        for a short time with concurrent callers waiting for the order lock
+        """
+        if self.status != OrderStatus.AWAITING_PAYMENT.value:
+            return self.fetch_status()
+
+        cache_key = f"order_fetched_status_{self.pk}_{self.tra_id}"
+        fetched = cache.get(cache_key)
+        if fetched is not None:
+            return OrderStatus(fetched)
+
+        status = self.fetch_status()
+        if status is not None:
+            timeout = int(settings.FETCHED_STATUS_CACHE_TIMEOUT.total_seconds())
+            cache.set(cache_key, status.value, timeout)
+        return status
+
+    @timed('order.update_status')
+    @transaction.atomic
     def update_status(self, status: OrderStatus=None) -> dict:
         """
         Update the order status, make side changes if needed,
         and return an update response
+
+        Concurrent updates of the same order are serialized by locking its row,
+        so that only the first caller fetches the status and schedules the tickets
         """
+        self._lock_and_refresh_status()
         if status is None:
-            status = self.fetch_status()
+            status = self.fetch_status_once()
 
         resp = {
             'old_status': self.get_status_display(),
@@ -293,61 +480,213 @@ class Order(models.Model):
             'updated': self.status != status.value and self.status not in OrderStatus.STABLE_LIST.value,
             # Redirect to payment if needed
             'redirect_to_payment': status and status.value == OrderStatus.AWAITING_PAYMENT.value,
-            # If sale freshly validated, generate tickets
-            'tickets_generated': (status
-                                  and self.status not in OrderStatus.VALIDATED_LIST.value
-                                  and status.value in OrderStatus.VALIDATED_LIST.value),
+            # If sale freshly validated, schedule the tickets and the confirmation
+            'tickets_generated': status.value in OrderStatus.VALIDATED_LIST.value,
         }
+        # Orders in a stable status are not updated and got their tickets when validated
+        if not resp['updated']:
+            resp['tickets_generated'] = False
 
         # Update order status
         if resp['updated']:
             self.status = status.value
             self.save()
 
-        # Generate tickets if needed
+        # Generate tickets and send the confirmation out of the request
         if resp['tickets_generated']:
-            self.generate_orderlineitems_and_fields()
+            Job.objects.enqueue_post_payment(self)
 
         resp['status']  = self.get_status_display()
         resp['message'] = OrderStatus.MESSAGES.value[self.status]
         return resp
 
+    def has_missing_tickets(self) -> bool:
+        """
+        Check without locking whether an orderline has less orderlineitems
+        than its quantity, in a single query
+        """
+        return self.orderlines.annotate(n_orderlineitems=Count('orderlineitems')) \
+                   .filter(quantity__gt=F('n_orderlineitems')) \
+                   .exists()
+
     @transaction.atomic
     def generate_orderlineitems_and_fields(self) -> int:
         """
-        When an order has just been validated, create
-        all the orderlineitems and fields required
-        TODO : add a lock or something, and improve from scripts
+        When an order has just been validated, create in bulk
+        all the orderlineitems and fields still missing,
+        with a constant number of queries per order
+        Return the number of orderlineitems created
         """
-        from .serializers import OrderLineItemSerializer, OrderLineFieldSerializer
+        # Concurrent generations of the same order are serialized
+        list(Order.objects.select_for_update().filter(pk=self.pk).values_list('pk'))
         orderlines = self.orderlines.filter(quantity__gt=0) \
-                         .prefetch_related('item', 'orderlineitems')
-
-        total = 0
-        for orderline in orderlines.all():
-            qte = orderline.quantity - len(orderline.orderlineitems.all())
-            while qte > 0:
-                # Create OrderLineItem
-                orderlineitem = OrderLineItemSerializer(data={
-                    'orderline': orderline.id
+                         .annotate(n_orderlineitems=Count('orderlineitems')) \
+                         .select_related('item') \
+                         .prefetch_related('item__fields')
+
+        orderlineitems, orderlinefields = [], []
+        for orderline in orderlines:
+            missing = orderline.quantity - orderline.n_orderlineitems
+            if missing <= 0:
+                continue
+
+            # Default values only depend on the order, resolve them once per item
+            defaults = [
+                (field.pk, get_field_default_value(field.default, self))
+                for field in orderline.item.fields.all()
+            ]
+            for __ in range(missing):
+                # The uuid is set on instantiation so fields can refer to it before saving
+                orderlineitem = OrderLineItem(orderline=orderline)
+                orderlineitems.append(orderlineitem)
+                orderlinefields.extend(
+                    OrderLineField(orderlineitem=orderlineitem, field_id=field_id,
+                                   value=value)
+                    for field_id, value in defaults
+                )
+
+        OrderLineItem.objects.bulk_create(orderlineitems)
+        OrderLineField.objects.bulk_create(orderlinefields)
+        return len(orderlineitems)
+
+    def get_tickets(self) -> List[dict]:
+        """
+        Get the data printed on each ticket of the order,
+        better with the TICKETS_PREFETCH relations prefetched
+        """
+        tickets = []
+        for orderline in self.orderlines.all():
+            for orderlineitem in orderline.orderlineitems.all():
+                # TODO Add more flexibility
+                # Add Nom et Prénom to orderline
+                first_name = last_name = None
+                for orderlinefield in orderlineitem.orderlinefields.all():
+                    if orderlinefield.field.name == 'Nom':
+                        first_name = orderlinefield.value
+                    elif orderlinefield.field.name == 'Prénom':
+                        last_name = orderlinefield.value
+
+                if first_name is None:
+                    first_name = self.owner.first_name
+                if last_name is None:
+                    last_name = self.owner.last_name
+
+                # Add a ticket with this data
+                tickets.append({
+                    'nom': first_name,
+                    'prenom': last_name,
+                    'qr_data': str(orderlineitem.id).replace('-', ''),
+                    'item': orderline.item,
+                    'uuid': orderlineitem.id,
                 })
-                orderlineitem.is_valid(raise_exception=True)
-                orderlineitem.save()
-
-                # Create OrderLineFields
-                for field in orderline.item.fields.all():
-                    orderlinefield = OrderLineFieldSerializer(data = {
-                        'orderlineitem': orderlineitem.data['id'],
-                        'field': field.id,
-                        'value': get_field_default_value(field.default, self),
-                    })
-                    orderlinefield.is_valid(raise_exception=True)
-                    orderlinefield.save()
+        return tickets
 
-                total += 1
-                qte -= 1
+    def get_rendered_tickets(self, kind: str='pdf', request=None) -> Union[bytes, str]:
+        """
+        Get the tickets of the order rendered as a PDF or as HTML,
+        only rendered again when their content changes
 
-        return total
+        Rendered tickets are stored in TICKETS_DIR so that every worker reads
+        the ones rendered by the others or by the render_tickets job
+        """
+        directory = os.path.join(settings.TICKETS_DIR, str(self.pk))
+        filename = f"{self.get_tickets_version()}.{kind}"
+        path = os.path.join(directory, filename)
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+            return content.decode() if kind == 'html' else content
+        except FileNotFoundError:
+            pass
+
+        prefetch_related_objects([ self ], *self.TICKETS_PREFETCH)
+        tickets = self.get_tickets()
+        if kind == 'html':
+            context = get_tickets_context(tickets, self)
+            content = render_to_string(TICKETS_TEMPLATE, context, request)
+        else:
+            content = render_tickets_pdf(tickets, self)
+
+        # Write then rename so that other workers never read a partial file,
+        # and drop the previous versions of these tickets
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(content.encode() if kind == 'html' else content)
+        os.replace(tmp_path, path)
+        for name in os.listdir(directory):
+            if name != filename and name.endswith(f".{kind}"):
+                with suppress(FileNotFoundError):
+                    os.remove(os.path.join(directory, name))
+        return content
+
+    def get_tickets_version(self) -> str:
+        """
+        Get a short hash of everything printed on the tickets of the order,
+        which changes as soon as a ticket or one of its field values changes
+        """
+        rows = OrderLineItem.objects.filter(orderline__order=self) \
+            .order_by('id', 'orderlinefields__id') \
+            .values_list('id', 'orderline__item__name', 'orderline__item__price',
+                         'orderlinefields__field__name', 'orderlinefields__value')
+        content = (self.sale.name, self.sale.ticket_renderer,
+                   self.owner.first_name, self.owner.last_name, *rows)
+        return hashlib.md5(repr(content).encode()).hexdigest()
+
+    def set_orderlines(self, quantities: Dict[Any, Any],
+                       replace: bool=False) -> List['OrderLine']:
+        """
+        Create, update or delete the orderlines of an ongoing order
+        to match the quantities mapped by item id, with one query per kind of change
+        If replace, the orderlines of the items missing from the quantities
+        are deleted as well
+        Return the orderlines of the requested items that are not empty
+        """
+        from .exceptions import OrderValidationException
+
+        if self.status != OrderStatus.ONGOING.value:
+            raise OrderValidationException("La commande n'accepte plus de changement.",
+                                           'unchangable_order')
+
+        quantities = Item.objects.clean_quantities(self.sale_id, quantities)
+
+        existing = { orderline.item_id: orderline for orderline in self.orderlines.all() }
+        if replace:
+            quantities = { **dict.fromkeys(existing, 0), **quantities }
+        orderlines, to_create, to_update, to_delete = [], [], [], []
+        for item_id, quantity in quantities.items():
+            orderline = existing.get(item_id)
+            if orderline is None:
+                if quantity > 0:
+                    to_create.append(OrderLine(order=self, item_id=item_id,
+                                               quantity=quantity))
+            elif quantity == 0:
+                to_delete.append(orderline.pk)
+            else:
+                if orderline.quantity != quantity:
+                    orderline.quantity = quantity
+                    to_update.append(orderline)
+                orderlines.append(orderline)
+
+        # Ongoing orders don't book items so stock counters are left untouched,
+        # but they hold them to fail early if not enough are left
+        with transaction.atomic():
+            StockHold.objects.hold(self, quantities)
+            if to_delete:
+                OrderLine.objects.filter(pk__in=to_delete).delete()
+            if to_update:
+                OrderLine.objects.bulk_update(to_update, ('quantity',))
+            if to_create:
+                # Primary keys of bulk created rows are only set on PostgreSQL,
+                # so the orderlines are fetched back by item
+                OrderLine.objects.bulk_create(to_create)
+                ordered = [ item_id for item_id, qt in quantities.items() if qt > 0 ]
+                orderlines = OrderLine.objects.filter(order=self, item_id__in=ordered)
+                orderlines = list(orderlines)
+
+        for orderline in orderlines:
+            orderline._reset_tracked_fields()
+        return orderlines
 
     def send_confirmation_mail(self):
         """
@@ -360,7 +699,7 @@ class Order(models.Model):
         link_order = f"http://assos.utc.fr/woolly/commandes/{self.pk}"
         order_list = "".join(f" - {ol.quantity} {ol.item.name}\n" for ol in self.orderlines.all())
         message = (
-            "Bonjour {self.owner.get_full_name()},\n\n"
+            f"Bonjour {self.owner.get_full_name()},\n\n"
             f"Votre commande n°{self.pk} vient d'être confirmée.\n"
             f"Vous avez commandé:\n{order_list}"
             f"Vous pouvez télécharger vos billets ici : {link_order}\n\n"
@@ -376,6 +715,46 @@ class Order(models.Model):
         )
         return email.send()
 
+    def get_lottery_mail(self) -> EmailMessage:
+        """
+        Build the mail announcing to the owner that they won items of a lottery sale
+        """
+        link_order = f"http://assos.utc.fr/woolly/commandes/{self.pk}"
+        order_list = "".join(
+            f" - {ol.quantity} {ol.item.name}\n" for ol in self.orderlines.all()
+        )
+        message = (
+            f"Bonjour {self.owner.get_full_name()},\n\n"
+            f"Vous avez été tiré au sort pour la vente {self.sale.name} !\n"
+            f"Votre commande n°{self.pk} comprend:\n{order_list}"
+            f"Vous pouvez la payer ici : {link_order}\n\n"
+            "Merci d'avoir utilisé Woolly"
+        )
+        return EmailMessage(
+            subject="Woolly - Résultat du tirage au sort",
+            body=message,
+            from_email="woolly@assos.utc.fr",
+            to=[self.owner.email],
+            reply_to=["woolly@assos.utc.fr"],
+        )
+
+    def save(self, *args, **kwargs) -> None:
+        """
+        Save the order and update the stock counters
+        if it enters or leaves the booking statuses,
+        and release its holds once it is not ongoing anymore
+        """
+        was_booking = self.books_items
+        was_ongoing = self.get_saved_value('status') == OrderStatus.ONGOING.value
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if was_booking != self.books_items:
+                sign = 1 if self.books_items else -1
+                StockCounter.objects.add_orderlines(self.orderlines.all(), sign)
+            # Holds are replaced by bookings or released once the order is not ongoing
+            if was_ongoing and self.status != OrderStatus.ONGOING.value:
+                StockHold.objects.filter(order=self).delete()
+
     def __str__(self) -> str:
         return f"N°{self.id} [{self.get_status_display()}] by {self.owner}"
 
@@ -383,7 +762,7 @@ class Order(models.Model):
         ordering = ('-id',)
 
 
-class OrderLine(models.Model):
+class OrderLine(TrackedFieldsModel):
     """
     Links an Order to an Item with a quantity
     """
@@ -391,6 +770,19 @@ class OrderLine(models.Model):
     order    = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='orderlines', editable=False)
     quantity = models.PositiveSmallIntegerField()
 
+    tracked_fields = ('quantity',)
+
+    def save(self, *args, **kwargs) -> None:
+        """
+        Save the orderline and update the stock counters if its order books items
+        """
+        delta = self.quantity - self.get_saved_value('quantity', 0)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if delta and self.order.books_items:
+                row = (self.item_id, self.item.group_id, delta)
+                StockCounter.objects.add(self.order.sale_id, [row])
+
     def __str__(self) -> str:
         return f"{self.id} - {self.quantity} x {self.item.name} (Order {self.order})"
 
@@ -413,6 +805,663 @@ class OrderLineItem(models.Model):
         ordering = ('id',)
 
 
+# --------------------------------------------
+#   Stock
+# --------------------------------------------
+
+StockRow = Tuple[int, int, int]  # (item_id, group_id, quantity)
+StockKey = Tuple[int, int]       # (group_id, item_id)
+
+
+class StockQuantity(namedtuple('StockQuantity', ('total', 'per_item', 'per_group'))):
+    """
+    Quantities of items in total, per item id and per item group id
+    """
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[StockRow]) -> 'StockQuantity':
+        """
+        Build quantities from (item_id, group_id, quantity) rows
+        """
+        total, per_item, per_group = 0, {}, {}
+        for item_id, group_id, quantity in rows:
+            total += quantity
+            per_item[item_id] = per_item.get(item_id, 0) + quantity
+            if group_id is not None:
+                per_group[group_id] = per_group.get(group_id, 0) + quantity
+        return cls(total, per_item, per_group)
+
+    def __add__(self, other: 'StockQuantity') -> 'StockQuantity':
+        per_item, per_group = dict(self.per_item), dict(self.per_group)
+        for key, qt in other.per_item.items():
+            per_item[key] = per_item.get(key, 0) + qt
+        for key, qt in other.per_group.items():
+            per_group[key] = per_group.get(key, 0) + qt
+        return type(self)(self.total + other.total, per_item, per_group)
+
+    def __sub__(self, other: 'StockQuantity') -> 'StockQuantity':
+        return type(self)(
+            self.total - other.total,
+            { key: qt - other.per_item.get(key, 0) for key, qt in self.per_item.items() },
+            {
+                key: qt - other.per_group.get(key, 0)
+                for key, qt in self.per_group.items()
+            },
+        )
+
+
+def get_stock_deltas(rows: Iterable[StockRow]) -> Dict[StockKey, int]:
+    """
+    Get the counters increments from (item_id, group_id, quantity) rows
+    """
+    deltas = defaultdict(int)
+    for item_id, group_id, quantity in rows:
+        deltas[(None, None)] += quantity
+        deltas[(None, item_id)] += quantity
+        if group_id is not None:
+            deltas[(group_id, None)] += quantity
+    return deltas
+
+
+def stock_key_order(key: StockKey) -> tuple:
+    """
+    Sort key of counters, sale first then groups then items
+    """
+    group_id, item_id = key
+    return (item_id is not None, group_id is not None, item_id or 0, group_id or 0)
+
+
+class StockCounterQuerySet(models.QuerySet):
+
+    def increment(self, sale_id: str, deltas: Dict[StockKey, int]) -> None:
+        """
+        Increment the counters of a sale by (group_id, item_id) keys,
+        the (None, None) key being the counter of the whole sale
+        """
+        keys = sorted((key for key in deltas if deltas[key]), key=stock_key_order)
+        if not keys:
+            return
+
+        with transaction.atomic():
+            # Null columns are not unique in the database, so missing counters
+            # are created while holding the sale lock, always taken first
+            counters = self.filter(sale_id=sale_id).values_list('group_id', 'item_id')
+            existing = set(counters)
+            if not existing.issuperset(keys):
+                sale = Sale.objects.select_for_update().filter(pk=sale_id)
+                list(sale.values_list('pk'))
+                existing = set(counters.all())
+
+            # Always update counters in the same order to prevent deadlocks
+            for key in keys:
+                group_id, item_id = key
+                if key in existing:
+                    self.filter(sale_id=sale_id, group_id=group_id, item_id=item_id) \
+                        .update(quantity=F('quantity') + deltas[key])
+                else:
+                    self.create(sale_id=sale_id, group_id=group_id, item_id=item_id,
+                                quantity=deltas[key])
+
+    def add(self, sale_id: str, rows: Iterable[StockRow]) -> None:
+        """
+        Add (item_id, group_id, quantity) rows to the counters of a sale
+        """
+        self.increment(sale_id, get_stock_deltas(rows))
+
+    def add_orderlines(self, orderlines: models.QuerySet, sign: int=1) -> None:
+        """
+        Add (or remove with sign=-1) the quantities of orderlines to the counters
+        """
+        rows_per_sale = defaultdict(list)
+        values = orderlines.values_list('order__sale_id', 'item_id', 'item__group_id',
+                                        'quantity')
+        for sale_id, item_id, group_id, quantity in values:
+            rows_per_sale[sale_id].append((item_id, group_id, sign * quantity))
+
+        with transaction.atomic():
+            for sale_id, rows in rows_per_sale.items():
+                self.add(sale_id, rows)
+
+    def move_item_group(self, item: Item, old_group_id: int=None) -> None:
+        """
+        Move the quantity booked for an item from its old group to its new one
+        """
+        booked = self.filter(item=item).values_list('quantity', flat=True).first()
+        if not booked:
+            return
+
+        deltas = {}
+        if old_group_id is not None:
+            deltas[(old_group_id, None)] = -booked
+        if item.group_id is not None:
+            deltas[(item.group_id, None)] = booked
+        self.increment(item.sale_id, deltas)
+
+    def get_quantity(self, sale: Sale, item_ids: Iterable[int]=(),
+                     group_ids: Iterable[int]=()) -> StockQuantity:
+        """
+        Get the quantities booked on a sale, some of its items and groups
+        """
+        selected = Q(group__isnull=True, item__isnull=True)
+        selected |= Q(item__in=item_ids) | Q(group__in=group_ids)
+        counters = self.filter(sale=sale).filter(selected) \
+                       .values_list('group_id', 'item_id', 'quantity')
+
+        total, per_item, per_group = 0, {}, {}
+        for group_id, item_id, quantity in counters:
+            if item_id is not None:
+                per_item[item_id] = quantity
+            elif group_id is not None:
+                per_group[group_id] = quantity
+            else:
+                total = quantity
+        return StockQuantity(total, per_item, per_group)
+
+    def rebuild(self, sales: Iterable[Sale]=None) -> int:
+        """
+        Recompute the counters from the orderlines of booking orders
+        Return the number of counters created
+        """
+        orderlines = OrderLine.objects \
+            .filter(order__status__in=OrderStatus.BOOKING_LIST.value) \
+            .values_list('order__sale_id', 'item_id', 'item__group_id') \
+            .annotate(quantity=Sum('quantity'))
+        counters = self
+        if sales is not None:
+            orderlines = orderlines.filter(order__sale__in=sales)
+            counters = counters.filter(sale__in=sales)
+
+        rows_per_sale = defaultdict(list)
+        for sale_id, item_id, group_id, quantity in orderlines:
+            rows_per_sale[sale_id].append((item_id, group_id, quantity))
+
+        with transaction.atomic():
+            counters.delete()
+            return len(self.bulk_create(
+                StockCounter(sale_id=sale_id, group_id=group_id, item_id=item_id,
+                             quantity=quantity)
+                for sale_id, rows in rows_per_sale.items()
+                for (group_id, item_id), quantity in get_stock_deltas(rows).items()
+            ))
+
+
+class StockCounter(models.Model):
+    """
+    Materialized quantity of items booked on a sale, an item group or an item
+    Maintained each time an order enters or leaves the booking statuses
+    and each time an orderline is deleted, directly, in bulk or in cascade
+
+    Updating booking orders or orderlines with QuerySet.update, bulk_update
+    or bulk_create bypasses the counters, which must then be recomputed
+    with the rebuild_stock_counters command
+
+    Only one of item or group is set, none of them for the whole sale counter
+    """
+    sale  = models.ForeignKey(Sale, on_delete=models.CASCADE,
+                              related_name='stockcounters', editable=False)
+    group = models.ForeignKey(ItemGroup, on_delete=models.CASCADE,
+                              related_name='stockcounters', blank=True, null=True,
+                              editable=False)
+    item  = models.ForeignKey(Item, on_delete=models.CASCADE,
+                              related_name='stockcounters', blank=True, null=True,
+                              editable=False)
+    quantity = models.IntegerField(default=0)
+
+    objects = StockCounterQuerySet.as_manager()
+
+    def __str__(self) -> str:
+        target = self.item or self.group or self.sale
+        return f"{self.quantity} booked on {target}"
+
+    class Meta:
+        unique_together = ('sale', 'group', 'item')
+
+
+@receiver(pre_delete, sender=OrderLine)
+def release_deleted_orderline(sender, instance: OrderLine, **kwargs) -> None:
+    """
+    Remove the quantity of a deleted orderline from the counters if its order books items
+    Sent for every orderline deleted by the admin, QuerySet.delete
+    or in cascade of its order, item, sale or owner, while they still exist
+    """
+    orderlines = OrderLine.objects.filter(pk=instance.pk) \
+        .filter(order__status__in=OrderStatus.BOOKING_LIST.value)
+    StockCounter.objects.add_orderlines(orderlines, -1)
+
+
+class StockHoldQuerySet(models.QuerySet):
+
+    def active(self, now=None) -> models.QuerySet:
+        """
+        Filter the holds that have not expired yet
+        """
+        return self.filter(expires_at__gt=now or timezone.now())
+
+    def get_quantity(self, sale: Sale, exclude_order: 'Order'=None) -> StockQuantity:
+        """
+        Get the quantities held by the ongoing orders of a sale
+        """
+        holds = self.active().filter(order__sale=sale)
+        if exclude_order is not None:
+            holds = holds.exclude(order=exclude_order)
+        return StockQuantity.from_rows(
+            holds.values_list('item_id', 'item__group_id').annotate(total=Sum('quantity'))
+        )
+
+    def hold(self, order: 'Order', quantities: Dict[int, int]) -> None:
+        """
+        Hold the quantities of items mapped by id for an ongoing order
+        until the order expires, replacing its previous holds on these items
+
+        The sale is locked until the end of the transaction, so that holds
+        are checked against the bookings and the holds of other orders
+        atomically. Raise if not enough items are left for an increase,
+        or if the items of the sale are drawn by lottery.
+        """
+        from .exceptions import OrderValidationException
+
+        with transaction.atomic():
+            sale = Sale.objects.select_for_update().get(pk=order.sale_id)
+            # Items of lottery sales are only ordered by the draw
+            if sale.is_lottery and any(qt > 0 for qt in quantities.values()):
+                raise OrderValidationException(
+                    "Les articles de cette vente sont tirés au sort.", 'lottery_sale')
+            previous = dict(self.filter(order=order).values_list('item_id', 'quantity'))
+            increased = {
+                item_id for item_id, qt in quantities.items()
+                if qt > previous.get(item_id, 0)
+            }
+
+            if increased:
+                wanted = { **previous, **quantities }
+                items = Item.objects.filter(pk__in=wanted).select_related('group')
+                items = { item.pk: item for item in items }
+                groups = {
+                    item.group_id: item.group for item in items.values() if item.group_id
+                }
+                order_qt = StockQuantity.from_rows(
+                    (item_id, items[item_id].group_id, qt)
+                    for item_id, qt in wanted.items()
+                )
+                booked_qt = StockCounter.objects.get_quantity(sale, items, groups)
+                others_qt = booked_qt + self.get_quantity(sale, exclude_order=order)
+
+                def exceeds(limit: int, others: int, qt: int) -> bool:
+                    return type(limit) is int and limit > 0 and others + qt > limit
+
+                errors = []
+                if exceeds(sale.max_item_quantity, others_qt.total, order_qt.total):
+                    errors.append("Il ne reste pas assez d'articles pour cette vente.")
+                for item_id in sorted(increased):
+                    item = items[item_id]
+                    if exceeds(item.quantity, others_qt.per_item.get(item_id, 0),
+                               order_qt.per_item[item_id]):
+                        errors.append(f"Il ne reste pas assez de {item.name}.")
+                increased_groups = { items[item_id].group_id for item_id in increased }
+                increased_groups.discard(None)
+                for group_id in sorted(increased_groups):
+                    group = groups[group_id]
+                    if exceeds(group.quantity, others_qt.per_group.get(group_id, 0),
+                               order_qt.per_group[group_id]):
+                        errors.append(f"Il ne reste pas assez de {group.name}.")
+                if errors:
+                    raise OrderValidationException(errors[0], 'not_enough_items',
+                                                   details=errors)
+
+            expires_at = order.created_at + settings.MAX_ONGOING_TIME
+            self.filter(order=order, item__in=quantities).delete()
+            self.bulk_create(
+                StockHold(order=order, item_id=item_id, quantity=qt,
+                          expires_at=expires_at)
+                for item_id, qt in quantities.items()
+                if qt > 0
+            )
+
+
+class StockHold(models.Model):
+    """
+    Quantity of an item temporarily held by an ongoing order,
+    until the order is paid, cancelled or expires
+    """
+    order = models.ForeignKey(Order, on_delete=models.CASCADE,
+                              related_name='holds', editable=False)
+    item  = models.ForeignKey(Item, on_delete=models.CASCADE,
+                              related_name='holds', editable=False)
+    quantity   = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = StockHoldQuerySet.as_manager()
+
+    def __str__(self) -> str:
+        return f"{self.quantity} x {self.item} held by order {self.order_id}"
+
+    class Meta:
+        unique_together = ('order', 'item')
+
+
+class AdmissionTicket(models.Model):
+    """
+    Place of a user in the admission queue of a sale,
+    admitted to the checkout until it is released or expires
+    """
+    sale = models.ForeignKey(Sale, on_delete=models.CASCADE,
+                             related_name='admission_tickets', editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='admission_tickets', editable=False)
+    created_at  = models.DateTimeField(auto_now_add=True, editable=False)
+    admitted_at = models.DateTimeField(blank=True, null=True)
+    expires_at  = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    @property
+    def is_admitted(self) -> bool:
+        return self.admitted_at is not None
+
+    def __str__(self) -> str:
+        state = "admitted" if self.is_admitted else "waiting"
+        return f"{self.user} {state} for {self.sale}"
+
+    class Meta:
+        ordering = ('id',)
+        unique_together = ('sale', 'user')
+
+
+# --------------------------------------------
+#   Lottery
+# --------------------------------------------
+
+class PurchaseIntentQuerySet(models.QuerySet):
+
+    def register(self, sale: Sale, user: User,
+                 quantities: Dict[Any, Any]) -> List['PurchaseIntent']:
+        """
+        Replace the purchase intents of a user on a lottery sale
+        with the quantities mapped by item id, during its registration
+        Return the intents that are not empty
+        """
+        from .exceptions import OrderValidationException
+
+        now = timezone.now()
+        if not sale.is_lottery:
+            raise OrderValidationException("Cette vente n'est pas tirée au sort.",
+                                           'not_lottery_sale')
+        if not (sale.is_active and sale.begin_at <= now <= sale.registration_end_at):
+            raise OrderValidationException(
+                "Les inscriptions au tirage au sort sont fermées.",
+                'lottery_registration_closed')
+
+        quantities = Item.objects.clean_quantities(sale.pk, quantities)
+        items = Item.objects.filter(pk__in=quantities).select_related('usertype')
+        owner = user.get_with_api_data()
+        for item in items:
+            if quantities[item.pk] and not item.usertype.check_user(owner):
+                raise OrderValidationException(
+                    f"L'article {item.name} est réservé à {item.usertype.name}",
+                    'item_not_allowed')
+
+        with transaction.atomic():
+            self.filter(sale=sale, owner=user).delete()
+            return self.bulk_create(
+                PurchaseIntent(sale=sale, owner=user, item_id=item_id, quantity=quantity)
+                for item_id, quantity in quantities.items()
+                if quantity > 0
+            )
+
+    def draw(self, sale: Sale, seed: Any=None) -> List['Order']:
+        """
+        Allocate the items of a lottery sale among the undrawn intents,
+        owners being drawn in random order and served as much as the sale,
+        item and group quantities and the max per user allow
+
+        Orders of the winners are created in bulk awaiting validation,
+        so that they book their items until they are paid,
+        and winners are notified once the transaction is committed
+        Return the created orders
+        """
+        rng = random.Random(seed)
+        with transaction.atomic():
+            sale = Sale.objects.select_for_update().get(pk=sale.pk)
+            intents = list(self.filter(sale=sale, allocated__isnull=True)
+                               .select_related('owner', 'item__group', 'item__usertype')
+                               .order_by('owner_id', 'item_id'))
+            if not intents:
+                return []
+
+            intents_per_owner = defaultdict(list)
+            for intent in intents:
+                intents_per_owner[intent.owner_id].append(intent)
+            items = { intent.item_id: intent.item for intent in intents }
+            groups = {
+                item.group_id: item.group for item in items.values() if item.group_id
+            }
+
+            # Quantities already booked on the sale and by each owner
+            booked = StockCounter.objects.get_quantity(sale, items, groups)
+            owner_rows = defaultdict(list)
+            user_orderlines = OrderLine.objects \
+                .filter(order__sale=sale) \
+                .filter(order__status__in=OrderStatus.BOOKING_LIST.value) \
+                .filter(order__owner__in=intents_per_owner) \
+                .values_list('order__owner_id', 'item_id', 'item__group_id', 'quantity')
+            for owner_id, *row in user_orderlines:
+                owner_rows[owner_id].append(row)
+
+            def left(limit: int, used: int) -> float:
+                return limit - used if type(limit) is int and limit > 0 else math.inf
+
+            owner_ids = sorted(intents_per_owner, key=str)
+            rng.shuffle(owner_ids)
+            orders, rows_per_owner = [], {}
+            for owner_id in owner_ids:
+                user = intents_per_owner[owner_id][0].owner
+                owner = user.get_with_api_data()
+                owner_qt = StockQuantity.from_rows(owner_rows[owner_id])
+                rows = []
+                for intent in intents_per_owner[owner_id]:
+                    item = intent.item
+                    quantity = 0
+                    if item.is_active and item.usertype.check_user(owner):
+                        quantity = min(
+                            intent.quantity,
+                            left(sale.max_item_quantity, booked.total),
+                            left(item.quantity, booked.per_item.get(item.pk, 0)),
+                            left(item.max_per_user, owner_qt.per_item.get(item.pk, 0)),
+                        )
+                        if item.group_id is not None:
+                            group_booked = booked.per_group.get(item.group_id, 0)
+                            group_owned = owner_qt.per_group.get(item.group_id, 0)
+                            quantity = min(
+                                quantity,
+                                left(item.group.quantity, group_booked),
+                                left(item.group.max_per_user, group_owned),
+                            )
+                    intent.allocated = max(int(quantity), 0)
+                    if intent.allocated:
+                        row = (item.pk, item.group_id, intent.allocated)
+                        allocated = StockQuantity.from_rows([ row ])
+                        booked, owner_qt = booked + allocated, owner_qt + allocated
+                        rows.append(row)
+
+                if rows:
+                    orders.append(Order(sale=sale, owner=user,
+                                        status=OrderStatus.AWAITING_VALIDATION.value))
+                    rows_per_owner[owner_id] = rows
+
+            # Create the orders of the winners and book their items
+            # Primary keys of bulk created rows are only set on PostgreSQL,
+            # so the orders are fetched back, the latest awaiting validation
+            # of each winner on the locked sale
+            Order.objects.bulk_create(orders)
+            order_ids = dict(
+                Order.objects.filter(sale=sale, owner__in=rows_per_owner,
+                                     status=OrderStatus.AWAITING_VALIDATION.value)
+                             .order_by().values_list('owner_id').annotate(Max('pk'))
+            )
+            orders = Order.objects.filter(pk__in=order_ids.values())
+            orders = list(orders.select_related('sale', 'owner'))
+            OrderLine.objects.bulk_create(
+                OrderLine(order_id=order_ids[owner_id], item_id=item_id,
+                          quantity=quantity)
+                for owner_id, rows in rows_per_owner.items()
+                for item_id, __, quantity in rows
+            )
+            StockCounter.objects.add(sale.pk, (
+                row for rows in rows_per_owner.values() for row in rows
+            ))
+            for intent in intents:
+                intent.order_id = None
+                if intent.allocated:
+                    intent.order_id = order_ids.get(intent.owner_id)
+            self.bulk_update(intents, ('allocated', 'order'))
+
+            messages = [ order.get_lottery_mail() for order in orders ]
+            transaction.on_commit(lambda: get_connection().send_messages(messages))
+        return orders
+
+
+class PurchaseIntent(models.Model):
+    """
+    Quantity of an item that a user wishes to buy on a lottery sale
+    Once drawn, the allocated quantity is ordered in the attached order
+    """
+    sale  = models.ForeignKey(Sale, on_delete=models.CASCADE,
+                              related_name='intents', editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE,
+                              related_name='intents', editable=False)
+    item  = models.ForeignKey(Item, on_delete=models.CASCADE,
+                              related_name='intents', editable=False)
+    quantity  = models.PositiveSmallIntegerField()
+    allocated = models.PositiveSmallIntegerField(blank=True, null=True, default=None)
+    order     = models.ForeignKey(Order, on_delete=models.SET_NULL,
+                                  related_name='intents', blank=True, null=True,
+                                  editable=False)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    objects = PurchaseIntentQuerySet.as_manager()
+
+    def __str__(self) -> str:
+        return f"{self.quantity} x {self.item.name} wished by {self.owner}"
+
+    class Meta:
+        ordering = ('id',)
+        unique_together = ('owner', 'item')
+
+
+# --------------------------------------------
+#   Jobs
+# --------------------------------------------
+
+JOB_STATUSES = (
+    ('pending', "En attente"),
+    ('running', "En cours"),
+    ('done', "Terminé"),
+    ('failed', "Échoué"),
+)
+
+# Work done once an order is paid, in this order
+POST_PAYMENT_JOBS = ('generate_tickets', 'render_tickets', 'send_confirmation_mail')
+
+
+class JobQuerySet(models.QuerySet):
+
+    def enqueue(self, name: str, order: Order, run_at=None) -> 'Job':
+        """
+        Schedule a job on an order, only once per order thanks to its key
+        """
+        job, __ = self.get_or_create(key=f"{name}/{order.pk}", defaults={
+            'name': name,
+            'order': order,
+            'run_at': run_at or timezone.now(),
+        })
+        return job
+
+    def enqueue_post_payment(self, order: Order) -> List['Job']:
+        return [ self.enqueue(name, order) for name in POST_PAYMENT_JOBS ]
+
+    def claim(self, limit: int=10) -> List['Job']:
+        """
+        Take the jobs due to run, and the running ones whose worker stopped answering,
+        so that concurrent workers never claim the same jobs
+        """
+        now = timezone.now()
+        due = Q(status='pending', run_at__lte=now)
+        due |= Q(status='running', locked_until__lt=now)
+        with transaction.atomic():
+            jobs = list(
+                self.select_for_update(skip_locked=True)
+                    .filter(due)
+                    .order_by('run_at', 'id')[:limit]
+            )
+            for job in jobs:
+                job.status = 'running'
+                job.attempts += 1
+                job.locked_until = now + settings.JOB_LOCK_TIMEOUT
+            self.bulk_update(jobs, ('status', 'attempts', 'locked_until'))
+        return jobs
+
+    def run_pending(self, limit: int=10) -> int:
+        """
+        Claim and run the jobs due to run
+        Return the number of jobs run, successfully or not
+        """
+        jobs = self.claim(limit)
+        for job in jobs:
+            job.run()
+        return len(jobs)
+
+
+class Job(models.Model):
+    """
+    Work run out of the request path by the run_jobs command,
+    retried with an exponential backoff until it succeeds or runs out of attempts
+    """
+    key    = models.CharField(max_length=128, unique=True, editable=False)
+    name   = models.CharField(max_length=64, editable=False)
+    order  = models.ForeignKey(Order, on_delete=models.CASCADE,
+                               related_name='jobs', editable=False)
+    status = models.CharField(max_length=8, choices=JOB_STATUSES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error  = models.TextField(blank=True, default='')
+
+    created_at   = models.DateTimeField(auto_now_add=True, editable=False)
+    run_at       = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(blank=True, null=True)
+
+    objects = JobQuerySet.as_manager()
+
+    def run(self) -> bool:
+        """
+        Run the job and schedule a retry if it fails
+        Return whether it succeeded
+        """
+        from .jobs import JOB_HANDLERS
+        try:
+            with timed(f"job.{self.name}"):
+                JOB_HANDLERS[self.name](self.order)
+        except Exception as error:
+            self.error = f"{type(error).__name__}: {error}"
+            if self.attempts >= settings.JOB_MAX_ATTEMPTS:
+                self.status = 'failed'
+            else:
+                self.status = 'pending'
+                delay = settings.JOB_RETRY_DELAY * 2 ** (self.attempts - 1)
+                self.run_at = timezone.now() + delay
+        else:
+            self.status = 'done'
+            self.error = ''
+        self.locked_until = None
+        self.save(update_fields=('status', 'error', 'run_at', 'locked_until'))
+        return self.status == 'done'
+
+    def __str__(self) -> str:
+        return f"{self.name} of order {self.order_id} ({self.status})"
+
+    class Meta:
+        ordering = ('run_at', 'id')
+        indexes = [
+            models.Index(fields=('status', 'run_at')),
+        ]
+
+
 # --------------------------------------------
 #   Fields
 # --------------------------------------------
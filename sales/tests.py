@@ -1,11 +1,38 @@
+from typing import Tuple
+from unittest.mock import patch
+import tempfile
+import zipfile
+import base64
+import uuid
+import csv
+import io
+import os
+
+from PIL import Image
+from PyPDF2 import PdfReader
+from qrcode import QRCode
+from qrcode.constants import ERROR_CORRECT_Q
+
+from django.conf import settings
+from django.utils import timezone
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
 from django.test import tag
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
+from rest_framework.test import APITestCase, APITransactionTestCase
 
+from core.faker import FakeModelFactory
+from core.utils import render_to_pdf, draw_tickets_pdf
+from core.qrcodes import QRCodeEngine
 from core.testcases import APIModelViewSetTestCase, ModelViewSetTestCase, get_permissions_from_compact
-from authentication.models import User
+from authentication.models import User, UserType
 from sales.models import (
     Association, Sale, ItemGroup, Item, OrderStatus, Order, OrderLine,
-    Field, ItemField, OrderLineItem, OrderLineField
+    StockHold, PurchaseIntent, Field, ItemField, OrderLineItem, OrderLineField,
+    Job, POST_PAYMENT_JOBS,
 )
 
 
@@ -59,6 +86,62 @@ class ItemViewSetTestCase(ModelViewSetTestCase):
     model = Item
     permissions = ManagerOrReadOnly
 
+    def _list_items(self, sale: Sale) -> Tuple[int, list]:
+        """
+        Helper to list the items of a sale and count the queries run
+        """
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f"/sales/{sale.pk}/items")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries), response.data['results']
+
+    def test_list_quantities(self):
+        """
+        Items quantities must be computed in a constant number of queries
+        """
+        sale = self.factory.create(Sale)
+        items = [ self.factory.create(Item, sale=sale, quantity=10) ]
+        num_queries, __ = self._list_items(sale)
+
+        items += [ self.factory.create(Item, sale=sale, quantity=10) for __ in range(4) ]
+        for i, item in enumerate(items):
+            for status_value in (OrderStatus.PAID.value, OrderStatus.CANCELLED.value):
+                order = self.factory.create(Order, sale=sale, status=status_value)
+                self.factory.create(OrderLine, order=order, item=item, quantity=i + 1)
+
+        num_queries_more, data = self._list_items(sale)
+        self.assertEqual(num_queries_more, num_queries)
+        quantities = {
+            item['id']: (item['quantity_sold'], item['quantity_left']) for item in data
+        }
+        self.assertEqual(quantities, {
+            item.pk: (i + 1, item.quantity - i - 1) for i, item in enumerate(items)
+        })
+
+    def test_payment_synch(self):
+        """
+        Items must only be synched when the payment system needs it
+        """
+        with patch('payment.services.fake.FakePaymentService.synch_item') as synch_item:
+            item = self.factory.create(Item, nemopay_id='1')
+            self.assertEqual(synch_item.call_count, 1)
+
+            item.description = "Changed description"
+            item.quantity = 42
+            item.is_active = not item.is_active
+            item.group = self.factory.create(ItemGroup)
+            item.save()
+            self.assertEqual(synch_item.call_count, 1)
+
+            for field, value in (('name', "New name"), ('price', item.price + 1)):
+                setattr(item, field, value)
+                item.save()
+            self.assertEqual(synch_item.call_count, 3)
+
+            item = Item.objects.get(pk=item.pk)
+            item.save()
+            self.assertEqual(synch_item.call_count, 3)
+
 
 # --------------------------------------------
 #   Orders
@@ -138,6 +221,545 @@ class OrderViewSetTestCase(ModelViewSetTestCase):
                 self.assertEqual(resp['tickets_generated'], generate, f"Different tickets_generated {tr}")
 
 
+@tag('order')
+class OrderExpiryTestCase(APITestCase):
+
+    factory = FakeModelFactory()
+
+    def test_expire_orders(self):
+        """
+        Overdue orders must be expired and release their items
+        """
+        sale = self.factory.create(Sale)
+        item = self.factory.create(Item, sale=sale, group=None)
+        long_ago = timezone.now() - settings.MAX_VALIDATION_TIME
+        long_ago -= timezone.timedelta(days=1)
+
+        def create_order(status: OrderStatus, quantity: int, overdue: bool,
+                         tra_id: int=None) -> Order:
+            order = self.factory.create(Order, sale=sale, status=status.value,
+                                        tra_id=tra_id)
+            self.factory.create(OrderLine, order=order, item=item, quantity=quantity)
+            if overdue:
+                Order.objects.filter(pk=order.pk).update(created_at=long_ago)
+            return order
+
+        orders = {
+            create_order(OrderStatus.ONGOING, 1, True): OrderStatus.EXPIRED,
+            create_order(OrderStatus.ONGOING, 1, False): OrderStatus.ONGOING,
+            create_order(OrderStatus.AWAITING_PAYMENT, 2, True): OrderStatus.EXPIRED,
+            create_order(OrderStatus.AWAITING_PAYMENT, 4, False):
+                OrderStatus.AWAITING_PAYMENT,
+            # Its transaction may still be paid, it is left to reconcile_orders
+            create_order(OrderStatus.AWAITING_PAYMENT, 32, True, tra_id=1):
+                OrderStatus.AWAITING_PAYMENT,
+            create_order(OrderStatus.AWAITING_VALIDATION, 8, True): OrderStatus.EXPIRED,
+            create_order(OrderStatus.PAID, 16, True): OrderStatus.PAID,
+        }
+        self.assertEqual(item.quantity_sold(), 2 + 4 + 8 + 16 + 32)
+
+        output = call_command('expire_orders', stdout=io.StringIO())
+        self.assertTrue(output.startswith("Expired 3 orders"), output)
+        for order, order_status in orders.items():
+            order.refresh_from_db()
+            self.assertEqual(order.status, order_status.value)
+        self.assertEqual(item.quantity_sold(), 4 + 16 + 32)
+
+        # Nothing left to expire
+        self.assertEqual(sum(Order.objects.expire_overdue().values()), 0)
+
+
+def use_temporary_tickets_dir(testcase) -> None:
+    """
+    Store the tickets rendered during a test in a temporary directory
+    """
+    directory = tempfile.TemporaryDirectory()
+    testcase.addCleanup(directory.cleanup)
+    override = testcase.settings(TICKETS_DIR=directory.name)
+    override.enable()
+    testcase.addCleanup(override.disable)
+
+
+@tag('order', 'tickets')
+class OrderTicketsTestCase(APITestCase):
+
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        use_temporary_tickets_dir(self)
+
+    def test_generate_orderlineitems_and_fields(self):
+        """
+        Missing tickets and their fields must be created in a constant number of queries
+        """
+        sale = self.factory.create(Sale)
+        owner = self.factory.create(User, first_name='Alice')
+        items = self.factory.create(Item, nb=2, sale=sale, group=None)
+        for default in ('owner.first_name', 'fixed'):
+            field = self.factory.create(Field, default=default)
+            self.factory.create(ItemField, item=items[0], field=field)
+
+        def create_order(quantities: Tuple[int, int]) -> Order:
+            order = self.factory.create(Order, sale=sale, owner=owner,
+                                        status=OrderStatus.PAID.value)
+            for item, quantity in zip(items, quantities):
+                self.factory.create(OrderLine, order=order, item=item, quantity=quantity)
+            return Order.objects.get(pk=order.pk)
+
+        # Same number of queries whatever the number of tickets
+        small_order = create_order((1, 0))
+        with CaptureQueriesContext(connection) as small_queries:
+            self.assertEqual(small_order.generate_orderlineitems_and_fields(), 1)
+        order = create_order((10, 3))
+        existing = self.factory.create(OrderLineItem,
+                                       orderline=order.orderlines.get(item=items[0]))
+        self.assertTrue(order.has_missing_tickets())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(order.generate_orderlineitems_and_fields(), 12)
+        self.assertEqual(len(queries), len(small_queries))
+
+        orderlineitems = OrderLineItem.objects.filter(orderline__order=order)
+        self.assertEqual(orderlineitems.filter(orderline__item=items[0]).count(), 10)
+        self.assertEqual(orderlineitems.filter(orderline__item=items[1]).count(), 3)
+        values = OrderLineField.objects.filter(orderlineitem__orderline__order=order) \
+                                       .values_list('orderlineitem', 'value')
+        self.assertEqual(len(values), 2 * 9)
+        self.assertNotIn(existing.pk, { orderlineitem for orderlineitem, __ in values })
+        self.assertEqual(sorted({ value for __, value in values }), [ 'Alice', 'fixed' ])
+
+        # Nothing left to generate
+        self.assertFalse(order.has_missing_tickets())
+        self.assertEqual(order.generate_orderlineitems_and_fields(), 0)
+
+    def test_tickets_cache(self):
+        """
+        Tickets must only be rendered again when their content changes
+        """
+        owner = self.factory.create(User, is_admin=True)
+        order = self.factory.create(Order, owner=owner, status=OrderStatus.PAID.value)
+        item = self.factory.create(Item, sale=order.sale, group=None)
+        field = self.factory.create(Field, default='fixed')
+        self.factory.create(ItemField, item=item, field=field)
+        self.factory.create(OrderLine, order=order, item=item, quantity=2)
+        order.generate_orderlineitems_and_fields()
+        self.client.force_authenticate(user=owner)
+
+        # Downloads of generated tickets do not lock the order to generate them
+        generate_patch = patch.object(Order, 'generate_orderlineitems_and_fields')
+        render_patch = patch('core.utils.render_to_pdf', wraps=render_to_pdf)
+        with generate_patch as generate, render_patch as render:
+            for __ in range(3):
+                resp = self.client.get(f"/orders/{order.pk}/pdf")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp['Content-Type'], 'application/pdf')
+                self.assertTrue(resp.content.startswith(b'%PDF'))
+            self.assertEqual(render.call_count, 1)
+
+            # Any change on the tickets renders them again
+            OrderLineField.objects.filter(orderlineitem__orderline__order=order) \
+                                  .update(value='new')
+            resp = self.client.get(f"/orders/{order.pk}/pdf")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(render.call_count, 2)
+            generate.assert_not_called()
+
+        # Only the last version is kept on disk, where every worker finds it
+        directory = os.path.join(settings.TICKETS_DIR, str(order.pk))
+        self.assertEqual(os.listdir(directory), [ f"{order.get_tickets_version()}.pdf" ])
+
+        html = self.client.get(f"/orders/{order.pk}/pdf?type=html")
+        self.assertEqual(html.status_code, 200)
+        self.assertContains(html, str(order.orderlines.get().orderlineitems.first().pk))
+
+    def test_qrcode_engine(self):
+        """
+        QR codes must match the qrcode library and be cached in a bounded LRU
+        """
+        engine = QRCodeEngine(maxsize=4)
+        payload = uuid.uuid4().hex
+        qr_code = QRCode(error_correction=ERROR_CORRECT_Q, box_size=8, border=2)
+        qr_code.add_data(payload)
+        qr_code.make(fit=True)
+        expected = qr_code.make_image().get_image().convert('1')
+
+        image = Image.open(io.BytesIO(base64.b64decode(engine.get_png(payload))))
+        self.assertEqual(image.size, expected.size)
+        self.assertEqual(list(image.convert('1').getdata()), list(expected.getdata()))
+
+        # Outputs are built from the cached modules
+        svg = engine.get_svg(payload)
+        self.assertTrue(svg.startswith('<svg'))
+        self.assertEqual(engine.cache.misses, 3)
+        self.assertEqual(engine.batch([ payload ] * 3, 'svg'), [ svg ] * 3)
+        self.assertEqual(engine.cache.hits, 4)
+        with self.assertRaises(ValueError):
+            engine.batch([ payload ], 'gif')
+
+        # Least recently used values are evicted first
+        for __ in range(3):
+            engine.get_runs(uuid.uuid4().hex)
+        self.assertEqual(len(engine.cache), 4)
+        self.assertNotIn(('runs', payload), engine.cache.values)
+        self.assertIn(('svg', payload), engine.cache.values)
+
+    def test_canvas_renderer(self):
+        """
+        Sales can draw their tickets straight onto the PDF canvas
+        """
+        owner = self.factory.create(User, is_admin=True)
+        sale = self.factory.create(Sale, ticket_renderer='canvas')
+        order = self.factory.create(Order, owner=owner, sale=sale,
+                                    status=OrderStatus.PAID.value)
+        self.factory.create(OrderLine, order=order, quantity=5,
+                            item=self.factory.create(Item, sale=sale, group=None))
+        order.generate_orderlineitems_and_fields()
+        self.client.force_authenticate(user=owner)
+
+        draw_patch = patch('core.utils.draw_tickets_pdf', wraps=draw_tickets_pdf)
+        with patch('core.utils.render_to_pdf') as render, draw_patch as draw:
+            resp = self.client.get(f"/orders/{order.pk}/pdf?download=true")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content.startswith(b'%PDF'))
+        self.assertIn('attachment', resp['Content-Disposition'])
+        render.assert_not_called()
+        self.assertEqual(len(draw.call_args[0][0]), 5)
+
+
+@tag('order', 'tickets')
+class ExportTicketsTestCase(APITransactionTestCase):
+
+    factory = FakeModelFactory()
+
+    def test_export_tickets(self):
+        """
+        All the tickets of the validated orders of a sale must be exported
+        """
+        sale = self.factory.create(Sale, ticket_renderer='canvas')
+        item = self.factory.create(Item, sale=sale, group=None)
+        orders = {}
+        quantities = (
+            (2, OrderStatus.PAID), (5, OrderStatus.VALIDATED),
+            (1, OrderStatus.PAID), (3, OrderStatus.AWAITING_PAYMENT),
+        )
+        for quantity, order_status in quantities:
+            order = self.factory.create(Order, sale=sale, status=order_status.value)
+            self.factory.create(OrderLine, order=order, item=item, quantity=quantity)
+            order.generate_orderlineitems_and_fields()
+            is_validated = order_status.value in OrderStatus.VALIDATED_LIST.value
+            orders[order.pk] = quantity if is_validated else None
+
+        # Paid order whose tickets are not generated yet
+        pending_order = self.factory.create(Order, sale=sale,
+                                            status=OrderStatus.PAID.value)
+        self.factory.create(OrderLine, order=pending_order, item=item, quantity=1)
+        orders[pending_order.pk] = 0
+
+        with tempfile.TemporaryDirectory() as folder:
+            # Zip of one PDF per order with a manifest listing the orders without tickets
+            output = os.path.join(folder, 'tickets.zip')
+            stderr = io.StringIO()
+            result = call_command('export_tickets', sale.pk, output=output, workers=2,
+                                  stdout=io.StringIO(), stderr=stderr)
+            self.assertTrue(result.startswith("Exported 8 tickets of 3 orders"), result)
+            self.assertIn("1 orders without tickets yet, "
+                          f"not exported: {pending_order.pk}", stderr.getvalue())
+            with zipfile.ZipFile(output) as archive:
+                manifest = archive.read('orders.csv').decode()
+                manifest = list(csv.DictReader(io.StringIO(manifest)))
+                exported = {
+                    int(row['order_id']): int(row['tickets']) for row in manifest
+                }
+                expected = { pk: n for pk, n in orders.items() if n is not None }
+                self.assertEqual(exported, expected)
+                for row in manifest:
+                    if row['filename']:
+                        self.assertTrue(archive.read(row['filename']).startswith(b'%PDF'))
+
+            # Merged PDF, with 4 tickets per page
+            output = os.path.join(folder, 'tickets.pdf')
+            call_command('export_tickets', sale.pk, format='pdf', output=output,
+                         workers=2, stdout=io.StringIO(), stderr=io.StringIO())
+            self.assertEqual(len(PdfReader(output).pages), 1 + 2 + 1)
+
+            # Merged PDFs in parts of at most 2 orders
+            result = call_command('export_tickets', sale.pk, format='pdf', output=output,
+                                  workers=2, batch_size=2,
+                                  stdout=io.StringIO(), stderr=io.StringIO())
+            self.assertTrue(result.startswith("Exported 8 tickets of 3 orders"), result)
+            parts = [ os.path.join(folder, f"tickets_00{part}.pdf") for part in (1, 2) ]
+            n_pages = [ len(PdfReader(part).pages) for part in parts ]
+            self.assertEqual(n_pages, [ 1 + 2, 1 ])
+
+
+@tag('order', 'jobs')
+class JobTestCase(APITestCase):
+
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        cache.clear()
+        use_temporary_tickets_dir(self)
+        self.order = self.factory.create(Order, status=OrderStatus.AWAITING_PAYMENT.value)
+        item = self.factory.create(Item, sale=self.order.sale, group=None)
+        self.factory.create(OrderLine, order=self.order, item=item, quantity=2)
+
+    def test_post_payment_jobs(self):
+        """
+        Paid orders must get their tickets and confirmation mail from jobs scheduled once
+        """
+        with transaction.atomic():
+            resp = self.order.update_status(OrderStatus.PAID)
+        self.assertTrue(resp['tickets_generated'])
+        self.assertFalse(OrderLineItem.objects.exists())
+        self.assertEqual(sorted(self.order.jobs.values_list('name', flat=True)),
+                         sorted(POST_PAYMENT_JOBS))
+
+        # Tickets downloaded before the jobs ran are generated on the fly
+        owner = self.order.owner
+        owner.is_admin = True
+        owner.save()
+        self.client.force_authenticate(user=owner)
+        resp = self.client.get(f"/orders/{self.order.pk}/pdf?type=html")
+        self.assertEqual(resp.status_code, 200)
+        orderlineitems = OrderLineItem.objects.filter(orderline__order=self.order)
+        self.assertEqual(orderlineitems.count(), 2)
+        self.assertContains(resp, str(orderlineitems.first().pk))
+
+        # Jobs are scheduled only once per order
+        with transaction.atomic():
+            resp = self.order.update_status(OrderStatus.VALIDATED)
+        self.assertFalse(resp['updated'])
+        self.assertFalse(resp['tickets_generated'])
+        Job.objects.enqueue_post_payment(self.order)
+        self.assertEqual(self.order.jobs.count(), len(POST_PAYMENT_JOBS))
+
+        output = call_command('run_jobs', once=True, stdout=io.StringIO())
+        self.assertTrue(output.startswith(f"Ran {len(POST_PAYMENT_JOBS)} jobs"), output)
+        self.assertEqual(set(self.order.jobs.values_list('status', flat=True)),
+                         { 'done' })
+        orderlineitems = OrderLineItem.objects.filter(orderline__order=self.order)
+        self.assertEqual(orderlineitems.count(), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(self.order.owner.get_full_name(), mail.outbox[0].body)
+
+        # The PDF is rendered for the web workers to serve it
+        version = self.order.get_tickets_version()
+        path = os.path.join(settings.TICKETS_DIR, str(self.order.pk), f"{version}.pdf")
+        self.assertTrue(os.path.isfile(path))
+
+        # Done jobs are not run again
+        self.assertEqual(Job.objects.run_pending(), 0)
+
+    def test_retries(self):
+        """
+        Failing jobs must be retried later with a backoff, until they run out of attempts
+        """
+        job = Job.objects.enqueue('generate_tickets', self.order)
+        for attempt in range(1, settings.JOB_MAX_ATTEMPTS + 1):
+            Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+            with patch.object(Order, 'generate_orderlineitems_and_fields',
+                              side_effect=ValueError("boom")):
+                self.assertEqual(Job.objects.run_pending(), 1)
+            job.refresh_from_db()
+            self.assertEqual(job.attempts, attempt)
+            self.assertEqual(job.error, "ValueError: boom")
+            if attempt < settings.JOB_MAX_ATTEMPTS:
+                self.assertEqual(job.status, 'pending')
+                min_delay = settings.JOB_RETRY_DELAY * (attempt / 2)
+                self.assertGreater(job.run_at, timezone.now() + min_delay)
+                # Not due yet
+                self.assertEqual(Job.objects.run_pending(), 0)
+        self.assertEqual(job.status, 'failed')
+
+        # Jobs of stopped workers are claimed again once their lock expired
+        job = Job.objects.enqueue('render_tickets', self.order)
+        self.assertEqual(len(Job.objects.claim()), 1)
+        self.assertEqual(len(Job.objects.claim()), 0)
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now())
+        self.assertEqual([ claimed.pk for claimed in Job.objects.claim() ], [ job.pk ])
+
+
+@tag('order', 'quantities')
+class StockHoldTestCase(APITestCase):
+
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        self.sale = self.factory.create(Sale, max_item_quantity=None)
+        self.group = self.factory.create(ItemGroup, quantity=3, max_per_user=None)
+        self.items = [
+            self.factory.create(Item, sale=self.sale, group=self.group, quantity=2,
+                                max_per_user=None)
+            for __ in range(2)
+        ]
+
+    def set_orderlines(self, order: Order, quantities: dict):
+        self.client.force_authenticate(user=order.owner)
+        data = [
+            { 'item': item.pk, 'quantity': quantity }
+            for item, quantity in quantities.items()
+        ]
+        return self.client.post(f"/orders/{order.pk}/orderlines", data, format='json')
+
+    def test_holds(self):
+        """
+        Ongoing orders must hold their items and later orders fail early
+        """
+        first, second = [ self.factory.create(Order, sale=self.sale) for __ in range(2) ]
+        resp = self.set_orderlines(first, { self.items[0]: 2 })
+        self.assertEqual(resp.status_code, 201, resp.data)
+        self.assertEqual(StockHold.objects.get_quantity(self.sale).per_item,
+                         { self.items[0].pk: 2 })
+
+        # Item and group limits are checked against the holds of other orders
+        resp = self.set_orderlines(second, { self.items[0]: 1 })
+        self.assertEqual(resp.status_code, 406, resp.data)
+        self.assertEqual(resp.data['code'], 'not_enough_items')
+        resp = self.set_orderlines(second, { self.items[1]: 2 })
+        self.assertEqual(resp.status_code, 406, resp.data)
+        resp = self.set_orderlines(second, { self.items[1]: 1 })
+        self.assertEqual(resp.status_code, 201, resp.data)
+
+        # Decreasing quantities releases items
+        resp = self.set_orderlines(first, { self.items[0]: 1 })
+        self.assertEqual(resp.status_code, 201, resp.data)
+        resp = self.set_orderlines(second, { self.items[0]: 1, self.items[1]: 1 })
+        self.assertEqual(resp.status_code, 201, resp.data)
+
+        # Holds are replaced by bookings once the order leaves ongoing status
+        first.status = OrderStatus.AWAITING_PAYMENT.value
+        first.save()
+        self.assertFalse(first.holds.exists())
+        self.assertEqual(self.items[0].quantity_sold(), 1)
+        resp = self.set_orderlines(second, { self.items[0]: 2 })
+        self.assertEqual(resp.status_code, 406, resp.data)
+
+    def test_expired_holds(self):
+        """
+        Holds must be released when their order expires
+        """
+        first, second = [ self.factory.create(Order, sale=self.sale) for __ in range(2) ]
+        resp = self.set_orderlines(first, { self.items[0]: 2 })
+        self.assertEqual(resp.status_code, 201, resp.data)
+        resp = self.set_orderlines(second, { self.items[0]: 1 })
+        self.assertEqual(resp.status_code, 406, resp.data)
+
+        overdue = timezone.now() + settings.MAX_ONGOING_TIME
+        overdue += timezone.timedelta(minutes=1)
+        with patch('django.utils.timezone.now', return_value=overdue):
+            resp = self.set_orderlines(second, { self.items[0]: 1 })
+            self.assertEqual(resp.status_code, 201, resp.data)
+            Order.objects.expire_overdue()
+        self.assertFalse(StockHold.objects.filter(order=first).exists())
+
+
+@tag('order', 'lottery')
+class LotteryTestCase(APITransactionTestCase):
+
+    factory = FakeModelFactory()
+
+    def setUp(self):
+        now = timezone.now()
+        self.sale = self.factory.create(Sale, max_item_quantity=None,
+                                        begin_at=now - timezone.timedelta(days=1),
+                                        end_at=now + timezone.timedelta(days=7))
+        self.sale.registration_end_at = now + timezone.timedelta(days=1)
+        self.sale.save()
+        usertype = self.factory.create(UserType, validation='True')
+        self.group = self.factory.create(ItemGroup, quantity=6, max_per_user=None)
+        self.items = [
+            self.factory.create(Item, sale=self.sale, group=self.group, usertype=usertype,
+                                quantity=4, max_per_user=2)
+            for __ in range(2)
+        ]
+        self.users = [ self.factory.create(User) for __ in range(6) ]
+
+    def register(self, user: User, quantities: dict):
+        self.client.force_authenticate(user=user)
+        data = [
+            { 'item': item.pk, 'quantity': quantity }
+            for item, quantity in quantities.items()
+        ]
+        return self.client.post(f"/sales/{self.sale.pk}/intents", data, format='json')
+
+    def test_lottery(self):
+        """
+        Items must be drawn among intents within all the limits
+        """
+        for user in self.users:
+            resp = self.register(user, { self.items[0]: 1, self.items[1]: 3 })
+            self.assertEqual(resp.status_code, 201, resp.data)
+        resp = self.register(self.users[0], { self.items[0]: 2, self.items[1]: 0 })
+        self.assertEqual(resp.status_code, 201, resp.data)
+        self.assertEqual(resp.data, [ { 'item': self.items[0].pk, 'quantity': 2,
+                                        'allocated': None, 'order': None } ])
+        resp = self.client.post(f"/sales/{self.sale.pk}/intents",
+                                [ { 'item': { 'id': self.items[0].pk }, 'quantity': 1 } ],
+                                format='json')
+        self.assertEqual(resp.status_code, 400, resp.data)
+        self.assertEqual(resp.data['code'], 'invalid_intents')
+
+        # Items cannot be held nor ordered first come first served
+        resp = self.client.post(f"/sales/{self.sale.pk}/checkout", {
+            'orderlines': [ { 'item': self.items[0].pk, 'quantity': 1 } ],
+            'return_url': 'http://localhost:3000/orders',
+        }, format='json')
+        self.assertEqual(resp.status_code, 406, resp.data)
+        self.assertEqual(resp.data['code'], 'lottery_sale')
+        self.assertFalse(StockHold.objects.exists())
+        self.assertFalse(OrderLine.objects.exists())
+
+        order = self.factory.create(Order, owner=self.users[0], sale=self.sale)
+        self.factory.create(OrderLine, order=order, item=self.items[0], quantity=1)
+        self.client.force_authenticate(user=self.users[0])
+        resp = self.client.get(f"/orders/{order.pk}/pay?return_url=http://localhost:3000")
+        self.assertEqual(resp.status_code, 406, resp.data)
+        order.delete()
+
+        # Nothing is drawn before the end of the registration
+        output = call_command('draw_lottery', stdout=io.StringIO())
+        self.assertTrue(output.startswith("Drew 0"), output)
+        self.sale.registration_end_at = timezone.now() - timezone.timedelta(minutes=1)
+        self.sale.save()
+        resp = self.register(self.users[1], { self.items[0]: 1 })
+        self.assertEqual(resp.status_code, 406, resp.data)
+
+        # Drawn orders must be found back on databases
+        # that don't return bulk inserted keys
+        with patch.object(connection.features, 'can_return_rows_from_bulk_insert', False):
+            output = call_command('draw_lottery', self.sale.pk, seed='42',
+                                  stdout=io.StringIO())
+        self.assertTrue(output.startswith("Drew 1"), output)
+
+        orders = Order.objects.filter(sale=self.sale)
+        statuses = { order.status for order in orders }
+        self.assertEqual(statuses, { OrderStatus.AWAITING_VALIDATION.value })
+        self.assertEqual(len(mail.outbox), len(orders))
+        self.assertTrue(all(item.quantity_sold() <= item.quantity for item in self.items))
+        sold = sum(item.quantity_sold() for item in self.items)
+        self.assertEqual(sold, self.group.quantity)
+        for user in self.users:
+            quantities = OrderLine.objects \
+                .filter(order__owner=user, order__sale=self.sale) \
+                .values_list('item_id', 'quantity')
+            self.assertTrue(all(quantity <= 2 for __, quantity in quantities))
+            allocated = PurchaseIntent.objects.filter(owner=user) \
+                                              .values_list('item_id', 'allocated')
+            allocated = dict(allocated)
+            expected = { **dict.fromkeys(allocated, 0), **dict(quantities) }
+            self.assertEqual(allocated, expected)
+
+        # Winners can pay their order
+        order = orders.first()
+        self.client.force_authenticate(user=order.owner)
+        resp = self.client.get(f"/orders/{order.pk}/pay?return_url=http://localhost:3000")
+        self.assertEqual(resp.status_code, 200, resp.data)
+
+        # Intents are only drawn once
+        output = call_command('draw_lottery', self.sale.pk, stdout=io.StringIO())
+        self.assertTrue(output.startswith("Drew 0"), output)
+
+
 @tag('order')
 class OrderLineViewSetTestCase(ModelViewSetTestCase):
     model = OrderLine
@@ -153,6 +775,75 @@ class OrderLineViewSetTestCase(ModelViewSetTestCase):
     def get_url(self, pk=None) -> str:
         return super().get_url(pk) + "?all"
 
+    def _bulk_upsert(self, quantities: dict) -> Tuple[int, object]:
+        """
+        Helper to upsert orderlines at once and count the queries run
+        """
+        data = [
+            { 'item': item.pk, 'quantity': quantity }
+            for item, quantity in quantities.items()
+        ]
+        self.client.force_authenticate(user=self.users['user'])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(f"/orders/{self.order.pk}/orderlines", data,
+                                        format='json')
+        return len(context.captured_queries), response
+
+    def test_bulk_upsert(self):
+        """
+        Orderlines must be upserted at once with a constant number of queries
+        """
+        self.order.orderlines.all().delete()
+        items = [ self.factory.create(Item, sale=self.order.sale) for __ in range(10) ]
+
+        self._bulk_upsert({ items[0]: 1, items[1]: 1, items[2]: 1 })
+
+        # Delete, update and create one orderline
+        quantities = { items[0]: 0, items[1]: 2, items[3]: 1 }
+        num_queries, response = self._bulk_upsert(quantities)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        self.assertEqual(len(response.data), 2)
+
+        # Delete, update and create many orderlines
+        quantities = { item: i for i, item in enumerate(items) if i > 1 }
+        quantities[items[1]] = 0
+        num_queries_more, response = self._bulk_upsert(quantities)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        self.assertEqual(num_queries_more, num_queries)
+        self.assertEqual(len(response.data), len(items) - 2)
+
+        expected = {
+            item.pk: quantity for item, quantity in quantities.items() if quantity
+        }
+        orderlines = self.order.orderlines.values_list('item_id', 'quantity')
+        self.assertEqual(dict(orderlines), expected)
+
+        # Created orderlines are returned on databases
+        # that don't return bulk inserted keys
+        with patch.object(connection.features, 'can_return_rows_from_bulk_insert', False):
+            __, response = self._bulk_upsert({ items[0]: 1, items[1]: 0 })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        self.assertEqual(len(response.data), 1)
+        self.assertIsNotNone(response.data[0]['id'])
+        self.order.orderlines.filter(item=items[0]).delete()
+
+        # Items of other sales are refused
+        other_item = self.factory.create(Item)
+        __, response = self._bulk_upsert({ items[1]: 5, other_item: 1 })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        orderlines = self.order.orderlines.values_list('item_id', 'quantity')
+        self.assertEqual(dict(orderlines), expected)
+
+        # Items and orders must be ids
+        invalid_lines = (
+            { 'item': [ items[1].pk ], 'quantity': 1 },
+            { 'item': items[1].pk, 'quantity': 1, 'order': { 'id': self.order.pk } },
+        )
+        for line in invalid_lines:
+            response = self.client.post("/orderlines", [ line ], format='json')
+            self.assertEqual(response.status_code, 400, response.data)
+            self.assertEqual(response.data['code'], 'invalid_orderlines')
+
 
 @tag('order')
 class OrderLineItemViewSetTestCase(ModelViewSetTestCase):
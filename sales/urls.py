@@ -6,7 +6,7 @@ from authentication.views import UserViewSet, UserTypeViewSet
 from .views import (
     AssociationViewSet, SaleViewSet, ItemGroupViewSet, ItemViewSet,
     OrderViewSet, OrderLineViewSet, OrderLineItemViewSet, FieldViewSet,
-    OrderLineFieldViewSet, ItemFieldViewSet, generate_tickets
+    OrderLineFieldViewSet, ItemFieldViewSet, purchase_intents, generate_tickets
 )
 
 urlpatterns = merge_sets(
@@ -63,6 +63,8 @@ urlpatterns = merge_sets(
 )
 
 urlpatterns += [
+    # Tirage au sort
+    path('sales/<str:pk>/intents', purchase_intents, name='sale-intents'),
     # Generation du PDF
     path('orders/<int:pk>/pdf', generate_tickets),
 ]
@@ -1,12 +1,15 @@
-from django.shortcuts import render
 from django.http import HttpResponse
+from django.db import transaction
+from django.shortcuts import get_object_or_404
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 
 from authentication.oauth import OAuthAuthentication
-from core.utils import render_to_pdf, base64_qrcode
+from core.exceptions import InvalidRequest
+from core.helpers import is_list_of_records
 from core.viewsets import ModelViewSet, APIModelViewSet
 from core.permissions import CanOnlyReadOrUpdate, IsAdmin, IsAdminOrReadOnly
 from sales.exceptions import OrderValidationException
@@ -15,7 +18,7 @@ from sales.permissions import (
 )
 from sales.models import (
     Association, Sale, ItemGroup, Item,
-    OrderStatus, Order, OrderLine, OrderLineItem,
+    OrderStatus, Order, OrderLine, OrderLineItem, StockHold, PurchaseIntent,
     Field, ItemField, OrderLineField
 )
 from sales.serializers import (
@@ -23,6 +26,7 @@ from sales.serializers import (
     OrderSerializer, OrderLineSerializer, OrderLineItemSerializer,
     FieldSerializer, ItemFieldSerializer, OrderLineFieldSerializer,
 )
+from payment.admission import AdmissionQueue
 
 
 # --------------------------------------------
@@ -88,7 +92,7 @@ class ItemViewSet(ModelViewSet):
     """
     Defines the behavior of the item interactions
     """
-    queryset = Item.objects.all()
+    queryset = Item.objects.with_quantities().prefetch_related('itemfields', 'fields')
     serializer_class = ItemSerializer
     permission_classes = [IsManagerOrReadOnly]
 
@@ -162,6 +166,11 @@ class OrderViewSet(ModelViewSet):
             serializer = self.get_serializer(instance=order)
             status_code = status.HTTP_200_OK
         except Order.DoesNotExist:
+            # Only users admitted by the queue of the sale can order
+            sale = Sale.objects.filter(pk=sale_pk).first()
+            if sale is not None:
+                AdmissionQueue(sale).check(request.user)
+
             # Configure new Order
             serializer = OrderSerializer(data={
                 'sale': sale_pk,
@@ -229,16 +238,14 @@ class OrderLineViewSet(ModelViewSet):
 
         return queryset
 
-    def create(self, request, *args, **kwargs):
+    def get_open_order(self, order_pk) -> Order:
         """
-        Create an orderline attached to an order
+        Retrieve an order that the user can change or fail
         """
-        # Retrieve Order or fail
-        order_pk = self.get_kwarg('order_pk', 'order')
         order = Order.objects.get(pk=order_pk)
 
         # Check Order owner
-        user = request.user
+        user = self.request.user
         if not (user.is_authenticated and user.is_admin or order.owner == user):
             raise PermissionDenied()
 
@@ -246,6 +253,20 @@ class OrderLineViewSet(ModelViewSet):
         if order.status != OrderStatus.ONGOING.value:
             raise OrderValidationException("La commande n'accepte plus de changement.", 'unchangable_order')
 
+        return order
+
+    def create(self, request, *args, **kwargs):
+        """
+        Create an orderline attached to an order,
+        or many at once from a list of { item, quantity }
+        """
+        if isinstance(request.data, list):
+            return self.bulk_upsert(request, request.data)
+
+        # Retrieve an open Order or fail
+        order_pk = self.get_kwarg('order_pk', 'order')
+        order = self.get_open_order(order_pk)
+
         item_pk = request.data.get('item')
         try:
             quantity = int(request.data.get('quantity'))
@@ -257,36 +278,72 @@ class OrderLineViewSet(ModelViewSet):
                 status_code=status.HTTP_400_BAD_REQUEST
             ) from error
 
-        # Try to retrieve a similar OrderLine...
-        # TODO ajout de la vérification de la limite de temps
-        try:
-            orderline = OrderLine.objects.get(order=order_pk, item=item_pk)
-            serializer = OrderLineSerializer(orderline, data={ 'quantity': quantity }, partial=True)
-
-            # Delete empty OrderLines
-            if quantity <= 0:
-                orderline.delete()
-                return Response(serializer.initial_data, status=status.HTTP_205_RESET_CONTENT)
-
-        except OrderLine.DoesNotExist:
-            # ...or create a new one
-            if quantity > 0:
-                serializer = self.get_serializer(data={
-                    'order': order_pk,
-                    'item': item_pk,
-                    'quantity': quantity,
-                })
-            # If no quantity, then no OrderLine
-            else:
-                return Response({}, status=status.HTTP_204_NO_CONTENT)
-
-        # Validate and create OrderLineSerializer
-        serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
+        with transaction.atomic():
+            # Try to retrieve a similar OrderLine...
+            # TODO ajout de la vérification de la limite de temps
+            try:
+                orderline = OrderLine.objects.get(order=order_pk, item=item_pk)
+                serializer = OrderLineSerializer(orderline, data={ 'quantity': quantity }, partial=True)
+
+                # Delete empty OrderLines and release their items
+                if quantity <= 0:
+                    StockHold.objects.hold(order, { orderline.item_id: 0 })
+                    orderline.delete()
+                    return Response(serializer.initial_data, status=status.HTTP_205_RESET_CONTENT)
+
+                item_pk = orderline.item_id
+            except OrderLine.DoesNotExist:
+                # ...or create a new one
+                if quantity > 0:
+                    serializer = self.get_serializer(data={
+                        'order': order_pk,
+                        'item': item_pk,
+                        'quantity': quantity,
+                    })
+                # If no quantity, then no OrderLine
+                else:
+                    return Response({}, status=status.HTTP_204_NO_CONTENT)
+
+            # Validate, hold items or fail early and create OrderLineSerializer
+            serializer.is_valid(raise_exception=True)
+            StockHold.objects.hold(order, { int(item_pk): quantity })
+            self.perform_create(serializer)
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    def bulk_upsert(self, request, data: list):
+        """
+        Create, update or delete the orderlines of an order at once
+        from a list of { item, quantity }, empty orderlines are deleted
+        """
+        if not is_list_of_records(data, ('order', 'item')):
+            raise InvalidRequest(
+                "Les articles commandés doivent être une liste de { item, quantity }.",
+                'invalid_orderlines')
+
+        # The order comes from the url or must be the same for all lines
+        order_pks = { line.get('order') for line in data }
+        order_pk = self.kwargs.get('order_pk')
+        if order_pk is None:
+            if len(order_pks) != 1:
+                raise InvalidRequest(
+                    "Les articles doivent appartenir à une seule commande.",
+                    'multiple_orders')
+            order_pk = order_pks.pop()
+
+        with transaction.atomic():
+            order = self.get_open_order(order_pk)
+            orderlines = order.set_orderlines({
+                line.get('item'): line.get('quantity') for line in data
+            })
+
+        item_pks = [ orderline.item_id for orderline in orderlines ]
+        orderlines = OrderLine.objects.filter(order=order, item_id__in=item_pks) \
+                                      .prefetch_related('orderlineitems')
+        serializer = self.get_serializer(orderlines, many=True)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
 
 class OrderLineItemViewSet(ModelViewSet):
     queryset = OrderLineItem.objects.all()
@@ -351,6 +408,37 @@ class OrderLineFieldViewSet(ModelViewSet):
         return Response(serializer.data)
 
 
+# --------------------------------------------
+#   Lottery
+# --------------------------------------------
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def purchase_intents(request, pk: str, **kwargs):
+    """
+    Get or replace the purchase intents of the user on a lottery sale
+
+    Body:
+        list of { item, quantity }
+    """
+    sale = get_object_or_404(Sale, pk=pk)
+    if request.method == 'POST':
+        data = request.data
+        if not is_list_of_records(data, ('item',)):
+            raise InvalidRequest(
+                "Les articles souhaités doivent être une liste de { item, quantity }.",
+                'invalid_intents')
+        PurchaseIntent.objects.register(sale, request.user, {
+            line.get('item'): line.get('quantity') for line in data
+        })
+
+    intents = PurchaseIntent.objects.filter(sale=sale, owner=request.user) \
+                            .values('item', 'quantity', 'allocated', 'order')
+    if request.method == 'POST':
+        return Response(list(intents), status=status.HTTP_201_CREATED)
+    return Response(list(intents), status=status.HTTP_200_OK)
+
+
 # --------------------------------------------
 #   Tickets
 # --------------------------------------------
@@ -360,65 +448,27 @@ class OrderLineFieldViewSet(ModelViewSet):
 @permission_classes([IsOwnerOrManagerReadOnly])
 def generate_tickets(request, pk: int, **kwargs):
     # Get order
-    order = Order.objects.all().prefetch_related(
-        'orderlines', 'orderlines__orderlineitems', 'orderlines__item',
-        'orderlines__orderlineitems__orderlinefields',
-        'orderlines__orderlineitems__orderlinefields__field'
-    ).get(pk=pk)
+    order = Order.objects.select_related('sale', 'owner').get(pk=pk)
 
     # Check order is valid
     if order.status not in OrderStatus.VALIDATED_LIST.value:
         raise OrderValidationException(
             "La commande n'est pas valide", 'unvalid_order_tickets',
             details=f"Status: {order.get_status_display()}",
-            status=status.HTTP_400_BAD_REQUEST)
-
-    # Process tickets
-    tickets = []
-    for orderline in order.orderlines.all():
-        for orderlineitem in orderline.orderlineitems.all():
-            # Process QRCode
-            orderline_code = str(orderlineitem.id).replace('-', '')
-            qr_code = base64_qrcode(orderline_code)
-
-            # TODO Add more flexibility
-            # Add Nom et Prénom to orderline
-            first_name = last_name = None
-            for orderlinefield in orderlineitem.orderlinefields.all():
-                if orderlinefield.field.name == 'Nom':
-                    first_name = orderlinefield.value
-                elif orderlinefield.field.name == 'Prénom':
-                    last_name = orderlinefield.value
-
-            if first_name is None:
-                first_name = order.owner.first_name
-            if last_name is None:
-                last_name = order.owner.last_name
-
-            # Add a ticket with this data
-            tickets.append({
-                'nom': first_name,
-                'prenom': last_name,
-                'qr_code': qr_code,
-                'item': orderline.item,
-                'uuid': orderlineitem.id,
-            })
-
-    # Render template
-    template = 'pdf/template_order.html'
-    data = {
-        'tickets': tickets,
-        'order': order,
-    }
-    if request.GET.get('type', 'pdf') == 'html':
-        return render(request, template, data)
-    else:
-        pdf = render_to_pdf(template, data)
-        response = HttpResponse(pdf, content_type='application/pdf')
-
-        # Add download header by default
-        if request.GET.get('download', 'false') != 'false':
-            filename = f"Woolly_{order.sale.name}_{order.pk}.pdf"
-            response['Content-Disposition'] = f'attachment;filename="{filename}"'
-
-        return response
+            status_code=status.HTTP_400_BAD_REQUEST)
+
+    # Tickets are generated by the post-payment jobs, or now if they did not run yet
+    if order.has_missing_tickets():
+        order.generate_orderlineitems_and_fields()
+
+    kind = 'html' if request.GET.get('type', 'pdf') == 'html' else 'pdf'
+    content = order.get_rendered_tickets(kind, request)
+    if kind == 'html':
+        return HttpResponse(content)
+
+    response = HttpResponse(content, content_type='application/pdf')
+    # Add download header by default
+    if request.GET.get('download', 'false') != 'false':
+        filename = f"Woolly_{order.sale.name}_{order.pk}.pdf"
+        response['Content-Disposition'] = f'attachment;filename="{filename}"'
+    return response
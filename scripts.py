@@ -1,11 +1,10 @@
 from sales.models import *
 import pandas as pd
-from payment.services.payutc import Payutc
-from woolly_api.settings import EXPORTS_DIR, PAYUTC_KEY, MAX_ONGOING_TIME, MAX_PAYMENT_TIME
-from payment.views import updateOrderStatus, createOrderLineItemsAndFields
+from woolly_api.settings import EXPORTS_DIR
 from os import path
 from tqdm.auto import tqdm
 from django.utils import timezone
+from django.core.management import call_command
 from django.db.models import Count
 
 
@@ -83,53 +82,12 @@ def dump_sale_excel(sale_pk: int=None):
 
 def update_orders(sale_pk: int=None):
 	"""
-	Update all ongoing and awaiting orders
+	Update all awaiting orders and then expire overdue orders,
+	see the reconcile_orders and expire_orders commands
 	"""
-
-	payutc = Payutc({ 'app_key': PAYUTC_KEY })
-
-	orders = Order.objects.prefetch_related('sale', 'sale__association', 'owner', 'orderlines', 'orderlines__item') \
-												.filter(status__in=OrderStatus.BUYABLE_STATUS_LIST.value)
-
-	if sale_pk is not None:
-		orders = orders.filter(sale_id=sale_pk)
-
-	def _check_payutc(order):
-		transaction = payutc.getTransactionInfo({ 'tra_id': order.tra_id, 'fun_id': order.sale.association.fun_id })
-		return updateOrderStatus(order, transaction)
-
-	def _process_order(order):
-		from_status = order.status
-		message = "Unchanged"
-
-		if order.status == OrderStatus.ONGOING.value:
-			# Check if the order is outdated
-			if order.created_at + MAX_ONGOING_TIME < timezone.now():
-				order.status = OrderStatus.EXPIRED.value
-				order.save()
-				message = "Outdated"
-
-		elif order.status == OrderStatus.AWAITING_PAYMENT.value:
-			transaction = payutc.getTransactionInfo({ 'tra_id': order.tra_id, 'fun_id': order.sale.association.fun_id })
-			if 'error' in transaction:
-				message = "Payutc Error: " + transaction['error']['message']
-			else:
-				updateOrderStatus(order, transaction)
-				message = "Updated"
-
-		return {
-			'sale': order.sale.name,
-			'owner': order.owner.email,
-			'order_id': order.pk,
-			'items': ', '.join('{} x {}'.format(orderline.quantity, orderline.item.name) for orderline in order.orderlines.all()),
-			'from': OrderStatus(from_status).name,
-			'to': OrderStatus(order.status).name,
-			'message': message,
-		}
-
-	results = pd.DataFrame(_process_order(order) for order in tqdm(orders, desc="Updating orders..."))
-	results.to_excel(_export_name("update_orders", sale_pk))
-	print("Updated and dumped {} orders.".format(len(results)))
+	sales = [] if sale_pk is None else [sale_pk]
+	call_command('reconcile_orders', *sales)
+	call_command('expire_orders', *sales)
 
 def gen_tickets(sale_pk: int=None):
 	orders = Order.objects.prefetch_related('sale', 'sale__association', 'owner', 'orderlines', 'orderlines__orderlineitems', 'orderlines__item') \
@@ -143,7 +101,7 @@ def gen_tickets(sale_pk: int=None):
 	total_tickets = 0
 	for order in tqdm(orders, desc="Generating tickets..."):
 		before = sum(len(orderline.orderlineitems.all()) for orderline in order.orderlines.all())
-		after = createOrderLineItemsAndFields(order)
+		after = order.generate_orderlineitems_and_fields()
 		total_tickets += after
 		results.append({
 			'sale': order.sale.name,
@@ -28,12 +28,20 @@ def make_path(rel: str) -> str:
 # --------------------------------------------------------------------------
 
 EXPORTS_DIR = make_path('exports')
+TICKETS_DIR = os.path.join(EXPORTS_DIR, 'tickets')
 
 MAX_ONGOING_TIME = timedelta(minutes=15)
 MAX_PAYMENT_TIME = timedelta(hours=1)
 MAX_VALIDATION_TIME = timedelta(days=30)
 
 API_MODEL_CACHE_TIMEOUT = timedelta(minutes=30)
+FETCHED_STATUS_CACHE_TIMEOUT = timedelta(seconds=5)
+ADMISSION_CHECKOUT_DURATION = timedelta(seconds=30)
+ADMISSION_TOKEN_TIMEOUT = timedelta(minutes=5)
+QRCODE_CACHE_SIZE = 4096
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = timedelta(seconds=30)
+JOB_LOCK_TIMEOUT = timedelta(minutes=5)
 
 VALID_TVA = (0, 5.5, 10, 20)
 
@@ -42,7 +50,11 @@ VALID_TVA = (0, 5.5, 10, 20)
 # --------------------------------------------------------------------------
 
 # Payutc & Portail des Assos config
-PAYUTC = confidentials.PAYUTC
+PAYUTC = dict(confidentials.PAYUTC)
+# Point to a local stand-in, see `python manage.py fake_payutc`
+if os.environ.get('PAYUTC_BASE_URL'):
+    PAYUTC['base_url'] = os.environ['PAYUTC_BASE_URL'].rstrip('/')
+    PAYUTC['payment_url'] = f"{PAYUTC['base_url']}/validation"
 OAUTH = {
     'portal': {
         'client_id':        confidentials.PORTAL['id'],